@@ -0,0 +1,968 @@
+'''
+    Description: Microbenchmarks for the depth and detection utilities. All of the
+                 benchmarks run on synthetic or recorded data so no camera is needed
+    Usage: python benchmark.py --bench="sampling"
+           python benchmark.py --bench="all" --replay recordings/hallway
+           python benchmark.py --bench="detectors" --replay recordings/hallway --repeat 100 \
+               --detector tflite:models/detect.tflite --detector dnn:yolo-coco
+'''
+
+from realsense import ArrayFrame, DepthHistory, DepthFilterChain, DepthIntegral
+from realsense import filter_distance, sample_distances, box_distances
+from depth_profile import get_depth_profile
+from obstacle_map import ObstacleMap, coverage
+from point_cloud import GroundObstacles
+from registration import Registration
+from replay import Recording
+from frame_pool import FramePool, AllocationMeter
+from detector import create_detector, TFLiteDetector, Detections, decode_yolo, nms, postprocess
+from collections import deque
+from pipeline import Pipeline
+from tracker import DetectionScheduler, iou_matrix
+from roi import CorridorROI
+from gating import DepthGate, SceneGate
+from governor import Governor, Tier
+import tempfile
+import os
+import numpy as np
+import argparse
+import time
+import cv2
+
+def synthetic_depth(width=640, height=480, holes=0.1, seed=42):
+    # Build a z16 depth image of a tilted plane (mm) with sensor noise and holes
+    rng = np.random.RandomState(seed)
+    yy, xx = np.mgrid[0:height, 0:width]
+    depth = 800 + 4*yy + xx + rng.normal(0, 15, size=(height, width))
+    depth[rng.random_sample((height, width)) < holes] = 0
+
+    return depth.astype(np.uint16)
+
+def synthetic_floor_depth(camera_height=1.2, tilt=15, fx=600.0, width=640, height=480, seed=0):
+    # z16 depth of a flat floor seen by a camera tilted down by `tilt` degrees,
+    # with a 1.5m distant box in the middle of the frame, noise and holes
+    rng = np.random.RandomState(seed)
+    v, u = np.mgrid[0:height, 0:width]
+    down = (v - height/2) / fx * np.cos(np.radians(tilt)) + np.sin(np.radians(tilt))
+    depth = np.where(down > 1e-3, camera_height / np.maximum(down, 1e-3), 0)
+    depth[depth > 6] = 0
+    depth[(abs(u - width/2) < 40) & (abs(v - height/2) < 90)] = 1.5
+
+    depth = np.where(depth > 0, depth*1000 + rng.normal(0, 5, size=depth.shape), 0)
+    depth[rng.random_sample(depth.shape) < 0.05] = 0
+    return depth.astype(np.uint16)
+
+def synthetic_hallway_depth(obstacle=None, half_width=0.6, camera_height=1.2, fx=600.0, width=640, height=480, seed=0):
+    # z16 depth of a hallway half_width (m) to either side with the floor and
+    # ceiling camera_height away and an end wall at 6m, seen by a level camera.
+    # obstacle is an optional (x1, y1, x2, y2, distance) box in front of it
+    rng = np.random.RandomState(seed)
+    v, u = np.mgrid[0:height, 0:width]
+    du, dv = np.maximum(abs(u - width/2), 1), np.maximum(abs(v - height/2), 1)
+    depth = np.minimum(np.minimum(half_width * fx / du, camera_height * fx / dv), 6.0)
+    if obstacle is not None:
+        x1, y1, x2, y2, distance = obstacle
+        depth[y1:y2, x1:x2] = np.minimum(depth[y1:y2, x1:x2], distance)
+
+    depth = depth*1000 + rng.normal(0, 10, size=depth.shape)
+    depth[rng.random_sample(depth.shape) < 0.05] = 0
+    return depth.astype(np.uint16)
+
+# Recording to draw the benchmark frames from, synthetic frames are used if unset
+REPLAY = None
+
+# (backend, model) pairs compared by the detector benchmark
+DETECTORS = []
+
+def color_frames(count=1):
+    # Color images for the benchmarks, random noise when there is no recording
+    if REPLAY is None:
+        rng = np.random.RandomState(0)
+        return [rng.randint(0, 256, size=(480, 640, 3)).astype(np.uint8) for _ in range(count)]
+
+    recording = Recording(REPLAY)
+    idx = np.linspace(0, len(recording) - 1, count).astype(int)
+    return [np.array(recording[i][0]) for i in idx]
+
+def depth_frames(count=1):
+    # Depth images for the benchmarks, evenly spaced through the recording
+    if REPLAY is None:
+        return [synthetic_depth(seed=i) for i in range(count)]
+
+    recording = Recording(REPLAY)
+    idx = np.linspace(0, len(recording) - 1, count).astype(int)
+    return [np.array(recording[i][1]) for i in idx]
+
+def legacy_filter_distance(depth_frame, x, y):
+    # Original implementation of realsense.filter_distance, kept for comparison
+    distances = []
+    positive = np.random.randint(low=30, high=100)
+
+    i = 0
+    while(i < 50):
+        dist = int(depth_frame.get_distance(x, y) * 100)
+        if dist != 0:
+            positive = dist
+        distances.append(positive)
+        i += 1
+
+    distances = np.asarray(distances)
+    return int(distances.mean())
+
+def legacy_depth_profile(depth_frame, profile_width, X, Y):
+    # Original per-pixel implementation of depth_profile.get_depth_profile
+    X = min(max(X, 0), 639)
+    Y = min(max(Y, 0), 479)
+    if (profile_width >= 640-X):
+        profile_width = 639-X
+
+    depth_profile = []
+    for i in range(profile_width):
+        depth_profile.append(legacy_filter_distance(depth_frame, X+i, Y))
+
+    return np.array(depth_profile)
+
+def legacy_coverage(depth_frame):
+    # Original nested loop of depth_estimation/test_realsense.py
+    grid = []
+    coverage = [0]*64
+    for y in range(480):
+        for x in range(640):
+            dist = depth_frame.get_distance(x, y)
+            if 0 < dist and dist < 1:
+                coverage[x//10] += 1
+        if y % 20 == 19:
+            grid.append(coverage)
+            coverage = [0]*64
+
+    return grid
+
+def timeit(func, repeat):
+    # Return the mean time per call in milliseconds
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+
+    return (time.perf_counter() - start) / repeat * 1000
+
+def bench_sampling(repeat):
+    depth_frame = ArrayFrame(depth_frames()[0])
+    points = [(320, 240), (410, 240), (230, 240), (320, 420), (380, 420), (260, 420)]
+
+    legacy = timeit(lambda: [legacy_filter_distance(depth_frame, x, y) for x, y in points], repeat)
+    vectorized = timeit(lambda: [filter_distance(depth_frame, x, y) for x, y in points], repeat)
+
+    print("[INFO] filter_distance x{} points".format(len(points)))
+    print("    legacy:     {:.3f} ms".format(legacy))
+    print("    vectorized: {:.3f} ms ({:.1f}x)".format(vectorized, legacy/vectorized))
+
+def random_boxes(count, width=640, height=480, seed=0):
+    # Random (x1, y1, x2, y2) pixel boxes of 20-200px inside the frame
+    rng = np.random.RandomState(seed)
+    size = rng.randint(20, 200, size=(count, 2))
+    start = rng.randint(0, [width, height], size=(count, 2)) % ([width, height] - size)
+
+    return np.hstack([start, start + size])
+
+def bench_batch(repeat):
+    depth_frame = ArrayFrame(depth_frames()[0])
+
+    print("[INFO] batched depth queries vs per-point filter_distance")
+    print("    {:>5} {:>12} {:>12} {:>12}".format("N", "loop (ms)", "points (ms)", "boxes (ms)"))
+    for count in [1, 10, 50, 100]:
+        boxes = random_boxes(count)
+        points = (boxes[:, :2] + boxes[:, 2:]) // 2
+
+        loop = timeit(lambda: [filter_distance(depth_frame, x, y) for x, y in points], repeat)
+        batched = timeit(lambda: sample_distances(depth_frame, points), repeat)
+        boxed = timeit(lambda: box_distances(depth_frame, boxes), repeat)
+        print("    {:>5} {:>12.3f} {:>12.3f} {:>12.3f}".format(count, loop, batched, boxed))
+
+def bench_profile(repeat):
+    depth_frame = ArrayFrame(depth_frames()[0])
+
+    # navigate() takes two 100px profiles on either side of the object
+    legacy = timeit(lambda: [legacy_depth_profile(depth_frame, 100, x, 270) for x in (120, 420)],
+                    max(repeat // 20, 1))
+    vectorized = timeit(lambda: [get_depth_profile(depth_frame, 100, x, 270) for x in (120, 420)], repeat)
+    band = timeit(lambda: [get_depth_profile(depth_frame, 100, x, 270, thickness=5) for x in (120, 420)],
+                  repeat)
+
+    print("[INFO] get_depth_profile, two 100px profiles")
+    print("    legacy:             {:.3f} ms".format(legacy))
+    print("    vectorized (1 row): {:.3f} ms ({:.0f}x)".format(vectorized, legacy/vectorized))
+    print("    vectorized (5 row): {:.3f} ms ({:.0f}x)".format(band, legacy/band))
+
+def bench_history(repeat):
+    print("[INFO] DepthHistory push and temporal statistics")
+    print("    {:>6} {:>10} {:>10} {:>16} {:>12}".format("frames", "MB", "push (ms)", "median 64px (ms)", "point (ms)"))
+    for length in [3, 5, 10]:
+        history = DepthHistory(length)
+        frames = depth_frames(length)
+        for frame in frames:
+            history.push(frame)
+
+        push = timeit(lambda: history.push(frames[0]), repeat)
+        median = timeit(lambda: history.median((288, 208, 352, 272)), repeat)
+        point = timeit(lambda: history.distance(320, 240), repeat)
+        print("    {:>6} {:>10.1f} {:>10.3f} {:>16.3f} {:>12.3f}".format(
+            length, history.nbytes / 1e6, push, median, point))
+
+def calibration(width=640, height=480):
+    # Calibration of the recording, or typical D415 values for synthetic frames
+    if REPLAY is not None and "color_intrinsics" in Recording(REPLAY).calibration:
+        return Recording(REPLAY).calibration
+
+    def intrinsics(f):
+        return {"width": width, "height": height, "fx": f, "fy": f, "ppx": width/2, "ppy": height/2,
+                "model": "distortion.brown_conrady", "coeffs": [0.0]*5}
+
+    return {
+        "depth_scale": 0.001,
+        "depth_intrinsics": intrinsics(600.0),
+        "color_intrinsics": intrinsics(615.0),
+        "depth_to_color": {"rotation": [1.0, 0, 0, 0, 1.0, 0, 0, 0, 1.0], "translation": [0.015, 0, 0]},
+    }
+
+def bench_registration(repeat):
+    depth = depth_frames()[0]
+    start = time.perf_counter()
+    registration = Registration(calibration())
+    setup = (time.perf_counter() - start) * 1000
+
+    print("[INFO] depth to color registration (tables built in {:.1f} ms)".format(setup))
+    for count in [1, 10, 100]:
+        points = (random_boxes(count)[:, :2] + 10)
+        aligned = timeit(lambda: registration.sample_distances(depth, points), repeat)
+        print("    {:>3} points: {:.3f} ms".format(count, aligned))
+
+    registration.remap_tables(1.3)
+    print("    full frame remap: {:.3f} ms".format(timeit(lambda: registration.align(depth), repeat)))
+
+def bench_filters(repeat):
+    frames = depth_frames(10)
+
+    # Time each stage on its own and then the default chain
+    stages = {
+        "decimation x2": DepthFilterChain(decimation=2, threshold=None, spatial=None, temporal=None, hole_filling=False),
+        "threshold": DepthFilterChain(spatial=None, temporal=None, hole_filling=False),
+        "spatial": DepthFilterChain(threshold=None, temporal=None, hole_filling=False),
+        "temporal": DepthFilterChain(threshold=None, spatial=None, hole_filling=False),
+        "hole filling": DepthFilterChain(threshold=None, spatial=None, temporal=None),
+        "default chain": DepthFilterChain(),
+        "default chain, decimation x2": DepthFilterChain(decimation=2),
+    }
+
+    print("[INFO] numpy depth filter chain per frame")
+    for name, chain in stages.items():
+        frame = iter(frames * (repeat // len(frames) + 1))
+        print("    {:<30} {:.3f} ms".format(name, timeit(lambda: chain.process(next(frame)), repeat)))
+
+def bench_integral(repeat):
+    depth = depth_frames()[0]
+    integral = DepthIntegral(depth)
+
+    print("[INFO] summed area tables, built in {:.3f} ms per frame".format(
+        timeit(lambda: DepthIntegral(depth), repeat)))
+    print("    {:>5} {:>16} {:>18} {:>16}".format("boxes", "box stats (ms)", "box_distances (ms)", "midpoint (ms)"))
+    for count in [1, 10, 50, 100, 200]:
+        boxes = random_boxes(count)
+        points = (boxes[:, :2] + boxes[:, 2:]) // 2
+
+        stats = timeit(lambda: integral.box_stats(boxes), repeat)
+        lattice = timeit(lambda: box_distances(depth, boxes), repeat)
+        midpoint = timeit(lambda: sample_distances(depth, points), repeat)
+        print("    {:>5} {:>16.3f} {:>18.3f} {:>16.3f}".format(count, stats, lattice, midpoint))
+
+def bench_obstacles(repeat):
+    depth = depth_frames()[0]
+
+    print("[INFO] obstacle map of a whole frame")
+    print("    legacy coverage loop: {:.1f} ms".format(timeit(lambda: legacy_coverage(ArrayFrame(depth)), 1)))
+    print("    coverage grid:        {:.3f} ms".format(timeit(lambda: coverage(depth), repeat)))
+    for step in [1, 2, 4]:
+        obstacle_map = ObstacleMap(step=step)
+        print("    ObstacleMap step={}:   {:.3f} ms".format(step, timeit(lambda: obstacle_map.update(depth), repeat)))
+
+def bench_ground(repeat):
+    # Recorded frames if there are any, otherwise a synthetic floor scene
+    frames = depth_frames(10) if REPLAY is not None else [synthetic_floor_depth(seed=i) for i in range(10)]
+    intrinsics = calibration()["depth_intrinsics"]
+
+    print("[INFO] point cloud ground removal per frame")
+    for step in [2, 4, 8]:
+        for budget in [0.002, 0.005]:
+            ground = GroundObstacles(intrinsics, step=step)
+            ground.ground.budget = budget
+            frame = iter(frames * (repeat // len(frames) + 1))
+            elapsed = timeit(lambda: ground.update(next(frame)), repeat)
+            print("    step={} budget={:.0f}ms: {:.3f} ms, {:.1%} of the grid is obstacle".format(
+                step, budget * 1000, elapsed, ground.mask.mean()))
+
+def legacy_preprocess(color, width, height, floating):
+    # Per frame preprocessing of main.py before the buffers were pooled
+    frame = np.asanyarray(color.get_data()).copy()
+    frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    frame_resized = cv2.resize(frame_rgb, (width, height))
+    input_data = np.expand_dims(frame_resized, axis=0)
+    if floating:
+        input_data = (np.float32(input_data) - 127.5) / 127.5
+
+    return frame, input_data
+
+def bench_pool(repeat):
+    # "copied" builds the input in the pooled buffers and copies it into a stand
+    # in for the interpreter's input tensor like set_tensor does, "in tensor"
+    # builds it straight in the tensor. "lut" normalizes through a lookup table
+    # instead of the in place arithmetic
+    frames = [ArrayFrame(image) for image in color_frames(10)]
+    lut = ((np.arange(256) - 127.5) / 127.5).astype(np.float32)
+
+    # The first frames are left out of the figures while the buffers settle,
+    # which has to leave some frames to measure
+    warmup = min(10, repeat // 2)
+    if warmup < 10:
+        print("[INFO] pool: only {} warm up frames out of {}, use --repeat 20 or more for steady state figures".format(
+            warmup, repeat))
+
+    print("[INFO] preprocessing of a 300x300 model input, steady state per frame")
+    print("    {:>8} {:>10} {:>14} {:>10} {:>10}".format("input", "path", "peak bytes", "mean ms", "p95 ms"))
+    for floating in [False, True]:
+        pool = FramePool(640, 480, 300, 300, floating)
+        tensor = np.empty((1, 300, 300, 3), dtype=np.float32 if floating else np.uint8)
+
+        def copied(frame):
+            frame, inputs = pool.prepare(frame)
+            np.copyto(tensor, inputs)
+
+        def in_tensor(frame):
+            pool.copy(frame)
+            pool.prepare_input(pool.color, out=tensor)
+
+        def through_lut(frame):
+            pool.copy(frame)
+            cv2.resize(pool.color, pool.input_size, dst=pool.resized)
+            cv2.cvtColor(pool.resized, cv2.COLOR_BGR2RGB, dst=pool.rgb[0])
+            cv2.LUT(pool.rgb[0], lut, dst=tensor[0])
+
+        paths = [("legacy", lambda frame: legacy_preprocess(frame, 300, 300, floating)),
+                 ("pooled", pool.prepare), ("copied", copied), ("in tensor", in_tensor)]
+        if floating:
+            paths.append(("lut", through_lut))
+        for name, prepare in paths:
+            meter = AllocationMeter(warmup=warmup)
+            for i in range(repeat):
+                with meter:
+                    prepare(frames[i % len(frames)])
+            report = meter.report()
+            meter.stop()
+            print("    {:>8} {:>10} {:>14} {:>10.3f} {:>10.3f}".format(
+                "float32" if floating else "uint8", name, report["max_bytes"], report["mean_ms"], report["p95_ms"]))
+
+def bench_detectors(repeat):
+    # Every detector runs on the same frames, so their latencies and outputs can
+    # be compared directly
+    if not DETECTORS:
+        print("[INFO] detectors: nothing to compare, pass --detector backend:model")
+        return
+    frames = color_frames(min(repeat, 50))
+
+    print("[INFO] detectors on {} frames, per frame".format(len(frames)))
+    print("    {:>8} {:>30} {:>14} {:>10} {:>10} {:>16} {:>10}".format(
+        "backend", "model", "preprocess ms", "infer ms", "post ms", "total mean/p95", "boxes>0.5"))
+    for backend, model in DETECTORS:
+        detector = create_detector(backend, model)
+        detector.detect(frames[0])
+
+        stages = np.zeros((repeat, 3))
+        found = 0
+        for i in range(repeat):
+            frame = frames[i % len(frames)]
+            start = time.perf_counter()
+            inputs = detector.preprocess(frame)
+            prepared = time.perf_counter()
+            outputs = detector.infer(inputs)
+            inferred = time.perf_counter()
+            detections = detector.postprocess(outputs)
+            stages[i] = [prepared - start, inferred - prepared, time.perf_counter() - inferred]
+            found += np.count_nonzero(detections.scores > 0.5)
+
+        stages *= 1000
+        total = stages.sum(axis=1)
+        print("    {:>8} {:>30} {:>14.2f} {:>10.2f} {:>10.2f} {:>7.1f}/{:<8.1f} {:>10.2f}".format(
+            backend, model[-30:], *stages.mean(axis=0), total.mean(), np.percentile(total, 95), found / repeat))
+
+def bench_interpreters(repeat):
+    # Sweep the interpreter pool size and threads per interpreter for every
+    # TFLite model given with --detector. Up to one frame per interpreter is kept
+    # in flight, and each frame is postprocessed while the next ones run
+    models = [model for backend, model in DETECTORS if backend == "tflite"]
+    if not models:
+        print("[INFO] interpreters: nothing to sweep, pass --detector tflite:model")
+        return
+    frames = color_frames(min(repeat, 50))
+    cores = os.cpu_count() or 4
+
+    for model in models:
+        print("[INFO] interpreter pool sweep for {}, {} frames".format(model, repeat))
+        print("    {:>4} {:>7} {:>8} {:>10} {:>8} {:>8} {:>8}".format(
+            "pool", "threads", "xnnpack", "frames/s", "p50 ms", "p95 ms", "p99 ms"))
+        for xnnpack in [True, False]:
+            for size in [1, 2, 4]:
+                for threads in [1, 2, 4]:
+                    if size * threads > cores:
+                        continue
+                    detector = TFLiteDetector(model, num_threads=threads, pool_size=size, xnnpack=xnnpack)
+                    detector.detect(frames[0])
+
+                    latencies = []
+                    in_flight = deque()
+
+                    def finish():
+                        submitted, future = in_flight.popleft()
+                        detector.postprocess(future.result())
+                        latencies.append(time.perf_counter() - submitted)
+
+                    start = time.perf_counter()
+                    for i in range(repeat):
+                        inputs = detector.preprocess(frames[i % len(frames)])
+                        in_flight.append((time.perf_counter(), detector.submit(inputs)))
+                        if len(in_flight) >= size:
+                            finish()
+                    while in_flight:
+                        finish()
+                    elapsed = time.perf_counter() - start
+                    detector.pool.close()
+
+                    latencies = np.asarray(latencies) * 1000
+                    print("    {:>4} {:>7} {:>8} {:>10.1f} {:>8.1f} {:>8.1f} {:>8.1f}".format(
+                        size, threads, "on" if xnnpack else "off", repeat / elapsed,
+                        *np.percentile(latencies, [50, 95, 99])))
+
+def bench_pipeline(repeat):
+    # The same stages run back to back and as a pipeline on identical frames.
+    # Without a --detector the inference is a 40 ms sleep, which like invoke()
+    # releases the GIL
+    colors, depths = color_frames(20), depth_frames(20)
+    detector = create_detector(*DETECTORS[0]) if DETECTORS else None
+    pool = FramePool(input_width=300, input_height=300)
+    obstacles = ObstacleMap()
+    boxes = random_boxes(5)
+    centres = (boxes[:, :2] + boxes[:, 2:]) // 2
+
+    def preprocess(i):
+        if detector is None:
+            return i, np.array(pool.prepare_input(colors[i % 20]))
+        inputs = detector.preprocess(colors[i % 20])
+        return i, detector.submit(inputs) if hasattr(detector, "submit") else inputs
+
+    def infer(job):
+        if detector is None:
+            time.sleep(0.04)
+            return job
+        if hasattr(detector, "submit"):
+            return job[0], job[1].result()
+        return job[0], detector.infer(job[1])
+
+    def postprocess(job):
+        if detector is not None:
+            detector.postprocess(job[1])
+        sample_distances(depths[job[0] % 20], centres)
+        return job
+
+    def decide(job):
+        obstacles.update(depths[job[0] % 20])
+        return job
+
+    stages = [("preprocess", preprocess), ("infer", infer), ("postprocess", postprocess), ("decide", decide)]
+    print("[INFO] serial loop and pipeline over {} frames".format(repeat))
+
+    start = time.perf_counter()
+    for i in range(repeat):
+        job = i
+        for _, stage in stages:
+            job = stage(job)
+    serial = repeat / (time.perf_counter() - start)
+    print("    serial: {:.1f} frames/s".format(serial))
+
+    # Frames arrive at 30 fps like the camera, the pipeline drops what it can't keep up with
+    frames = iter(range(repeat))
+    def source():
+        time.sleep(1 / 30)
+        return next(frames)
+
+    # Frames dropped before their postprocessing still have to hand back their
+    # interpreter
+    def release(job):
+        if detector is not None and isinstance(job, tuple) and hasattr(job[1], "add_done_callback"):
+            job[1].add_done_callback(lambda future: detector.release(future.result()))
+        elif detector is not None and isinstance(job, tuple):
+            detector.release(job[1])
+
+    pipeline = Pipeline(source, stages, release=release).start()
+    pipeline.join()
+    stats = pipeline.stats()
+    print("    pipeline: {:.1f} frames/s, {} of {} frames dropped".format(
+        stats["throughput"], repeat - pipeline.completed, repeat))
+    for name, _ in stages:
+        print("        {:>12}: {:.2f} ms mean, {:.2f} ms p95, queue max depth {}, {} dropped".format(
+            name, stats[name]["mean_ms"], stats[name]["p95_ms"],
+            stats[name]["queue"]["max_depth"], stats[name]["queue"]["dropped"]))
+
+def moving_objects(frames, count=3, fps=30, seed=0):
+    # Ground truth boxes of objects moving across the frame at constant
+    # velocity and bouncing off the edges, plus noisy detections of them
+    rng = np.random.RandomState(seed)
+    size = rng.uniform(0.1, 0.25, (count, 2))
+    position = rng.uniform(0.2, 0.8, (count, 2))
+    velocity = rng.uniform(-0.3, 0.3, (count, 2))
+
+    truth, detections = [], []
+    for _ in range(frames):
+        position += velocity / fps
+        bounce = (position < size/2) | (position > 1 - size/2)
+        velocity[bounce] *= -1
+        boxes = np.hstack([position - size/2, position + size/2])
+        truth.append(boxes)
+        detections.append(Detections(boxes + rng.normal(0, 0.005, boxes.shape), np.zeros(count, dtype=np.int32),
+                                     np.full(count, 0.9, dtype=np.float32)))
+
+    return truth, detections
+
+def box_error(boxes, truth):
+    # Mean corner error of every true box against the closest reported box, a
+    # missing object counts as a whole frame off
+    if len(boxes) == 0:
+        return 1.0
+    distance = np.abs(np.asarray(truth)[:, None] - np.asarray(boxes)[None]).mean(axis=2)
+    return float(distance.min(axis=1).mean())
+
+def bench_tracker(repeat):
+    # Detector runs and box error when the detector only runs every k-th frame,
+    # with the boxes moved by the tracker or left where they were last detected
+    fps = 30
+    frames = max(repeat, 90)
+    truth, detections = moving_objects(frames, fps=fps)
+
+    print("[INFO] tracked detections over {} synthetic frames".format(frames))
+    print("    {:>9} {:>10} {:>12} {:>12} {:>10}".format("interval", "detector", "tracked err", "stale err", "ms/frame"))
+    for interval, adaptive in [(1, False), (3, False), (5, False), (2, True)]:
+        scheduler = DetectionScheduler(interval=interval, adaptive=adaptive, threshold=0.5)
+        tracked, stale = [], []
+        last = []
+
+        start = time.perf_counter()
+        for i in range(frames):
+            if scheduler.due():
+                boxes = scheduler.update(detections[i], i / fps).boxes
+                last = detections[i].boxes
+            else:
+                boxes = scheduler.predict(i / fps).boxes
+            tracked.append(box_error(boxes, truth[i]))
+            stale.append(box_error(last, truth[i]))
+        elapsed = (time.perf_counter() - start) * 1000 / frames
+
+        print("    {:>9} {:>10} {:>12.4f} {:>12.4f} {:>10.3f}".format(
+            "adaptive" if adaptive else interval, "{}/{}".format(scheduler.detections, frames),
+            np.mean(tracked), np.mean(stale), elapsed))
+
+def synthetic_yolo(objects=6, classes=80, size=416, seed=0):
+    # YOLOv3 output layers like OpenCV returns them for a size x size input.
+    # Around every object a cluster of rows fires with jittered boxes, the rest
+    # only have a little objectness and zeroed class scores
+    rng = np.random.RandomState(seed)
+    outputs = []
+    for stride in [32, 16, 8]:
+        rows = (size // stride) ** 2 * 3
+        output = np.zeros((rows, 5 + classes), dtype=np.float32)
+        output[:, :2] = rng.uniform(0, 1, (rows, 2))
+        output[:, 2:4] = rng.uniform(0.02, 0.2, (rows, 2))
+        output[:, 4] = rng.uniform(0, 0.2, rows)
+        outputs.append(output)
+
+    # Every other object overlaps the previous one and is of another class, so
+    # that class aware NMS keeps both
+    centre = None
+    for i in range(objects):
+        output = outputs[rng.randint(3)]
+        rows = rng.choice(len(output), 8, replace=False)
+        if i % 2 == 0:
+            centre = rng.uniform(0.2, 0.8, 2)
+        else:
+            centre = centre + rng.uniform(-0.03, 0.03, 2)
+        box = rng.uniform(0.1, 0.4, 2)
+        output[rows, :2] = centre + rng.normal(0, 0.01, (8, 2))
+        output[rows, 2:4] = box * rng.uniform(0.9, 1.1, (8, 2))
+        output[rows, 4] = rng.uniform(0.6, 1.0, 8)
+
+        probabilities = rng.dirichlet(np.ones(classes), 8) * 0.2
+        probabilities[:, rng.randint(classes)] += 0.8
+        output[rows, 5:] = probabilities * output[rows, 4:5]
+
+    return outputs
+
+def legacy_yolo(layerOutputs, W, H, CONFIDENCE=0.5, THRESHOLD=0.3):
+    # The per row decoding of the yolov3 webcam scripts
+    boxes = []
+    confidences = []
+    classIDs = []
+
+    for output in layerOutputs:
+        for detection in output:
+            scores = detection[5:]
+            classID = np.argmax(scores)
+            confidence = scores[classID]
+
+            if confidence > CONFIDENCE:
+                box = detection[0:4]*np.array([W, H, W, H])
+                (centerX, centerY, width, height) = box.astype("int")
+                x = int(centerX - (width/2))
+                y = int(centerY - (height/2))
+
+                boxes.append([x, y, int(width), int(height)])
+                confidences.append(float(confidence))
+                classIDs.append(classID)
+
+    idxs = cv2.dnn.NMSBoxes(boxes, confidences, CONFIDENCE, THRESHOLD)
+    return [(boxes[i], classIDs[i], confidences[i]) for i in np.asarray(idxs, dtype=int).reshape(-1)]
+
+def bench_yolo(repeat, confidence=0.5, nms_threshold=0.3):
+    # The vectorized decoder against the per row loop of the webcam scripts. The
+    # loop rounds its boxes to whole pixels, so the boxes are compared to within
+    # a pixel. Class aware NMS is checked against running NMS class by class
+    W, H = 640, 480
+    outputs = synthetic_yolo()
+
+    def vectorized(classes_aware):
+        boxes, classes, scores = decode_yolo(outputs, confidence)
+        keep = nms(boxes, scores, confidence, nms_threshold, classes if classes_aware else None)
+        return postprocess(boxes[keep], classes[keep], scores[keep], confidence)
+
+    legacy = legacy_yolo(outputs, W, H, confidence, nms_threshold)
+    detections = vectorized(False)
+    pixels = detections.boxes * [H, W, H, W]
+    matched = len(legacy) == len(detections.boxes) and all(
+        np.abs(pixels[:, [1, 0]] - [x, y]).max(axis=1).min() <= 1.5 and
+        classID in detections.classes[np.abs(detections.scores - score) < 1e-6]
+        for (x, y, _, _), classID, score in legacy)
+
+    boxes, classes, scores = decode_yolo(outputs, confidence)
+    per_class = sorted(int(i) for c in np.unique(classes) for i in
+                       np.flatnonzero(classes == c)[nms(boxes[classes == c], scores[classes == c], confidence, nms_threshold)])
+    batched = sorted(int(i) for i in nms(boxes, scores, confidence, nms_threshold, classes))
+
+    loop = timeit(lambda: legacy_yolo(outputs, W, H, confidence, nms_threshold), repeat)
+    agnostic = timeit(lambda: vectorized(False), repeat)
+    aware = timeit(lambda: vectorized(True), repeat)
+
+    print("[INFO] YOLOv3 decoding of {} rows".format(sum(len(output) for output in outputs)))
+    print("    legacy loop:  {:.3f} ms, {} detections".format(loop, len(legacy)))
+    print("    vectorized:   {:.3f} ms ({:.1f}x), {} detections, matches the loop: {}".format(
+        agnostic, loop/agnostic, len(detections.boxes), matched))
+    print("    class aware:  {:.3f} ms, {} detections, matches per class NMS: {}".format(
+        aware, len(vectorized(True).boxes), per_class == batched))
+
+def tiled_detections(detector, frame, size, overlap=0.25):
+    # Reference detections for the ROI evaluation. The detector runs on tiles of
+    # its own input size all over the frame, which is as close to ground truth
+    # for small objects as the model gets, and the tiles are merged with NMS
+    H, W = frame.shape[:2]
+    w, h = size
+    mapping = CorridorROI(W, H)
+    def starts(length, size):
+        stride = int(size * (1 - overlap))
+        return sorted(set(list(range(0, max(length - size, 0), stride)) + [max(length - size, 0)]))
+
+    boxes, classes, scores = [], [], []
+    for y in starts(H, h):
+        for x in starts(W, w):
+            region = (x, y, min(x + w, W), min(y + h, H))
+            tile = mapping.to_frame(detector.detect(mapping.crop(frame, region)), region)
+            boxes.append(tile.boxes)
+            classes.append(tile.classes)
+            scores.append(tile.scores)
+
+    boxes, classes, scores = np.concatenate(boxes), np.concatenate(classes), np.concatenate(scores)
+    keep = nms(boxes, scores, detector.threshold, 0.5, classes)
+    return Detections(boxes[keep], classes[keep], scores[keep])
+
+def matched(reference, detections, iou_threshold=0.5):
+    # Which reference detections overlap a detection of the same class
+    overlap = iou_matrix(reference.boxes, detections.boxes)
+    overlap[reference.classes[:, None] != detections.classes[None, :]] = 0
+    return (overlap >= iou_threshold).any(axis=1) if overlap.size else np.zeros(len(reference.boxes), dtype=bool)
+
+def bench_roi(repeat, small_area=0.02, threshold=0.5):
+    # Detection on the whole frame against the depth guided crop on the same
+    # replayed frames. Recall is measured on the small objects, by area, of
+    # tiled full resolution reference detections, over the whole frame and
+    # within the corridor ahead
+    colors, depths = color_frames(min(repeat, 50)), depth_frames(min(repeat, 50))
+    H, W = colors[0].shape[:2]
+    roi = CorridorROI(W, H, refresh=10 ** 9)
+    roi.select(depths[0])
+    select = timeit(lambda: roi.select(depths[0]), repeat)
+    print("[INFO] region of interest selection: {:.3f} ms".format(select))
+
+    # How much of the frame the crops cover, without the full frame refreshes.
+    # In the hallway a person walks up the corridor and past its edge, with the
+    # walls alongside within the near field distance the whole time
+    hallway = [synthetic_hallway_depth((x, 140, x + 80, 480, distance), seed=i)
+               for i, (x, distance) in enumerate(zip(np.linspace(200, 520, 20).astype(int), np.linspace(3.0, 1.0, 20)))]
+    scenes = [("recording" if REPLAY is not None else "tilted plane", depths), ("hallway", hallway)]
+    for name, frames in scenes:
+        regions = [roi.select(depth) for depth in frames]
+        area = np.mean([(x2 - x1) * (y2 - y1) for x1, y1, x2, y2 in regions]) / (W * H)
+        cropped = np.mean([region != roi.full for region in regions])
+        print("    {:>12}: crops cover {:.0%} of the frame on average, {:.0%} of the frames are cropped".format(
+            name, area, cropped))
+
+    if not DETECTORS:
+        print("[INFO] roi: no detector to evaluate, pass --detector backend:model and a --replay recording")
+        return
+    if REPLAY is None:
+        print("[INFO] roi: the recall needs real frames, pass a --replay recording")
+
+    half = W * roi.corridor / 2
+    corridor = (W/2 - half, roi.rows[0], W/2 + half, roi.rows[1])
+    print("    {:>8} {:>30} {:>6} {:>10} {:>10} {:>14} {:>16}".format(
+        "backend", "model", "mode", "mean ms", "p95 ms", "small recall", "corridor recall"))
+    for backend, model in DETECTORS:
+        detector = create_detector(backend, model, threshold=threshold)
+        size = getattr(detector, "input_size", (300, 300))
+        references = [tiled_detections(detector, color, size) for color in colors]
+
+        for mode in ["full", "roi"]:
+            roi = CorridorROI(W, H, size) if mode == "roi" else None
+            latencies, hits = [], []
+            for i in range(repeat):
+                color, depth, reference = colors[i % len(colors)], depths[i % len(depths)], references[i % len(colors)]
+                start = time.perf_counter()
+                if roi is None:
+                    detections = detector.detect(color)
+                else:
+                    region = roi.select(depth)
+                    detections = roi.to_frame(detector.detect(roi.crop(color, region)), region)
+                latencies.append(time.perf_counter() - start)
+
+                # Small reference objects, and whether their centre is in the corridor
+                y1, x1, y2, x2 = reference.boxes.T
+                small = (y2 - y1) * (x2 - x1) < small_area
+                cx, cy = (x1 + x2) / 2 * W, (y1 + y2) / 2 * H
+                inside = (cx >= corridor[0]) & (cx < corridor[2]) & (cy >= corridor[1]) & (cy < corridor[3])
+                found = matched(reference, detections)
+                hits.append((found[small].sum(), small.sum(), found[small & inside].sum(), (small & inside).sum()))
+
+            latencies = np.asarray(latencies) * 1000
+            hits = np.sum(hits, axis=0)
+            print("    {:>8} {:>30} {:>6} {:>10.2f} {:>10.2f} {:>14} {:>16}".format(
+                backend, model[-30:], mode, latencies.mean(), np.percentile(latencies, 95),
+                "{:.2f} ({})".format(hits[0] / hits[1], hits[1]) if hits[1] else "-",
+                "{:.2f} ({})".format(hits[2] / hits[3], hits[3]) if hits[3] else "-"))
+
+def approaching_object(frames, width=640, height=480, low=False, seed=0):
+    # Depth frames of a far wall with an object that walks up to 0.9 m and away
+    # again, and its box in normalized (y1, x1, y2, x2) coordinates. A low object
+    # sits at the bottom of the view, with its box midpoint in the bottom quarter
+    rng = np.random.RandomState(seed)
+    distances = 4.0 - 3.1 * np.sin(np.linspace(0, np.pi, frames)) ** 2
+    depths, boxes = [], []
+    for distance in distances:
+        depth = np.full((height, width), 5000, dtype=np.float32) + rng.normal(0, 15, (height, width))
+        half = int(60 / distance)
+        top, bottom = (height - 2*half, height) if low else (height//2 - 2*half, height//2 + 2*half)
+        left, right = (width//2 - 2*half, width//2 + 2*half) if low else (width//2 - half, width//2 + half)
+        depth[top:bottom, left:right] = distance * 1000
+        depths.append(depth.astype(np.uint16))
+        boxes.append(np.array([[top / height, left / width, bottom / height, right / width]], dtype=np.float32))
+
+    return depths, boxes
+
+def decision(depth, boxes, min_distance=130):
+    # The part of the navigation decision that depends on the detections: any
+    # detection closer than min_distance (cm) makes the user avoid it
+    if len(boxes) == 0:
+        return "Forward"
+    H, W = depth.shape[:2]
+    centres = np.stack([(boxes[:, 1] + boxes[:, 3]) / 2 * W, (boxes[:, 0] + boxes[:, 2]) / 2 * H], axis=1)
+    return "Avoid" if (sample_distances(depth, centres) < min_distance).any() else "Forward"
+
+def bench_gate(repeat):
+    # Commands and CPU time with the detector on every frame and behind the
+    # depth gate. With a --detector and --replay the recorded frames are used,
+    # otherwise an object walks up to the camera and a stand in detector that
+    # returns its box burns a few milliseconds of CPU per frame
+    if DETECTORS and REPLAY is not None:
+        recording = Recording(REPLAY)
+        frames = [(np.array(recording[i][0]), np.array(recording[i][1])) for i in range(min(repeat, len(recording)))]
+        detector = create_detector(*DETECTORS[0])
+        def detect(scene, i):
+            detections = detector.detect(frames[i][0])
+            return detections.boxes[detections.scores > 0.5]
+        scenes = {"recording": ([depth for _, depth in frames], None)}
+    else:
+        # The object walks up in the middle of the view, and as a low obstacle at
+        # the bottom of it
+        scenes = {"centred": approaching_object(max(repeat, 60)), "low": approaching_object(max(repeat, 60), low=True)}
+        weights = np.random.RandomState(0).random_sample((300, 300)).astype(np.float32)
+        def detect(scene, i):
+            for _ in range(20):
+                np.dot(weights, weights)
+            return scenes[scene][1][i]
+
+    for scene, (depths, _) in scenes.items():
+        print("[INFO] depth gate over {} frames, {}".format(len(depths), scene))
+        results = {}
+        for name, gate in [("always", None), ("gated", DepthGate())]:
+            commands = []
+            start, cpu = time.perf_counter(), time.process_time()
+            for i, depth in enumerate(depths):
+                run = gate is None or gate.check(depth)
+                boxes = detect(scene, i) if run else np.zeros((0, 4), dtype=np.float32)
+                commands.append(decision(depth, boxes))
+            results[name] = commands
+            print("    {:>7}: {:.1f} ms wall, {:.1f} ms CPU per frame, {}".format(
+                name, (time.perf_counter() - start) * 1000 / len(depths), (time.process_time() - cpu) * 1000 / len(depths),
+                gate.stats() if gate is not None else "detector on every frame"))
+
+        same = np.mean([a == b for a, b in zip(results["always"], results["gated"])])
+        print("    commands unchanged on {:.1%} of the frames".format(same))
+
+def standing_still(frames, width=640, height=480, seed=0):
+    # Color frames of a user who stands still for a while, with sensor noise,
+    # then turns, then stands still again
+    rng = np.random.RandomState(seed)
+    scene = cv2.resize(rng.randint(0, 256, (6, 16, 3)).astype(np.uint8), (width * 2, height))
+    pan = np.concatenate([np.zeros(frames // 3), np.linspace(0, width, frames // 3), np.full(frames - 2 * (frames // 3), width)])
+    return [np.clip(scene[:, int(x):int(x) + width] + rng.normal(0, 3, (height, width, 3)), 0, 255).astype(np.uint8)
+            for x in pan]
+
+def bench_scene(repeat):
+    # Cache hit rate and CPU time when the results of the last frame are reused
+    # while the scene hasn't changed, on consecutive recorded frames or a
+    # synthetic stand still, turn, stand still sequence. Without a --detector a
+    # stand in burns a few milliseconds of CPU per frame
+    if REPLAY is not None:
+        recording = Recording(REPLAY)
+        frames = [np.array(recording[i][0]) for i in range(min(repeat, len(recording)))]
+    else:
+        frames = standing_still(max(repeat, 90))
+
+    if DETECTORS:
+        detector = create_detector(*DETECTORS[0])
+        detect = detector.detect
+        detect(frames[0])
+    else:
+        weights = np.random.RandomState(0).random_sample((300, 300)).astype(np.float32)
+        def detect(frame):
+            for _ in range(20):
+                np.dot(weights, weights)
+
+    print("[INFO] scene change gate over {} frames".format(len(frames)))
+    for max_age in [0, 5, 10, 30]:
+        scene = SceneGate(max_age=max_age)
+        scene.changed(frames[0])
+        cost = timeit(lambda: scene.difference(frames[0]), repeat)
+
+        scene = SceneGate(max_age=max_age)
+        cpu = time.process_time()
+        for frame in frames:
+            if max_age == 0 or scene.changed(frame):
+                detect(frame)
+        cpu = (time.process_time() - cpu) * 1000 / len(frames)
+
+        if max_age == 0:
+            baseline = cpu
+            print("    always run: {:.2f} ms CPU per frame, thumbnail difference {:.3f} ms".format(cpu, cost))
+        else:
+            stats = scene.stats()
+            print("    max age {:>2}: {:.2f} ms CPU per frame ({:.0%} less), hit rate {:.0%}, {} expired".format(
+                max_age, cpu, 1 - cpu / baseline, stats["hit_rate"], stats["expired"]))
+
+def bench_governor(repeat, target_ms=150):
+    # Simulated run of the governor against a board that is slower at better
+    # quality tiers and heats up while it works hard. The decision latency of
+    # each tier is drawn around a fixed mean and a fake sysfs file holds the
+    # temperature. The tiers share a stand in detector, so nothing is timed
+    class Idle:
+        def detect(self, image):
+            return None
+    import detector as backends
+    backends.BACKENDS["idle"] = lambda model, **kwargs: Idle()
+
+    tiers = [Tier("full", "a", None, 1), Tier("stride2", "a", None, 2), Tier("stride4", "a", None, 4)]
+    means = {"full": 0.17, "stride2": 0.12, "stride4": 0.08}
+    frames = max(repeat, 1500)
+    print("[INFO] governor over {} simulated frames, {} ms target".format(frames, target_ms))
+    print("    {:>13} {:>9} {:>14} {:>14} {:>16}".format("hysteresis", "switches", "p90 ms", "over target", "frames per tier"))
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "temp")
+        for name, options in [("none", {"headroom": 1.0, "hold": 0, "cool": 75.0}), ("default", {})]:
+            rng = np.random.RandomState(0)
+            temperature = 60.0
+            with open(path, "w") as f:
+                f.write(str(int(temperature * 1000)))
+            governor = Governor(tiers, "idle", target_ms=target_ms, temperature_path=path,
+                                temperature_every=10, **options)
+
+            latencies = []
+            for i in range(frames):
+                # The board heats up at the best tier and cools down at the others,
+                # and a busy stretch in the middle makes every tier slower
+                busy = 1.3 if frames // 3 <= i < frames // 2 else 1.0
+                latency = rng.normal(means[governor.tier.name], 0.015) * busy
+                temperature += 0.02 if governor.level == 0 else -0.015
+                if i % 10 == 0:
+                    with open(path, "w") as f:
+                        f.write(str(int(temperature * 1000)))
+                governor.observe("decision", latency)
+                governor.update()
+                latencies.append(latency)
+
+            latencies = np.asarray(latencies) * 1000
+            stats = governor.stats()
+            print("    {:>13} {:>9} {:>14.1f} {:>13.1%} {:>16}".format(
+                name, stats["switches"], np.percentile(latencies, 90), np.mean(latencies > target_ms),
+                "/".join(str(count) for count in stats["frames_in"].values())))
+
+BENCHMARKS = {
+    "batch": bench_batch,
+    "detectors": bench_detectors,
+    "filters": bench_filters,
+    "gate": bench_gate,
+    "governor": bench_governor,
+    "ground": bench_ground,
+    "history": bench_history,
+    "integral": bench_integral,
+    "interpreters": bench_interpreters,
+    "obstacles": bench_obstacles,
+    "pipeline": bench_pipeline,
+    "pool": bench_pool,
+    "profile": bench_profile,
+    "registration": bench_registration,
+    "roi": bench_roi,
+    "sampling": bench_sampling,
+    "scene": bench_scene,
+    "tracker": bench_tracker,
+    "yolo": bench_yolo,
+}
+
+if __name__ == "__main__":
+    # Construct and parse the command line arguments
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--bench", choices=sorted(BENCHMARKS) + ["all"], default="all",
+                    help="Name of the benchmark to run")
+    ap.add_argument("--repeat", type=int, default=200,
+                    help="Number of iterations to average over")
+    ap.add_argument("--replay", default=None,
+                    help="Recording made with replay.py to take the frames from")
+    ap.add_argument("--detector", action="append", default=[],
+                    help="Detector to compare as backend:model, can be given more than once")
+    args = vars(ap.parse_args())
+    REPLAY = args["replay"]
+    DETECTORS = [tuple(spec.split(":", 1)) for spec in args["detector"]]
+
+    names = sorted(BENCHMARKS) if args["bench"] == "all" else [args["bench"]]
+    for name in names:
+        BENCHMARKS[name](args["repeat"])
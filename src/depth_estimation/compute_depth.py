@@ -2,16 +2,24 @@
     Author: Jordan Madden
     Usage: python compute_depth.py --device="rpi"
            python compute_depth.py --device="win" 
+           python compute_depth.py --device="rpi" --headless
 '''
 from imutils.video import FPS
 import numpy as np
 import argparse
-import cv2
+import sys
+import os
+
+# The debug view lives in the src folder, one level up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from visualize import Visualizer
 
 # Construct and parse the command arguments
 ap = argparse.ArgumentParser()
 ap.add_argument("-d", "--device", required=True,
                  help="Will the code be run on raspberry pi or windows machine?")
+ap.add_argument("--headless", action="store_true",
+                 help="Run without the debug window")
 args = vars(ap.parse_args())
 
 if args["device"] == "rpi":
@@ -57,6 +65,7 @@ config.enable_stream(rs.stream.color, 640, 480, rs.format.bgr8, 30)
 
 # Start streaming
 pipeline.start(config)
+viz = Visualizer("RealSense", enabled=not args["headless"]).start()
 fps = FPS().start()
 print("[INFO] starting video stream...")
 
@@ -73,34 +82,20 @@ try:
         (H, W) = depth_frame.get_height(), depth_frame.get_width()
         H, W = int(SCALE_H*H), int(SCALE_W*W)
 
-        # Convert images to numpy arrays
-        depth_image = np.asanyarray(depth_frame.get_data())
-        color_image = np.asanyarray(color_frame.get_data())
-
-        # Apply colormap on depth image (image must be converted to 8-bit per pixel first)
-        # and extract the image dimensions
-        depth_colormap = cv2.applyColorMap(cv2.convertScaleAbs(depth_image, alpha=0.03), cv2.COLORMAP_JET)
-
         # Find the distance of an arbitraty point in the video frame. The distance 
         dist = filter_distance(depth_frame, W//2, H//2)
         #dist = depth_frame.get_distance(240, 320)
         print("Distance: {}".format(dist))
         
-        # Resize the images to known dimensions
-        color_image = cv2.resize(color_image, (W, H))
-        depth_colormap = cv2.resize(depth_colormap, (W, H))
-
-        # Stack both images horizontally and display them
-        images = np.hstack((color_image, depth_colormap))
-        cv2.namedWindow('RealSense')
-        cv2.imshow('RealSense', images)
+        # Show both images side by side, with the depth colormapped on the render
+        # thread
+        viz.submit(np.asanyarray(color_frame.get_data()), depth_frame)
 
         # Update the FPS counter
         fps.update()
 
-        # Break from loop if the "Q" key is pressed
-        key = cv2.waitKey(1) & 0xFF
-        if key == ord("q"):
+        # Break from loop if the "Q" key is pressed in the window
+        if viz.quit:
             print("[INFO] ending video stream...")  
             fps.stop()
             break
@@ -109,5 +104,6 @@ finally:
     print("[INFO] elasped time: {:.2f}".format(fps.elapsed()))
     print("[INFO] approx. FPS: {:.2f}".format(fps.fps()))
 
-    # Stop streaming
+    # Stop the window and streaming
+    viz.stop()
     pipeline.stop()
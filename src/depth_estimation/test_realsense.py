@@ -3,6 +3,12 @@
 '''
 
 import pyrealsense2 as rs
+import sys
+import os
+
+# The obstacle map lives in the src folder, one level up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from obstacle_map import coverage
 
 try:
     # Create a context object. This object owns the handles to all connected realsense devices
@@ -17,21 +23,10 @@ try:
         if not depth: continue
 
         # Print a simple text-based representation of the image, by breaking it into 10x20 pixel regions and approximating the coverage of pixels within one meter
-        coverage = [0]*64
-        for y in range(480):
-            for x in range(640):
-                dist = depth.get_distance(x, y)
-                if 0 < dist and dist < 1:
-                    coverage[x//10] += 1
-            
-            if y%20 is 19:
-                line = ""
-                for c in coverage:
-                    line += " .:nhBXWW"[c//25]
-                coverage = [0]*64
-                print(line)
+        for row in coverage(depth, max_distance=1.0, cell=(20, 10)):
+            print("".join(" .:nhBXWW"[c//25] for c in row))
     exit(0)
-    
+
 except Exception as e:
     print(e)
-    pass
\ No newline at end of file
+    pass
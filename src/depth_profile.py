@@ -1,48 +1,67 @@
 '''
     Author: Jordan Madden
     Usage: python depth_profile.py
+           python depth_profile.py --replay recordings/hallway
 '''
 
-from realsense import RealSense, filter_distance
-import matplotlib.pyplot as plt
-from imutils.video import FPS
+from realsense import RealSense, depth_array, robust_percentile
+from replay import ReplaySource
 import numpy as np
+import argparse
 import time
 import cv2
 
-def get_depth_profile(depth_frame, profile_width, X, Y):
+def get_depth_profile(depth_frame, profile_width, X, Y, thickness=1):
+    # Get the raw depth image and its dimensions
+    image, scale = depth_array(depth_frame)
+    H, W = image.shape[:2]
+
     # Ensure the coordiantes fall within the frame
-    if (X < 0):
-        X = 0
-    if (X >= 640):
-        X = 639
-    if (Y < 0):
-        Y = 0
-    if (Y >= 480):
-        Y = 479
+    X = min(max(X, 0), W-1)
+    Y = min(max(Y, 0), H-1)
     
     # Ensure the profile width falls within the frame
-    if (profile_width >= 640-X):
-        profile_width = 639-X
-    else:
-        profile_width = profile_width
+    if (profile_width >= W-X):
+        profile_width = W-1-X
     
-    # Array to store the depth profile
-    depth_profile = []
+    # Slice the band of rows below Y and take the median of the valid depth
+    # values in each of its columns
+    band = image[Y:Y+thickness, X:X+profile_width]
+    raw, counts = robust_percentile(band.T, 50)
 
-    # Get distance of each pixel along the profile width and add it to 
-    # the depth profile list
-    for i in range(profile_width):
-        depth_profile.append(filter_distance(depth_frame, X+i, Y))
+    # Columns that are entirely holes take the value of the closest valid column
+    # to their left, or the first valid column if there is none
+    valid = counts > 0
+    if not valid.any():
+        return np.zeros(profile_width, dtype=np.int32)
+    idx = np.where(valid, np.arange(profile_width), 0)
+    np.maximum.accumulate(idx, out=idx)
+    idx[:np.argmax(valid)] = np.argmax(valid)
 
-    return np.array(depth_profile)
+    # Return the depth profile in centimetres
+    return (raw[idx] * (scale * 100)).astype(np.int32)
 
 if __name__ == "__main__":
-    video = RealSense(width=640, height=480).start()
+    import matplotlib.pyplot as plt
+    from imutils.video import FPS
+
+    # Construct and parse the command line arguments
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--replay', help='Path to a recording to use instead of the camera', default=None)
+    args = vars(ap.parse_args())
+
+    if args["replay"]:
+        video = ReplaySource(args["replay"]).start()
+    else:
+        video = RealSense(width=640, height=480).start()
     fps = FPS().start()
     
     while True:
-        color_frame, depth_frame = video.read()
+        frameset = video.read()
+        if frameset is None:
+            fps.stop()
+            break
+        color_frame, depth_frame = frameset
         
         # Convert images to numpy arrays and get the frame dimensions
         depth_image = np.asanyarray(depth_frame.get_data())
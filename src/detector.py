@@ -0,0 +1,338 @@
+'''
+    Description: Object detectors behind one interface. Every backend takes a BGR
+                 frame and returns the detections as numpy arrays of normalized
+                 (y1, x1, y2, x2) boxes, class ids and scores sorted by score, so
+                 the navigation and the benchmarks don't depend on the model.
+
+                 Backends: "tflite" for the SSD models on the Pi, "tf2" for the
+                 TensorFlow object detection API checkpoints and "dnn" for the
+                 Darknet YOLO models through OpenCV
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+from threading import Event
+from frame_pool import FramePool
+import numpy as np
+import os
+import cv2
+
+# The Pi only has the TFLite runtime, desktop machines can use the interpreter
+# that ships with TensorFlow
+try:
+    import tflite_runtime.interpreter as tflite
+except ImportError:
+    try:
+        from tensorflow import lite as tflite
+    except ImportError:
+        tflite = None
+
+# Result of a detector. It unpacks like the (boxes, classes, scores) tuple that
+# detect() has always returned
+Detections = namedtuple("Detections", ["boxes", "classes", "scores"])
+
+def postprocess(boxes, classes, scores, threshold=0.0, max_detections=None):
+    # Keep the detections scoring above the threshold, best first, as float32
+    # boxes clipped to the frame, int32 classes and float32 scores
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    classes = np.asarray(classes).reshape(-1)
+    scores = np.asarray(scores, dtype=np.float32).reshape(-1)
+
+    keep = np.flatnonzero(scores > threshold)
+    keep = keep[np.argsort(-scores[keep], kind="stable")][:max_detections]
+
+    return Detections(np.clip(boxes[keep], 0, 1), classes[keep].astype(np.int32), scores[keep])
+
+def decode_yolo(outputs, threshold=0.5):
+    # Turn the rows of the YOLO output layers, (cx, cy, w, h, objectness, class
+    # scores...) in normalized coordinates, into the boxes, classes and scores of
+    # the rows whose best class score is above the threshold. OpenCV's region
+    # layer already multiplies the class scores by the objectness, so no class
+    # can score above it and the argmax only has to run on the rows that pass
+    rows = np.concatenate([np.asarray(output).reshape(-1, output.shape[-1]) for output in outputs])
+    rows = rows[rows[:, 4] > threshold]
+    classes = np.argmax(rows[:, 5:], axis=1)
+    scores = rows[np.arange(len(rows)), 5 + classes]
+
+    keep = scores > threshold
+    centre, size = rows[keep, 0:2], rows[keep, 2:4]
+    corners = np.hstack([centre - size/2, centre + size/2])
+
+    # (x1, y1, x2, y2) to (y1, x1, y2, x2)
+    return corners[:, [1, 0, 3, 2]], classes[keep].astype(np.int32), scores[keep]
+
+def nms(boxes, scores, threshold, iou_threshold, classes=None):
+    # Indices of the boxes that survive non-maximum suppression, best first. With
+    # classes, boxes only suppress boxes of the same class. All classes still go
+    # through one NMSBoxes call, each class moved to its own region of the plane
+    # so that boxes of different classes can never overlap
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=np.intp)
+
+    boxes = np.asarray(boxes, dtype=np.float32)
+    if classes is not None:
+        span = float(boxes.max() - boxes.min()) + 1
+        boxes = boxes + (np.asarray(classes, dtype=np.float32) * span)[:, None]
+
+    # NMSBoxes takes (x, y, w, h) rectangles
+    rects = np.hstack([boxes[:, [1, 0]], boxes[:, [3, 2]] - boxes[:, [1, 0]]])
+    idxs = cv2.dnn.NMSBoxes(rects.tolist(), np.asarray(scores).tolist(), threshold, iou_threshold)
+    return np.asarray(idxs, dtype=np.intp).reshape(-1)
+
+def dequantize(tensor, detail):
+    # Float values of a quantized TFLite tensor. Float tensors come back as they are
+    scale, zero_point = detail["quantization"]
+    if tensor.dtype == np.float32 or not scale:
+        return tensor
+    return (tensor.astype(np.float32) - zero_point) * scale
+
+def make_interpreter(model_path, num_threads=None, xnnpack=True):
+    # TFLite interpreter with its tensors allocated. XNNPACK is applied by default
+    # from TFLite 2.3, switching it off needs the op resolver option of 2.5, which
+    # tflite_runtime has at module level and tensorflow under tf.lite.experimental.
+    # Older runtimes don't apply it at all, so there is nothing to switch off.
+    # num_threads is only passed when it is set, the oldest runtimes lack it
+    kwargs = {}
+    if num_threads is not None:
+        kwargs["num_threads"] = num_threads
+    if not xnnpack:
+        resolvers = getattr(tflite, "OpResolverType", None) or getattr(getattr(tflite, "experimental", None), "OpResolverType", None)
+        if resolvers is not None:
+            kwargs["experimental_op_resolver_type"] = resolvers.BUILTIN_WITHOUT_DEFAULT_DELEGATES
+
+    interpreter = tflite.Interpreter(model_path=model_path, **kwargs)
+    interpreter.allocate_tensors()
+    return interpreter
+
+class OutputViews(list):
+    # Views of the output tensors of one interpreter, in output_details order.
+    # The interpreter stays reserved until they are released, since invoking it
+    # again would overwrite them
+    def __init__(self, slot, views):
+        super().__init__(views)
+        self.slot = slot
+
+class InterpreterPool:
+    def __init__(self, model_path, size=2, num_threads=1, xnnpack=True):
+        # Copies of the same model, each invoked on its own worker thread. invoke()
+        # releases the GIL, so while one interpreter runs the next frame the
+        # caller can postprocess the previous one
+        if tflite is None:
+            raise ImportError("the interpreter pool needs tflite_runtime or tensorflow")
+
+        self.interpreters = [make_interpreter(model_path, num_threads, xnnpack) for _ in range(size)]
+        self.workers = [ThreadPoolExecutor(max_workers=1) for _ in range(size)]
+        self.free = [Event() for _ in range(size)]
+        for free in self.free:
+            free.set()
+        self.next = 0
+
+        # Every interpreter has the same input and outputs
+        self.input_details = self.interpreters[0].get_input_details()
+        self.output_details = self.interpreters[0].get_output_details()
+        self.input_index = self.input_details[0]["index"]
+        self.outputs = [detail["index"] for detail in self.output_details]
+
+    def acquire(self):
+        # Reserve the next interpreter in turn, once the outputs of its last
+        # frame have been released, and return its slot
+        i = self.next
+        self.next = (i + 1) % len(self.interpreters)
+        self.free[i].wait()
+        self.free[i].clear()
+        return i
+
+    def input(self, i):
+        # View of the input tensor of a reserved interpreter. TFLite refuses to
+        # invoke while any view of its buffers is alive, so it has to be dropped
+        # before run()
+        return self.interpreters[i].tensor(self.input_index)()
+
+    def _run(self, i):
+        # The outputs are read as views of the interpreter's buffers, not copied
+        interpreter = self.interpreters[i]
+        interpreter.invoke()
+        return OutputViews(i, [interpreter.tensor(index)()[0] for index in self.outputs])
+
+    def run(self, i):
+        # Invoke a reserved interpreter whose input is filled in and return a
+        # future of its output views
+        return self.workers[i].submit(self._run, i)
+
+    def submit(self, inputs):
+        # Copy the input into the next interpreter in turn and run it. The caller
+        # can reuse its buffer straight away
+        i = self.acquire()
+        self.interpreters[i].set_tensor(self.input_index, inputs)
+        return self.run(i)
+
+    def release(self, outputs):
+        # Drop the output views and hand the interpreter back. Releasing twice is
+        # harmless, so dropped frames can always be released
+        if outputs.slot is None:
+            return
+        slot, outputs.slot = outputs.slot, None
+        outputs.clear()
+        self.free[slot].set()
+
+    def __len__(self):
+        return len(self.interpreters)
+
+    def close(self):
+        for worker in self.workers:
+            worker.shutdown()
+
+class Detector:
+    # Subclasses implement preprocess, infer and postprocess. They are kept apart
+    # so that callers can time them separately or run them on different threads
+    threshold = 0.0
+
+    def preprocess(self, image):
+        # Model input for a BGR image
+        raise NotImplementedError
+
+    def infer(self, inputs):
+        # Raw model outputs for a model input
+        raise NotImplementedError
+
+    def postprocess(self, outputs):
+        # Detections from the raw model outputs
+        raise NotImplementedError
+
+    def release(self, outputs):
+        # Give back what the outputs of a frame hold on to, for frames that are
+        # dropped before they are postprocessed. Most backends hold on to nothing
+        pass
+
+    def detect(self, image):
+        return self.postprocess(self.infer(self.preprocess(image)))
+
+class TFLiteDetector(Detector):
+    def __init__(self, model_path, threshold=0.0, num_threads=None, pool_size=1, xnnpack=True):
+        if tflite is None:
+            raise ImportError("the tflite backend needs tflite_runtime or tensorflow")
+
+        # With a pool of interpreters, submit() lets the caller keep several frames
+        # in flight. infer() always waits for its frame
+        self.threshold = threshold
+        self.pool = InterpreterPool(model_path, pool_size, num_threads, xnnpack)
+        self.input_details = self.pool.input_details
+        self.output_details = self.pool.output_details
+
+        # Models exported with TF2 order their outputs (scores, boxes, count,
+        # classes) instead of the TF1 (boxes, classes, scores, count)
+        if "StatefulPartitionedCall" in self.output_details[0]["name"]:
+            self.order = (1, 3, 0)
+        else:
+            self.order = (0, 1, 2)
+
+        # The model input is built straight in the input tensor of the interpreter
+        # that will run it, through the pooled intermediate buffers
+        _, height, width, _ = self.input_details[0]["shape"]
+        self.input_size = (width, height)
+        self.floating = self.input_details[0]["dtype"] == np.float32
+        self.buffers = FramePool(input_width=width, input_height=height, floating=self.floating)
+
+    def preprocess(self, image):
+        # Reserve the next interpreter, fill in its input tensor and return its
+        # slot, which stands in for the model input
+        slot = self.pool.acquire()
+        view = self.pool.input(slot)
+        self.buffers.prepare_input(image, out=view)
+        del view
+        return slot
+
+    def submit(self, inputs):
+        # Start the inference and return a future of its raw outputs
+        return self.pool.run(inputs)
+
+    def infer(self, inputs):
+        return self.submit(inputs).result()
+
+    def postprocess(self, outputs):
+        # Fully quantized models can have uint8 outputs. The detections are copies,
+        # so the views are released as soon as they are built
+        boxes, classes, scores = [dequantize(outputs[i], self.output_details[i]) for i in self.order]
+        detections = postprocess(boxes, classes, scores, self.threshold)
+        del boxes, classes, scores
+        self.pool.release(outputs)
+        return detections
+
+    def release(self, outputs):
+        self.pool.release(outputs)
+
+class TF2Detector(Detector):
+    def __init__(self, model_dir, threshold=0.0):
+        # TensorFlow takes several seconds to import, so it is only imported
+        # when this backend is used. The model folder holds the pipeline.config
+        # and the checkpoint folder of a model from the TF2 detection zoo
+        os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+        import tensorflow as tf
+        from object_detection.builders import model_builder
+        from object_detection.utils import config_util
+        tf.get_logger().setLevel('ERROR')
+
+        self.threshold = threshold
+        self.tf = tf
+        configs = config_util.get_configs_from_pipeline_file(os.path.join(model_dir, 'pipeline.config'))
+        self.model = model_builder.build(model_config=configs['model'], is_training=False)
+        ckpt = tf.compat.v2.train.Checkpoint(model=self.model)
+        ckpt.restore(os.path.join(model_dir, 'checkpoint', 'ckpt-0')).expect_partial()
+
+        @tf.function
+        def detect(image):
+            image, shapes = self.model.preprocess(image)
+            prediction_dict = self.model.predict(image, shapes)
+            return self.model.postprocess(prediction_dict, shapes)
+        self.graph = detect
+
+    def preprocess(self, image):
+        # The models resize internally and expect RGB
+        rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        return self.tf.convert_to_tensor(rgb[None], dtype=self.tf.float32)
+
+    def infer(self, inputs):
+        return self.graph(inputs)
+
+    def postprocess(self, outputs):
+        return postprocess(outputs['detection_boxes'][0].numpy(),
+                           outputs['detection_classes'][0].numpy(),
+                           outputs['detection_scores'][0].numpy(), self.threshold)
+
+class DNNDetector(Detector):
+    def __init__(self, model_dir, threshold=0.5, nms_threshold=0.3, input_size=(416, 416), class_aware=True):
+        # Darknet YOLO model run through OpenCV. The model folder holds the
+        # yolov3.cfg and yolov3.weights files. With class_aware NMS a person
+        # standing in front of a chair doesn't suppress the chair
+        self.threshold = threshold
+        self.nms_threshold = nms_threshold
+        self.class_aware = class_aware
+        self.input_size = input_size
+        self.net = cv2.dnn.readNetFromDarknet(os.path.join(model_dir, "yolov3.cfg"),
+                                              os.path.join(model_dir, "yolov3.weights"))
+        self.layers = self.net.getUnconnectedOutLayersNames()
+
+    def preprocess(self, image):
+        return cv2.dnn.blobFromImage(image, 1/255.0, self.input_size, swapRB=True, crop=False)
+
+    def infer(self, inputs):
+        self.net.setInput(inputs)
+        return self.net.forward(self.layers)
+
+    def postprocess(self, outputs):
+        boxes, classes, scores = decode_yolo(outputs, self.threshold)
+        keep = nms(boxes, scores, self.threshold, self.nms_threshold, classes if self.class_aware else None)
+        return postprocess(boxes[keep], classes[keep], scores[keep], self.threshold)
+
+BACKENDS = {
+    "dnn": DNNDetector,
+    "tf2": TF2Detector,
+    "tflite": TFLiteDetector,
+}
+
+def create_detector(backend, model, **kwargs):
+    # Build the detector of the named backend for a model file or folder
+    if backend not in BACKENDS:
+        raise ValueError("unknown detector backend {!r}, expected one of {}".format(backend, sorted(BACKENDS)))
+
+    return BACKENDS[backend](model, **kwargs)
@@ -0,0 +1,110 @@
+'''
+    Description: Preallocated buffers for the capture to inference path and the
+                 instrumentation used to check that the hot loop stops allocating
+                 once it reaches a steady state
+'''
+
+import numpy as np
+import tracemalloc
+import time
+import cv2
+
+class FramePool:
+    def __init__(self, width=None, height=None, input_width=None, input_height=None,
+                 floating=False, input_mean=127.5, input_std=127.5):
+        # Drawable copy of the color frame, the resized BGR frame, the uint8 model
+        # input in RGB and, for floating models, the normalized model input. The
+        # color and model input buffers are only built if their sizes are given
+        self.color = np.empty((height, width, 3), dtype=np.uint8) if width else None
+        self.resized = self.rgb = self.input = None
+        if input_width:
+            self.resized = np.empty((input_height, input_width, 3), dtype=np.uint8)
+            self.rgb = np.empty((1, input_height, input_width, 3), dtype=np.uint8)
+            self.input = np.empty(self.rgb.shape, dtype=np.float32) if floating else None
+        self.input_size = (input_width, input_height)
+        self.input_mean = input_mean
+        self.input_scale = 1.0 / input_std
+
+        # Depth frame whose buffer is currently being viewed
+        self.pinned = None
+
+    def pin(self, depth_frame):
+        # Return a view of the depth frame's z16 buffer. Holding on to the frame
+        # keeps librealsense from recycling the buffer until the next frame is pinned
+        self.pinned = depth_frame
+        return np.asanyarray(depth_frame.get_data())
+
+    def copy(self, color_frame):
+        # Copy the color frame into the drawable buffer
+        np.copyto(self.color, np.asanyarray(color_frame.get_data()))
+        return self.color
+
+    def prepare_input(self, image, out=None):
+        # Build the [1xHxWx3] model input from a BGR image in place, or straight in
+        # out, such as a view of the interpreter's input tensor. Resizing before the
+        # channel swap converts far fewer pixels and gives the same result
+        cv2.resize(image, self.input_size, dst=self.resized)
+        if self.input is None:
+            rgb = self.rgb if out is None else out
+            cv2.cvtColor(self.resized, cv2.COLOR_BGR2RGB, dst=rgb[0])
+            return rgb
+
+        # Cast first so that the arithmetic runs in place without the temporary
+        # buffers numpy uses for mixed dtype ufuncs. This measured faster than a
+        # 256 entry lookup table through cv2.LUT
+        cv2.cvtColor(self.resized, cv2.COLOR_BGR2RGB, dst=self.rgb[0])
+        normalized = self.input if out is None else out
+        np.copyto(normalized, self.rgb)
+        np.subtract(normalized, self.input_mean, out=normalized)
+        np.multiply(normalized, self.input_scale, out=normalized)
+        return normalized
+
+    def prepare(self, color_frame):
+        # Copy the color frame and build the model input from it
+        image = np.asanyarray(color_frame.get_data())
+        return self.copy(color_frame), self.prepare_input(image)
+
+class AllocationMeter:
+    def __init__(self, warmup=10):
+        # Iterations to ignore while caches and buffers settle
+        self.warmup = warmup
+        self.allocated = []
+        self.latencies = []
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _reset_peak(self):
+        # tracemalloc.reset_peak only exists from Python 3.9, older versions have
+        # to restart tracing to clear the peak
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.stop()
+            tracemalloc.start()
+
+    def __enter__(self):
+        # Measure one iteration of the hot loop
+        self._reset_peak()
+        self.baseline = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.latencies.append(time.perf_counter() - self.start)
+        self.allocated.append(tracemalloc.get_traced_memory()[1] - self.baseline)
+
+    def report(self):
+        # Peak bytes allocated on top of the baseline and latency per iteration,
+        # over the steady state iterations
+        allocated = np.asarray(self.allocated[self.warmup:] or [0])
+        latencies = np.asarray(self.latencies[self.warmup:] or [0]) * 1000
+        return {
+            "iterations": len(allocated),
+            "max_bytes": int(allocated.max()),
+            "mean_bytes": float(allocated.mean()),
+            "mean_ms": float(latencies.mean()),
+            "p95_ms": float(np.percentile(latencies, 95)),
+        }
+
+    def stop(self):
+        tracemalloc.stop()
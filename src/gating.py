@@ -0,0 +1,131 @@
+'''
+    Description: Cheap per frame checks that decide whether the detector has to
+                 run at all. DepthGate skips the detector while nothing in the
+                 depth frame is close enough to change the navigation decision,
+                 with a safety floor that still runs it every few frames.
+                 SceneGate lets the results of the last frame be reused while the
+                 scene hasn't changed, up to a maximum age
+'''
+
+from realsense import depth_array
+import numpy as np
+import cv2
+
+class DepthGate:
+    def __init__(self, max_distance=1.6, rows=None, step=4, min_fraction=0.002, floor=15):
+        # The detector runs when more than min_fraction of the valid pixels
+        # between rows[0] and rows[1] of the depth frame are closer than
+        # max_distance (m), which should be the navigation's stopping distance
+        # plus a margin for the time between frames. The navigation acts on the
+        # distance at a detection's midpoint wherever it is in the frame, so by
+        # default every row is checked, floor included. No more than floor frames
+        # in a row are skipped. Every step-th row and column is checked
+        self.max_distance = max_distance
+        self.rows = rows
+        self.step = step
+        self.min_fraction = min_fraction
+        self.floor = floor
+
+        # Frames checked, frames skipped, runs forced by the floor and the
+        # number of frames skipped since the detector last ran
+        self.frames = 0
+        self.skipped = 0
+        self.forced = 0
+        self.streak = 0
+
+    def near_fraction(self, depth):
+        # Fraction of the valid sampled pixels closer than max_distance
+        image, scale = depth_array(depth)
+        top, bottom = self.rows if self.rows is not None else (0, image.shape[0])
+        band = image[top:bottom:self.step, ::self.step]
+        valid = np.count_nonzero(band)
+        if valid == 0:
+            return 0.0
+
+        near = np.count_nonzero((band > 0) & (band < self.max_distance / scale))
+        return near / valid
+
+    def check(self, depth):
+        # Whether the detector has to run on this frame
+        self.frames += 1
+        run = self.near_fraction(depth) > self.min_fraction
+        if not run and self.streak >= self.floor:
+            run = True
+            self.forced += 1
+
+        if run:
+            self.streak = 0
+        else:
+            self.streak += 1
+            self.skipped += 1
+        return run
+
+    def stats(self):
+        return {"frames": self.frames, "skipped": self.skipped, "forced": self.forced,
+                "skip_ratio": self.skipped / self.frames if self.frames else 0.0}
+
+class SceneGate:
+    def __init__(self, size=(32, 24), threshold=6.0, max_age=10):
+        # Frames are compared as size (w, h) grayscale thumbnails. A mean absolute
+        # difference above threshold (grey levels) from the frame the results
+        # were computed on counts as a new scene. Results are reused for at most
+        # max_age frames
+        self.size = size
+        self.threshold = threshold
+        self.max_age = max_age
+        self.small = np.empty((size[1], size[0], 3), dtype=np.uint8)
+        self.thumbnail = np.empty((size[1], size[0]), dtype=np.uint8)
+        self.reference = None
+        self.age = 0
+
+        # Frames checked, frames that reused the results, and changes forced by
+        # the age limit
+        self.frames = 0
+        self.hits = 0
+        self.expired = 0
+
+    def difference(self, image):
+        # Mean absolute difference between the thumbnail of a BGR image and the
+        # reference thumbnail. INTER_AREA averages the pixels, which also keeps
+        # sensor noise from counting as change
+        cv2.resize(image, self.size, dst=self.small, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(self.small, cv2.COLOR_BGR2GRAY, dst=self.thumbnail)
+        if self.reference is None:
+            return np.inf
+        return cv2.absdiff(self.thumbnail, self.reference).mean()
+
+    def check(self, image):
+        # Whether the results have to be computed again for this frame, and a
+        # copy of its thumbnail to commit() once they have been. Until then the
+        # reference stays, so a frame whose results never land can't make the
+        # frames after it count as unchanged
+        self.frames += 1
+        change = bool(self.difference(image) > self.threshold)
+        if not change and self.age >= self.max_age:
+            change = True
+            self.expired += 1
+
+        if change:
+            return True, self.thumbnail.copy()
+        self.age += 1
+        self.hits += 1
+        return False, None
+
+    def commit(self, thumbnail):
+        # Make the thumbnail of a frame whose results were computed the new
+        # reference. The reference is replaced rather than written into, so
+        # a check on another thread never sees it half copied
+        self.reference = thumbnail
+        self.age = 0
+
+    def changed(self, image):
+        # check() and commit() in one go, for callers that compute the results
+        # of a changed frame before they look at the next one
+        change, thumbnail = self.check(image)
+        if change:
+            self.commit(thumbnail)
+        return change
+
+    def stats(self):
+        return {"frames": self.frames, "hits": self.hits, "expired": self.expired,
+                "hit_rate": self.hits / self.frames if self.frames else 0.0}
@@ -0,0 +1,168 @@
+'''
+    Description: Runtime quality governor. It watches the latency of every stage
+                 and, where the board exposes it, the CPU temperature, and steps
+                 between quality tiers of model, input resolution and detection
+                 stride so that the navigation decision meets its target latency.
+                 Stepping back up needs clear headroom for a while, so the tiers
+                 don't flap, and every tier's detector is loaded up front so a
+                 switch never loads a model on the hot path
+'''
+
+from detector import create_detector
+from collections import namedtuple, deque
+from threading import RLock
+import numpy as np
+import json
+
+# Temperature of the Pi's CPU in millidegrees Celsius
+SYSFS_TEMPERATURE = "/sys/class/thermal/thermal_zone0/temp"
+
+# A quality tier. Tiers are ordered from the best quality to the cheapest.
+# input_size (w, h) is only used by backends whose input size isn't fixed by
+# the model, like the dnn backend, and detect_every is the detection stride
+Tier = namedtuple("Tier", ["name", "model", "input_size", "detect_every"])
+
+# Backends whose detector takes an input_size, the others read it from the model
+SIZED_BACKENDS = {"dnn"}
+
+def default_tiers(model):
+    # Without a tiers file the governor only varies the detection stride of the
+    # one model
+    return [Tier("full", model, None, 1), Tier("stride2", model, None, 2), Tier("stride4", model, None, 4)]
+
+def load_tiers(path, backend):
+    # Tiers from a JSON list of {"name", "model", "input_size", "detect_every"}
+    # objects, best quality first. Raises ValueError for a tier that sets an
+    # input_size the backend can't use
+    with open(path) as f:
+        entries = json.load(f)
+
+    tiers = [Tier(entry["name"], entry["model"], tuple(entry["input_size"]) if entry.get("input_size") else None,
+                  entry.get("detect_every", 1)) for entry in entries]
+    for tier in tiers:
+        if tier.input_size is not None and backend not in SIZED_BACKENDS:
+            raise ValueError("tier {!r} sets an input_size, but the {} backend takes it from the model. Use a model "
+                             "converted at that size, input_size only works with: {}".format(
+                                 tier.name, backend, ", ".join(sorted(SIZED_BACKENDS))))
+    return tiers
+
+def read_temperature(path=SYSFS_TEMPERATURE):
+    # CPU temperature in degrees Celsius, or None where the file doesn't exist.
+    # sysfs reports millidegrees, a fake file may hold either
+    try:
+        with open(path) as f:
+            value = float(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+    return value / 1000 if value > 200 else value
+
+class Governor:
+    def __init__(self, tiers, backend, target_ms=150, window=30, headroom=0.7, hold=60,
+                 hot=75.0, cool=65.0, temperature_path=SYSFS_TEMPERATURE, temperature_every=30, **options):
+        # Steps one tier down as soon as the 90th percentile decision latency over
+        # the last window frames is above target_ms, or the CPU is at or above hot
+        # degrees. Steps one tier back up only after hold frames in the tier, with
+        # the latency below headroom * target_ms and the CPU below cool degrees.
+        # The temperature is read every temperature_every frames. options are
+        # passed to create_detector for every tier
+        self.tiers = tiers
+        self.target = target_ms / 1000
+        self.headroom = headroom
+        self.hold = hold
+        self.hot = hot
+        self.cool = cool
+        self.temperature_path = temperature_path
+        self.temperature_every = temperature_every
+
+        # One detector per distinct model and input size, all loaded now
+        self.detectors = {}
+        for tier in tiers:
+            key = (tier.model, tier.input_size)
+            if key not in self.detectors:
+                kwargs = dict(options, input_size=tier.input_size) if tier.input_size else options
+                self.detectors[key] = create_detector(backend, tier.model, **kwargs)
+
+        # Latency of each stage over the window, the current tier and how long it
+        # has been in use. In pipeline mode the stages observe from their own
+        # threads while the decision thread updates, so both hold the lock
+        self.lock = RLock()
+        self.window = window
+        self.latencies = {}
+        self.level = 0
+        self.frames = 0
+        self.since_switch = 0
+        self.temperature = read_temperature(temperature_path)
+        self.switches = 0
+        self.frames_in = [0] * len(tiers)
+
+    @property
+    def tier(self):
+        return self.tiers[self.level]
+
+    @property
+    def detector(self):
+        return self.detectors[(self.tier.model, self.tier.input_size)]
+
+    def observe(self, stage, seconds):
+        # Record the latency of a stage. The "decision" stage, from capture to the
+        # navigation decision, is the one that is governed
+        with self.lock:
+            if stage not in self.latencies:
+                self.latencies[stage] = deque(maxlen=self.window)
+            self.latencies[stage].append(seconds)
+
+    def latency(self, stage="decision"):
+        # 90th percentile latency of a stage over the window, in seconds
+        with self.lock:
+            samples = self.latencies.get(stage)
+            return float(np.percentile(samples, 90)) if samples else None
+
+    def update(self):
+        # Call once per frame. Returns the tier to use, which changes at most by
+        # one step at a time
+        with self.lock:
+            return self._update()
+
+    def _update(self):
+        self.frames += 1
+        self.since_switch += 1
+        self.frames_in[self.level] += 1
+        if self.frames % self.temperature_every == 0:
+            self.temperature = read_temperature(self.temperature_path)
+
+        latency = self.latency()
+        samples = len(self.latencies.get("decision", ()))
+        hot = self.temperature is not None and self.temperature >= self.hot
+        cool = self.temperature is None or self.temperature < self.cool
+
+        # A tier is only judged on a full window of its own frames
+        if samples < self.window:
+            return self.tier
+        if (latency > self.target or hot) and self.level < len(self.tiers) - 1:
+            self._switch(self.level + 1)
+        elif latency < self.headroom * self.target and cool and self.since_switch >= self.hold and self.level > 0:
+            self._switch(self.level - 1)
+        return self.tier
+
+    def _switch(self, level):
+        self.level = level
+        self.since_switch = 0
+        self.switches += 1
+        for samples in self.latencies.values():
+            samples.clear()
+
+    def stats(self):
+        with self.lock:
+            stats = {"tier": self.tier.name, "switches": self.switches, "temperature": self.temperature,
+                     "frames_in": dict(zip([tier.name for tier in self.tiers], self.frames_in))}
+            for stage in self.latencies:
+                latency = self.latency(stage)
+                stats[stage + "_p90_ms"] = latency * 1000 if latency is not None else None
+            return stats
+
+    def close(self):
+        # Shut down the interpreter pools of the tiers' detectors
+        for detector in self.detectors.values():
+            if hasattr(detector, "pool"):
+                detector.pool.close()
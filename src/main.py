@@ -1,13 +1,26 @@
 '''
     Author: Jordan Madden
     Usage: python main.py  
+           python main.py --backend="dnn" --model="object_detection/yolov3/yolo-coco" --replay recordings/hallway
+           python main.py --governor --target-ms 150 --temperature-file /tmp/fake_temp
 '''
 
-from realsense import RealSense, filter_distance
-import tflite_runtime.interpreter as tflite
-from depth_profile import get_depth_profile
+from realsense import RealSense, StreamProfile, DepthIntegral, DepthFilterChain, sample_distances
+from registration import Registration
+from obstacle_map import ObstacleMap
+from point_cloud import GroundObstacles
+from replay import ReplaySource
+from frame_pool import FramePool, AllocationMeter
+from visualize import Visualizer
+from detector import create_detector, BACKENDS
+from pipeline import Pipeline
+from tracker import DetectionScheduler
+from roi import CorridorROI
+from gating import DepthGate, SceneGate
+from governor import Governor, default_tiers, load_tiers, SYSFS_TEMPERATURE
+from types import SimpleNamespace
 from imutils.video import FPS
-from smbus import SMBus
+from threading import Thread, RLock
 import importlib.util
 import numpy as np
 import argparse
@@ -17,89 +30,159 @@ import os
 
 # Construct and parse the command line arguments 
 ap = argparse.ArgumentParser()
-ap.add_argument('--model', help='Provide the path to the TFLite file, default is models/detect.tflite',
+ap.add_argument('--backend', help='Detector backend to run the model with',
+                    choices=sorted(BACKENDS), default='tflite')
+ap.add_argument('--model', help='TFLite model (v1, v2 or a path to a .tflite file), or the model folder for the tf2 and dnn backends',
                     default='v1')
+ap.add_argument('--threads', help='Number of threads each TFLite interpreter uses',
+                    type=int, default=None)
+ap.add_argument('--interpreters', help='Number of TFLite interpreters that frames are dispatched to in turn',
+                    type=int, default=1)
+ap.add_argument('--no-xnnpack', help='Run the TFLite model without the XNNPACK delegate',
+                    action='store_true')
+ap.add_argument('--detect-every', help='Run the detector on every n-th frame and track the boxes on the frames between',
+                    type=int, default=1)
+ap.add_argument('--adaptive', help='Adapt how often the detector runs to how well the tracker keeps up',
+                    action='store_true')
+ap.add_argument('--roi', help='Run the detector on the corridor ahead and the near field obstacles at native resolution instead of the whole frame',
+                    action='store_true')
+ap.add_argument('--roi-refresh', help='With --roi, run the detector on the whole frame every n-th detection',
+                    type=int, default=10)
+ap.add_argument('--depth-gate', help='Skip the detector while nothing in the depth frame is within the stopping distance',
+                    action='store_true')
+ap.add_argument('--gate-floor', help='With --depth-gate, run the detector at least once every n frames anyway',
+                    type=int, default=15)
+ap.add_argument('--scene-gate', help='Reuse the detections and distances of the last frame while the scene hasn\'t changed',
+                    action='store_true')
+ap.add_argument('--max-age', help='With --scene-gate, the most frames in a row that reuse the same results',
+                    type=int, default=10)
+ap.add_argument('--governor', help='Step between quality tiers at runtime to keep the decision latency under --target-ms',
+                    action='store_true')
+ap.add_argument('--target-ms', help='With --governor, the 90th percentile decision latency to meet',
+                    type=float, default=150)
+ap.add_argument('--tiers', help='With --governor, JSON file of the quality tiers. By default only the detection stride of --model varies',
+                    default=None)
+ap.add_argument('--temperature-file', help='With --governor, file with the CPU temperature. Point it at a fake file to test throttling',
+                    default=SYSFS_TEMPERATURE)
 ap.add_argument('--threshold', help='Minimum confidence threshold for displaying detected objects',
                     default=0.5)
 ap.add_argument('--resolution', help='Desired webcam resolution in WxH. If the webcam does not support the resolution entered, errors may occur.',
                     default='640x480')               
+ap.add_argument('--depth-resolution', help='Resolution of the depth stream in WxH, defaults to the color resolution',
+                    default=None)
+ap.add_argument('--depth-fps', help='Frame rate of the depth stream',
+                    type=int, default=30)
+ap.add_argument('--color-fps', help='Frame rate of the color stream. When it is below the depth rate the obstacle checks run on every depth frame in a separate thread',
+                    type=int, default=30)
+ap.add_argument('--distance', help='How the distance of a detection is measured: the depth at the box midpoint or the mean depth over the central half of the box',
+                    choices=['midpoint', 'box'], default='midpoint')
+ap.add_argument('--filters', help='Run the depth post-processing filters (threshold, spatial, temporal and hole filling) on the capture thread',
+                    action='store_true')
+ap.add_argument('--decimation', help='With --filters, also decimate the depth frames by this factor. Everything that uses the depth frames is sized to match',
+                    type=int, default=1)
+ap.add_argument('--ground', help='Fit the ground plane and only check obstacles above it when there are no detections',
+                    action='store_true')
+ap.add_argument('--replay', help='Path to a recording made with replay.py to use instead of the camera',
+                    default=None)
+ap.add_argument('--realtime', help='Pace the replayed frames at the recorded rate instead of as fast as possible',
+                    action='store_true')
+ap.add_argument('--color-every', help='Only use the color of every n-th replayed frame, to simulate a slower color stream',
+                    type=int, default=1)
+ap.add_argument('--headless', help='Run without the debug window',
+                    action='store_true')
+ap.add_argument('--profile', help='Trace the allocations and latency of the preprocessing and print them on exit. Only used without --pipeline',
+                    action='store_true')
+ap.add_argument('--pipeline', help='Run capture, preprocessing, inference, postprocessing and the navigation decision as concurrent stages',
+                    action='store_true')
 args = vars(ap.parse_args())
 
-# Set the bus address and indicate I2C-1
+# Set the bus address and indicate I2C-1. The bus is not available when running
+# from a recording on a machine other than the Pi, in which case command()
+# reports the missing connection
 addr = 0x08
-bus = SMBus(1)
+try:
+    from smbus import SMBus
+    bus = SMBus(1)
+except (ImportError, OSError):
+    bus = None
 
-def detect(input_data, input_details, output_details):
-    # Perform the object detection and get the results
-    interpreter.set_tensor(input_details[0]['index'],input_data)
-    interpreter.invoke()
-    
-    boxes = interpreter.get_tensor(output_details[0]['index'])[0] 
-    classes = interpreter.get_tensor(output_details[1]['index'])[0] 
-    scores = interpreter.get_tensor(output_details[2]['index'])[0]
+# Distance (cm) reported for a checkpoint that has no obstacle in front of it
+NO_OBSTACLE = 10000
 
-    return (boxes, classes, scores)
+# Commands can be sent from both the detection loop and the depth thread. The
+# depth thread holds the lock while it checks the last command and sends one
+command_lock = RLock()
 
-def visualize_boxes(frame, depth_frame, boxes, scores, classes, H, W):
-    # Get the bounding box coordinates
-    coordinates = get_object_info(depth_frame, boxes, scores, H, W)
-    i = 0
-    
-    for dist,  coordinate in coordinates:
-        # Get the bounding box coordinates
-        x1, y1, x2, y2 = coordinate
-
-        # Draw bounding box
-        cv2.rectangle(frame, (x1,y1), (x2,y2), (0,255,0), 2)
-
-def get_object_info(depth_frame, detections, scores, H, W):
-    # Initialize list to store bounding box coordinates of each bounding box
-    # and the distance of each block
-    object_info = []
-
-    for detection, score in zip(detections, scores):
-        # Only move forward if score is above the threshold
-        if score > CONFIDENCE_THRESH:
-            # Extract the coordinates of the detections and normalize each detection
-            y1, x1, y2, x2 = detection
-            y1 = int(H*y1)
-            x1 = int(W*x1)
-            y2 = int(H*y2)
-            x2 = int(W*x2)
-
-            # Get the midpoint of each bounding box
-            midX = (x1 + x2)//2
-            midY = (y1 + y2)//2
-            
-            distance = filter_distance(depth_frame, midX, midY)
+def box_distance(depth_frame, x1, y1, x2, y2, integral=None):
+    # Mean depth over the central half of each box using the summed area tables
+    # of the frame. Boxes that are mostly holes fall back to the midpoint depth
+    boxes = np.stack([x1, y1, x2, y2], axis=1)
+    if registration is not None:
+        boxes = registration.boxes_to_depth(depth_frame, boxes)
+    else:
+        boxes = (boxes * np.tile(depth_scale(depth_frame), 2)).astype(int)
+    quarter = np.hstack([boxes[:, 2:] - boxes[:, :2]] * 2) // 4
+    inner = boxes + quarter * [1, 1, -1, -1]
+
+    if integral is None:
+        integral = DepthIntegral(depth_frame)
+    mean, valid, _ = integral.box_stats(inner)
+
+    midpoints = (inner[:, :2] + inner[:, 2:]) // 2
+    return np.where(valid > 0.25, mean, sample_distances(depth_frame, midpoints)).astype(int)
 
-            # Add the coordinates to the coordinate list and the 
-            object_info.append((distance, (x1, y1, x2, y2)))
+def depth_scale(depth_frame):
+    # Factors that take color pixels to the pixels of the depth frame, which is
+    # smaller than the color frame at a lower depth resolution or decimated
+    return np.array([depth_frame.get_width() / imW, depth_frame.get_height() / imH])
 
-    # Sort the data points by distance
+def get_object_info(depth_frame, detections, scores, H, W, integral=None):
+    # Only keep the detections whose score is above the threshold
+    keep = np.asarray(scores) > CONFIDENCE_THRESH
+    detections = np.asarray(detections).reshape(-1, 4)[keep]
+
+    # Scale the normalized (y1, x1, y2, x2) detections to pixel coordinates
+    y1, x1, y2, x2 = (detections * [H, W, H, W]).astype(int).T
+
+    # Get the distance of every detection in one pass, either from box statistics
+    # or at the midpoint of each box. The boxes come from the color image, so
+    # they are registered to the depth image when the calibration is available
+    midpoints = np.stack([(x1 + x2)//2, (y1 + y2)//2], axis=1)
+    if DISTANCE_MODE == "box":
+        distances = box_distance(depth_frame, x1, y1, x2, y2, integral)
+    elif registration is not None:
+        distances = registration.sample_distances(depth_frame, midpoints)
+    else:
+        distances = sample_distances(depth_frame, (midpoints * depth_scale(depth_frame)).astype(int))
+
+    # Pair each distance with its box coordinates and sort them by distance
+    object_info = [(int(d), (int(a), int(b), int(c), int(e)))
+                    for d, a, b, c, e in zip(distances, x1, y1, x2, y2)]
     object_info.sort()
 
     return object_info
 
 def command(val, frame):
     global last_command
-    print(last_command)
-    
-    # Send data to chip so that it can provide feedback
-    try:
-        send_feedback_command(val, last_command)
-    except:
-        print("Remote IOError: No I2C/TWI connection is present")
-       
-    # Display command on the screen
-    text = "Command: {}".format(val)
-    print(text)
-    cv2.rectangle(frame, (0, 0), (180, 25), (255, 255, 255), -1)
-    cv2.putText(frame, text, (10, 20), cv2.FONT_HERSHEY_SIMPLEX,
-            0.5, (0, 0, 0), thickness=2)
-    
-    # Update the previously sent command 
-    last_command = val
+    with command_lock:
+        print(last_command)
+        
+        # Send data to chip so that it can provide feedback
+        try:
+            send_feedback_command(val, last_command)
+        except:
+            print("Remote IOError: No I2C/TWI connection is present")
+           
+        # Display command on the screen. The depth thread has no frame to draw on
+        text = "Command: {}".format(val)
+        print(text)
+        if frame is not None:
+            cv2.rectangle(frame, (0, 0), (180, 25), (255, 255, 255), -1)
+            cv2.putText(frame, text, (10, 20), cv2.FONT_HERSHEY_SIMPLEX,
+                    0.5, (0, 0, 0), thickness=2)
+        
+        # Update the previously sent command 
+        last_command = val
     
 def send_feedback_command(command, prev_command):
     if command is not prev_command:
@@ -119,43 +202,88 @@ def send_feedback_command(command, prev_command):
         bus.write_byte(addr, 0x04)
         
 
-def checkpoints(depth_frame):
+def checkpoints(depth_frame, ground=None):
     global checkpoint_detection
     checkpoint_detection = False
     min_distance2 = 80
     W, H = 640, 480
 
-    # Coordinates of the points to be checked in the frame
-    center = filter_distance(depth_frame, W//2, H//2)
-    right = filter_distance(depth_frame, W//2 + 90, H//2)
-    left = filter_distance(depth_frame, W//2 - 90, H//2)
-    l_center = filter_distance(depth_frame, W//2, H//2 + 180)
-    l_right = filter_distance(depth_frame, W//2 + 60, H//2 + 180)
-    l_left = filter_distance(depth_frame, W//2 - 60, H//2 + 180)
+    # Coordinates of the points to be checked in the frame: center, right, left
+    # and the lower center, right and left
+    points = [(W//2, H//2), (W//2 + 90, H//2), (W//2 - 90, H//2),
+              (W//2, H//2 + 180), (W//2 + 60, H//2 + 180), (W//2 - 60, H//2 + 180)]
+
+    # The points are laid out for a 640x480 frame, scale them to the depth stream
+    scale = [depth_frame.get_width() / W, depth_frame.get_height() / H]
+    points = (np.asarray(points) * scale).astype(int)
+
+    # With a ground estimate only the obstacles above the floor are checked, so
+    # the floor itself can't trigger the lower checkpoints when the camera tilts.
+    # Checkpoints that only see floor are treated as clear
+    if ground is not None:
+        grid_points = points // ground.step
+        distances = sample_distances(ground.obstacle_frame, grid_points, ksize=3, fill=NO_OBSTACLE)
+    else:
+        distances = sample_distances(depth_frame, points)
     
     # If any of the checkpoints are triggered raise a notification
-    if ((center < min_distance) or (left < min_distance) or (right < min_distance) or 
-        (l_center < min_distance) or (l_left < min_distance) or (l_right < min_distance)):
+    if (distances < min_distance).any():
         checkpoint_detection = True
         return True
     
     return False     
 
+def update_depth(depth_frame):
+    # Update the per-column nearest obstacles and the above-ground obstacle mask
+    # used by the navigation
+    obstacle_map.update(depth_frame)
+    if ground is not None:
+        ground.update(depth_frame)
+
+def depth_loop():
+    # Fast path that runs at the depth stream rate when it is faster than the
+    # color stream. It keeps the obstacle map up to date for the detection loop
+    # and stops the user as soon as a checkpoint is triggered. The stop holds
+    # until a depth frame clears the checkpoints, decide() doesn't override it
+    global depth_stop
+    seq = 0
+    while not video.stopped:
+        frameset = video.read_depth(wait_newer_than=seq, timeout=1.0)
+        if frameset is None:
+            continue
+        seq = frameset.seq
+
+        # Without a ground plane the checkpoints are sampled from the raw depth
+        # frame. The stop state and the last command are checked and replaced
+        # under the lock so the detection loop can't send one in between
+        update_depth(frameset.depth)
+        stop = checkpoints(frameset.depth, ground)
+        with command_lock:
+            depth_stop = stop
+            if stop and last_command != "Stop":
+                command("Stop", None)
+
 def navigate(frame, depth_frame, dist, left, right):
     # Determine the distance between the object and 
     # the left and right borders of the frame
     dist_left = left - 0
     dist_right = 640 - right
     
-    # Get the depth profile on either side of the object
+    # Get the nearest obstacle in each column on either side of the object from
+    # the obstacle map of the whole frame, whose columns are those of the depth
+    # stream. The depth thread may update the map meanwhile, so both sides come
+    # from one copy and each mean is taken once
     profile_w = 100
     y_offset = 30
-    left_profile = get_depth_profile(depth_frame, profile_w, left-profile_w, midY+y_offset)
-    right_profile = get_depth_profile(depth_frame, profile_w, right, midY+y_offset)   
+    sx = obstacle_map.width / imW
+    nearest = obstacle_map.nearest.copy()
+    left_mean = obstacle_map.column_distances(int((left-profile_w)*sx), int(left*sx), nearest).mean()
+    right_mean = obstacle_map.column_distances(int(right*sx), int((right+profile_w)*sx), nearest).mean()
             
     # Draw line across the profiles
-    cv2.line(frame, (left-profile_w, midY+y_offset), (left, midY+y_offset), (0, 0, 255), thickness=2)
-    cv2.line(frame, (right, midY+y_offset), (right+profile_w, midY+y_offset), (0, 0, 255), thickness=2)
+    if frame is not None:
+        cv2.line(frame, (left-profile_w, midY+y_offset), (left, midY+y_offset), (0, 0, 255), thickness=2)
+        cv2.line(frame, (right, midY+y_offset), (right+profile_w, midY+y_offset), (0, 0, 255), thickness=2)
     
     if dist < min_distance:
         # If object is close to the left of the frame, turn right
@@ -165,129 +293,354 @@ def navigate(frame, depth_frame, dist, left, right):
         elif right >= 640-profile_w:
             command("Left", frame)
         else:
-            print("Left: {:.2f}\tRight: {:.2f}".format(left_profile.mean(), right_profile.mean()))
-            if int(left_profile.mean()) > int(right_profile.mean()):
+            print("Left: {:.2f}\tRight: {:.2f}".format(left_mean, right_mean))
+            if int(left_mean) > int(right_mean):
                 command("Left", frame)
-            elif int(right_profile.mean()) > int(left_profile.mean()):
+            elif int(right_mean) > int(left_mean):
                 command("Right", frame)            
     else:
         # Move forward if nothing is within the proximity
         command("Forward", frame)    
 
+def capture():
+    # Wait for a frameset that hasn't been processed yet. Raises StopIteration at
+    # the end of a recording
+    global seq
+    frameset = video.read(wait_newer_than=seq, timeout=1.0)
+    if frameset is None:
+        if video.stopped:
+            raise StopIteration
+        return None
+    seq = frameset.seq
+
+    return SimpleNamespace(frameset=frameset, buffers=None, start=time.perf_counter())
+
+def preprocess(job):
+    # Pin the depth frame so the navigation works on a view of its buffer, then
+    # copy the color frame into a free set of pooled buffers and build the model
+    # input. Backends that can run asynchronously start the inference here, since
+    # their input doesn't live in the pooled buffers
+    color_frame, depth_frame = job.frameset
+    job.buffers = free_buffers.pop() if free_buffers else FramePool(video.color_width, video.color_height)
+    job.buffers.pin(depth_frame)
+    job.frame = job.buffers.copy(color_frame)
+
+    # Frames with nothing in range, frames of an unchanged scene and frames that
+    # the scheduler leaves to the tracker skip the model entirely
+    # A changed scene only becomes the reference once the frame's results land
+    # in postprocess, since the frame may still be dropped on the way
+    job.gated = gate is not None and not gate.check(depth_frame)
+    job.cached, job.thumbnail = False, None
+    if not job.gated and scene is not None:
+        changed, job.thumbnail = scene.check(job.frame)
+        job.cached = not changed
+    job.detect = not job.gated and not job.cached and (scheduler is None or scheduler.due())
+    job.future = None
+    if job.detect:
+        # The frame stays with the detector of the tier it started on
+        job.detector = detector if governor is None else governor.detector
+        job.region = roi.select(depth_frame) if roi is not None else None
+        image = roi.crop(job.frame, job.region) if roi is not None else job.frame
+        job.inputs = job.detector.preprocess(image)
+        job.future = job.detector.submit(job.inputs) if hasattr(job.detector, "submit") else None
+    return job
+
+def infer(job):
+    # Wait for or run the object detection
+    if job.detect:
+        start = time.perf_counter()
+        job.outputs = job.future.result() if job.future is not None else job.detector.infer(job.inputs)
+        if governor is not None:
+            governor.observe("infer", time.perf_counter() - start)
+    return job
+
+def postprocess(job):
+    global cached_points
+
+    # An unchanged scene reuses the distance-coordinate pairs of the last frame
+    # that computed them, and the obstacles found on it
+    if job.cached:
+        job.points = cached_points
+        return job
+
+    # Get the detections first, which hands the interpreter back for the next
+    # frame. Detections in a crop are mapped back to the whole frame. With a
+    # scheduler the detections correct the tracker, and the tracker moves the
+    # boxes along on the frames without detections
+    if job.detect:
+        detections = job.detector.postprocess(job.outputs)
+        if roi is not None:
+            detections = roi.to_frame(detections, job.region)
+
+    if job.gated:
+        boxes = None
+    elif scheduler is None:
+        boxes, classes, scores = detections
+    elif job.detect:
+        boxes, classes, scores, _ = scheduler.update(detections, job.frameset.timestamp)
+    else:
+        boxes, classes, scores, _ = scheduler.predict(job.frameset.timestamp)
+
+    # Update the obstacles here unless the depth thread is already doing it, and
+    # get the distance-coordinate pairs of the detections. A gated frame has
+    # nothing in range to detect
+    color_frame, depth_frame = job.frameset
+    if not split:
+        update_depth(depth_frame)
+
+    job.points = [] if boxes is None else get_object_info(depth_frame, boxes, scores, imH, imW, job.frameset.integral)
+    cached_points = job.points
+    if job.thumbnail is not None:
+        scene.commit(job.thumbnail)
+    return job
+
+def decide(job):
+    global numFrames, midX, midY
+    color_frame, depth_frame = job.frameset
+    frame, points = job.frame, job.points
+
+    # The command and the profiles are only drawn when there is a debug view
+    canvas = frame if viz.enabled else None
+    
+    # While the depth thread has the user stopped, keep them stopped. If there
+    # are no detections, move forward. otherwise make navigation decision. The
+    # lock keeps the depth thread from stopping the user halfway through
+    with command_lock:
+        if depth_stop:
+            command("Stop", canvas)
+        elif (len(points) == 0):
+            if ground is not None and checkpoints(depth_frame, ground):
+                command("Stop", canvas)
+            else:
+                command("Forward", canvas) 
+        else:  
+            for (dist, coords) in points:
+                # Extract the bounding box coordinates 
+                startX, startY, endX, endY = coords
+                
+                # Find the midpoint coordinates
+                midX = (startX+endX)//2
+                midY = (startY+endY)//2
+
+                # Determine what command to give to the user
+                navigate(canvas, depth_frame, dist, startX, endX)
+                break
+    
+    # Increment the frame counter
+    numFrames += 1
+            
+    # Hand the output frame, the depth frame and the detections with their
+    # distances to the debug view, which drops it if it is still busy
+    viz.submit(frame, depth_frame,
+               [(x1, y1, x2, y2, "Distance: {}cm".format(dist)) for dist, (x1, y1, x2, y2) in points])
+
+    # Let the governor step the quality tier on the latency from capture to
+    # here. A new tier brings its own detection stride and model input size
+    if governor is not None:
+        governor.observe("decision", time.perf_counter() - job.start)
+        tier = governor.update()
+        if governor.since_switch == 0:
+            if scheduler is not None:
+                scheduler.interval = tier.detect_every
+            if roi is not None:
+                roi.input_size = getattr(governor.detector, "input_size", roi.input_size)
+
+    # Update FPS counter
+    fps.update()
+    return job
+
+def release(job):
+    # Return the buffers of a finished or dropped frame to the free list, and
+    # once its inference is done whatever the model outputs hold on to
+    if job.buffers is not None:
+        free_buffers.append(job.buffers)
+        job.buffers = None
+    if getattr(job, "future", None) is not None:
+        job.future.add_done_callback(lambda future, detector=job.detector: detector.release(future.result()))
+        job.future = None
+
 if __name__ == "__main__":
     # Declare relevant constants
+    model_path = args["model"]
     if args["model"] == "v1":
         model_path = '/home/pi/tflite/detect.tflite'
     if args["model"] == "v2":
         model_path = '/home/pi/tflite/model.tflite'
         
     PATH_TO_MODEL_DIR = model_path
-    CONFIDENCE_THRESH = args["threshold"]
+    CONFIDENCE_THRESH = float(args["threshold"])
+    DISTANCE_MODE = args["distance"]
 
-    # Get the desired image dimensions
+    # Get the desired image dimensions of the color and depth streams
     resW, resH = args["resolution"].split('x')
     imW, imH = int(resW), int(resH)
+    depthW, depthH = [int(v) for v in (args["depth_resolution"] or args["resolution"]).split('x')]
 
     # Declare variables and constants for navigation
     min_distance = 130
     numFrames = 0
 
-    # Load TFLite model
+    # Load the model with the chosen backend
     print('[INFO] loading model...')
     start_time = time.time()
-    interpreter = tflite.Interpreter(model_path=PATH_TO_MODEL_DIR)    
+    options = {}
+    if args["backend"] == "tflite":
+        options = {"num_threads": args["threads"], "pool_size": args["interpreters"],
+                   "xnnpack": not args["no_xnnpack"]}
+
+    # With the governor every tier's model is loaded now, so that switching
+    # tiers never waits on a model load
+    governor = None
+    if args["governor"]:
+        try:
+            tiers = load_tiers(args["tiers"], args["backend"]) if args["tiers"] else default_tiers(PATH_TO_MODEL_DIR)
+        except ValueError as e:
+            ap.error(str(e))
+        governor = Governor(tiers, args["backend"], target_ms=args["target_ms"],
+                            temperature_path=args["temperature_file"], **options)
+        detector = governor.detector
+    else:
+        detector = create_detector(args["backend"], PATH_TO_MODEL_DIR, **options)
     end_time = time.time()
     elapsed_time = end_time - start_time
     print('Done! Took {} seconds'.format(elapsed_time))
+
+    # Decide which frames the detector runs on, unless it runs on all of them
+    scheduler = None
+    strided = governor is not None and any(tier.detect_every > 1 for tier in governor.tiers)
+    if args["detect_every"] > 1 or args["adaptive"] or strided:
+        interval = governor.tier.detect_every if governor is not None else args["detect_every"]
+        scheduler = DetectionScheduler(interval=max(interval, 1), adaptive=args["adaptive"],
+                                       threshold=CONFIDENCE_THRESH)
+
+    # Skip the detector while nothing is within the stopping distance, plus the
+    # distance walked before the next frame that runs it
+    gate = DepthGate(max_distance=min_distance / 100 + 0.3, floor=args["gate_floor"]) if args["depth_gate"] else None
+
+    # Reuse the results of the last frame while the scene stays the same
+    scene = SceneGate(max_age=args["max_age"]) if args["scene_gate"] else None
+    cached_points = []
     
-    # Initalize params for TFLite  model
-    interpreter.allocate_tensors()
-    input_details = interpreter.get_input_details()
-    output_details = interpreter.get_output_details()
-    height = input_details[0]['shape'][1]
-    width = input_details[0]['shape'][2]
-    floating_model = (input_details[0]['dtype'] == np.float32)
-    input_mean = 127.5
-    input_std = 127.5
-    
-    # Initialize commands
+    # Initialize commands and the stop state of the depth thread
     last_command = "Nada"
+    depth_stop = False
 
     # Initialize video stream and the FPS counter
     time.sleep(2.0)
     print('[INFO] running inference for realsense camera...')
-    video = RealSense(width=imW, height=imH).start()
+    # The depth filters run on the capture thread, before the frames are handed
+    # out. The sources report the decimated frame size and intrinsics
+    if args["decimation"] < 1 or (args["decimation"] > 1 and not args["filters"]):
+        ap.error("--decimation needs --filters and a factor of at least 1")
+    filters = DepthFilterChain(decimation=args["decimation"]) if args["filters"] else None
+    if args["replay"]:
+        video = ReplaySource(args["replay"], realtime=args["realtime"], integral=DISTANCE_MODE == "box",
+                             color_every=args["color_every"], filters=filters).start()
+        imW, imH = video.color_width, video.color_height
+    else:
+        video = RealSense(integral=DISTANCE_MODE == "box", filters=filters,
+                          depth_profile=StreamProfile(depthW, depthH, args["depth_fps"], "z16"),
+                          color_profile=StreamProfile(imW, imH, args["color_fps"], "bgr8")).start()
     fps = FPS().start()    
+    seq = 0
 
-    while True:
-        # Get the video frames from the camera
-        color_frame, depth_frame = video.read()
-        
-        # Convert images to numpy arrays and get the frame dimensions
-        depth_image = np.asanyarray(depth_frame.get_data())
-        frame1 = np.asanyarray(color_frame.get_data())
-
-        # Acquire frame and resize to expected shape [1xHxWx3]
-        frame = frame1.copy()
-        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        frame_resized = cv2.resize(frame_rgb, (width, height))
-        input_data = np.expand_dims(frame_resized, axis=0)
-
-        # Normalize pixel values if using a floating model
-        if floating_model:
-            input_data = (np.float32(input_data) - input_mean) / input_std
-        
-        # Run the object detection and visualze the results
-        boxes, classes, scores = detect(input_data, input_details, output_details)
-        visualize_boxes(frame, depth_frame, boxes, scores, classes, imH, imW)
-        
-        # Get the distance-coordinate pairs
-        points = get_object_info(depth_frame, boxes, scores, imH, imW)
-        
-        # If there are no detections, move forward. otherwise make navigation
-        # decision
-        if (len(points) == 0):
-            command("Forward", frame) 
-        else:  
-            for (dist, coords) in points:
-                # Extract the bounding box coordinates 
-                startX, startY, endX, endY = coords
-                
-                # Find the midpoint coordinates
-                midX = (startX+endX)//2
-                midY = (startY+endY)//2
-                
-                # Draw a circle at the midpoint for visual validation
-                cv2.circle(frame, (midX, midY), radius=5, 
-                    color=(0,0,255), thickness=2)
-                
-                    # Display the distance of the object from the camera
-                text = "Distance: {}cm".format(dist)
-                cv2.putText(frame, text, (startX, startY+20), cv2.FONT_HERSHEY_SIMPLEX, 
-                    0.6, (0, 0, 255), thickness=2)
+    # Debug view rendered on its own thread, or nothing at all when headless
+    viz = Visualizer('Object Detector', enabled=not args["headless"]).start()
 
-                # Determine what command to give to the user
-                navigate(frame, depth_frame, dist, startX, endX)
+    # Build the depth to color lookup tables once from the camera or recording
+    # calibration. Recordings without intrinsics fall back to unaligned lookups
+    calibration = video.get_calibration()
+    registration = Registration(calibration) if "color_intrinsics" in calibration else None
+    obstacle_map = ObstacleMap(video.width, video.height, calibration.get("depth_intrinsics"))
+
+    # The ground plane needs the depth intrinsics to deproject the frame
+    ground = None
+    if args["ground"] and "depth_intrinsics" in calibration:
+        ground = GroundObstacles(calibration["depth_intrinsics"])
+
+    # With a depth stream that is faster than the color stream the obstacle
+    # checks get their own thread instead of running once per detection
+    split = args["color_every"] > 1 if args["replay"] else args["depth_fps"] > args["color_fps"]
+    if split:
+        Thread(target=depth_loop, args=(), daemon=True).start()
+
+    # Crop the detector input to the corridor ahead, at the native resolution of
+    # the model input
+    roi = None
+    if args["roi"]:
+        roi = CorridorROI(video.color_width, video.color_height, getattr(detector, "input_size", (300, 300)),
+                          refresh=args["roi_refresh"])
+
+    # Sets of buffers for the color copy that are reused across frames, one per
+    # frame in flight. The detectors keep their own model input buffers
+    free_buffers = []
+
+    if args["pipeline"]:
+        # Every stage runs on its own thread with the newest frame waiting at
+        # each boundary. A replay that isn't paced in realtime hands out frames as
+        # fast as they are asked for, so there the stages wait for each other
+        # instead of dropping frames
+        pipeline = Pipeline(capture, [("preprocess", preprocess), ("infer", infer),
+                                      ("postprocess", postprocess), ("decide", decide)],
+                            release=release, block=bool(args["replay"]) and not args["realtime"]).start()
+        while pipeline.running():
+            # Press 'q' in the debug view to quit
+            if viz.quit:
+                pipeline.stop()
+            time.sleep(0.05)
+        fps.stop()
+    else:
+        # Optional allocation tracing of the preprocessing
+        meter = AllocationMeter() if args["profile"] else None
+
+        while True:
+            try:
+                job = capture()
+            except StopIteration:
+                fps.stop()
                 break
-        
-        # Increment the frame counter
-        numFrames += 1
-                
-        # Display the output frame
-        cv2.imshow('Object Detector', frame)
+            if job is None:
+                continue
 
-        # Update FPS counter
-        fps.update()
+            if meter is not None:
+                with meter:
+                    preprocess(job)
+            else:
+                preprocess(job)
+            decide(postprocess(infer(job)))
+            release(job)
 
-        # Press 'q' to quit
-        if cv2.waitKey(1) == ord('q'):
-            fps.stop()
-            break
+            # Press 'q' in the debug view to quit
+            if viz.quit:
+                fps.stop()
+                break
 
     # Show the elapsed time and the respective fps
     print("[INFO] elapsed time: {:.2f}".format(fps.elapsed()))
     print("[INFO] approximate fps: {:.2f}".format(fps.fps()))
+    print("[INFO] frame slot: {}".format(video.slot.stats()))
+    print("[INFO] debug view: {}".format(viz.stats()))
+    if scheduler is not None:
+        print("[INFO] detection scheduler: {}".format(scheduler.stats()))
+    if roi is not None:
+        print("[INFO] region of interest: {}".format(roi.stats()))
+    if gate is not None:
+        print("[INFO] depth gate: {}".format(gate.stats()))
+    if scene is not None:
+        print("[INFO] scene gate: {}".format(scene.stats()))
+    if governor is not None:
+        print("[INFO] governor: {}".format(governor.stats()))
+        governor.close()
+    if args["pipeline"]:
+        stats = pipeline.stats()
+        print("[INFO] pipeline: {:.2f} frames/s, {} frames completed, {} dropped".format(
+            stats.pop("throughput"), stats.pop("completed"), stats.pop("dropped")))
+        for name, stats in stats.items():
+            print("[INFO] pipeline {}: {}".format(name, stats))
+    elif meter is not None:
+        print("[INFO] preprocessing: {}".format(meter.report()))
+        meter.stop()
         
-    # Stop the video stream
-    cv2.destroyAllWindows()
+    # Stop the debug view and the video stream
+    viz.stop()
     video.stop() 
\ No newline at end of file
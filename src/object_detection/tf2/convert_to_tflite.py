@@ -1,8 +1,22 @@
 '''
    Usage: python convert_to_tflite.py
+          python convert_to_tflite.py --quantize int8 --replay recordings/hallway --replay recordings/kitchen
+          python convert_to_tflite.py --quantize fp16 --eval recordings/lab
 '''
 import tensorflow as tf
+import numpy as np
 import argparse
+import json
+import time
+import sys
+import os
+
+# The replay and detector code lives in the src folder, two levels up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from replay import Recording
+from frame_pool import FramePool
+from detector import TFLiteDetector
+from tracker import iou_matrix
 
 # Construct and parse the command line arguments
 ap = argparse.ArgumentParser()
@@ -10,17 +24,186 @@ ap.add_argument('--model', help='Folder that the saved model is located in',
                     default='exported-models/my_tflite_model/saved_model')
 ap.add_argument('--output', help='Folder that the tflite model will be written to',
                     default='exported-models/my_tflite_model')
+ap.add_argument('--quantize', help='dynamic: int8 weights with Flex ops (the original conversion), int8: full integer '
+                    'with uint8 input and builtin ops only, fp16: float16 weights with builtin ops only',
+                    choices=['dynamic', 'int8', 'fp16'], default='dynamic')
+ap.add_argument('--replay', help='Recording to draw the representative frames for int8 calibration from, can be repeated',
+                    action='append', default=[])
+ap.add_argument('--eval', help='Held out recording for the report, can be repeated. Without one the last '
+                    'part of every --replay recording is held out', action='append', default=[])
+ap.add_argument('--calibration-frames', help='Number of representative frames used for int8 calibration',
+                    type=int, default=200)
+ap.add_argument('--holdout', help='Fraction at the end of every --replay recording held out for the report',
+                    type=float, default=0.2)
+ap.add_argument('--eval-frames', help='Number of held out frames the report runs both models on',
+                    type=int, default=100)
+ap.add_argument('--threshold', help='Score above which detections are compared in the report',
+                    type=float, default=0.5)
+ap.add_argument('--threads', help='Number of threads the interpreters use in the report',
+                    type=int, default=4)
+ap.add_argument('--no-report', help='Only convert the model', action='store_true')
 args = ap.parse_args()
 
+def input_size(model_dir):
+    # Width and height of the image input of the saved model's serving signature
+    signature = tf.saved_model.load(model_dir).signatures['serving_default']
+    spec = list(signature.structured_input_signature[1].values())[0]
+    _, height, width, _ = spec.shape
+    return width, height
+
+def split_frames(replays, evals, holdout):
+    # (recording, frame) pairs to calibrate with and to evaluate on. Neighbouring
+    # frames look alike, so the held out frames are a block at the end of each
+    # recording instead of every n-th frame
+    calibration, evaluation = [], []
+    for path in replays:
+        recording = Recording(path)
+        cut = len(recording) if evals else int(len(recording) * (1 - holdout))
+        calibration += [(recording, i) for i in range(cut)]
+        evaluation += [(recording, i) for i in range(cut, len(recording))]
+    for path in evals:
+        recording = Recording(path)
+        evaluation += [(recording, i) for i in range(len(recording))]
+
+    return calibration, evaluation
+
+def spread(frames, count):
+    # count frames evenly spread over the list
+    if len(frames) <= count:
+        return frames
+    return [frames[i] for i in np.linspace(0, len(frames) - 1, count).astype(int)]
+
+def representative_dataset(frames, width, height):
+    # Float model inputs built exactly like the detector builds them at runtime,
+    # so the calibrated ranges match what the quantized model will be fed
+    pool = FramePool(input_width=width, input_height=height, floating=True)
+    def generator():
+        for recording, i in frames:
+            color, _, _ = recording[i]
+            yield [pool.prepare_input(np.ascontiguousarray(color)).copy()]
+    return generator
+
+def convert(model_dir, quantize, dataset=None):
+    converter = tf.lite.TFLiteConverter.from_saved_model(model_dir)
+    converter.experimental_new_converter = True
+
+    if quantize == 'dynamic':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+    elif quantize == 'int8':
+        # Every op in int8 and a uint8 image input. The calibrated input range is
+        # about [-1, 1], which quantizes back to the raw pixel values, so the
+        # detector can feed the resized RGB frame without normalizing it
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.uint8
+        converter.inference_output_type = tf.uint8
+    elif quantize == 'fp16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS]
+    else:
+        # Unquantized float model that the report compares against
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS]
+
+    return converter.convert()
+
+def save(tflite_model, path):
+    with tf.io.gfile.GFile(path, 'wb') as f:
+        f.write(tflite_model)
+    print("[INFO] wrote {} ({:.1f} MB)".format(path, len(tflite_model) / 1e6))
+
+def agreement(reference, candidate, iou_threshold=0.5):
+    # Greedily match the candidate detections to the reference ones of the same
+    # class, best reference first. Returns the matched count and the IoU and
+    # score difference of every match
+    overlap = iou_matrix(reference.boxes, candidate.boxes)
+    overlap[reference.classes[:, None] != candidate.classes[None, :]] = 0
+
+    ious, score_errors = [], []
+    used = set()
+    for r in range(len(reference.boxes)):
+        for c in np.argsort(-overlap[r]):
+            if overlap[r, c] < iou_threshold:
+                break
+            if c in used:
+                continue
+            used.add(c)
+            ious.append(overlap[r, c])
+            score_errors.append(abs(reference.scores[r] - candidate.scores[c]))
+            break
+
+    return len(used), ious, score_errors
+
+def report(reference_path, candidate_path, frames, threshold, threads):
+    # Latency of both models and how well the candidate's detections agree with
+    # the reference's on the held out frames
+    reference = TFLiteDetector(reference_path, threshold=threshold, num_threads=threads)
+    candidate = TFLiteDetector(candidate_path, threshold=threshold, num_threads=threads)
+
+    latencies = {"reference": [], "candidate": []}
+    counts = {"reference": 0, "candidate": 0, "matched": 0}
+    ious, score_errors = [], []
+    for recording, i in frames:
+        color = np.ascontiguousarray(recording[i][0])
+        results = {}
+        for name, detector in [("reference", reference), ("candidate", candidate)]:
+            inputs = detector.preprocess(color)
+            start = time.perf_counter()
+            outputs = detector.infer(inputs)
+            latencies[name].append(time.perf_counter() - start)
+            results[name] = detector.postprocess(outputs)
+            counts[name] += len(results[name].boxes)
+
+        matched, frame_ious, frame_errors = agreement(results["reference"], results["candidate"])
+        counts["matched"] += matched
+        ious += frame_ious
+        score_errors += frame_errors
+
+    reference.pool.close()
+    candidate.pool.close()
+
+    summary = {"frames": len(frames), "threshold": threshold, "threads": threads}
+    for name, values in latencies.items():
+        values = np.asarray(values) * 1000
+        summary[name + "_ms"] = {"p50": float(np.percentile(values, 50)), "p95": float(np.percentile(values, 95))}
+    summary["speedup"] = summary["reference_ms"]["p50"] / summary["candidate_ms"]["p50"]
+    summary["detections"] = counts
+    summary["recall"] = counts["matched"] / counts["reference"] if counts["reference"] else 1.0
+    summary["precision"] = counts["matched"] / counts["candidate"] if counts["candidate"] else 1.0
+    summary["mean_iou"] = float(np.mean(ious)) if ious else None
+    summary["mean_score_error"] = float(np.mean(score_errors)) if score_errors else None
+    return summary
+
+# The representative frames come from the recordings, the rest are held out
+width, height = input_size(args.model)
+calibration, evaluation = split_frames(args.replay, args.eval, args.holdout)
+if args.quantize == 'int8' and not calibration:
+    ap.error('int8 quantization needs representative frames, pass at least one --replay recording')
+
 # Convert the model to TF Lite
-converter = tf.lite.TFLiteConverter.from_saved_model(args.model)
-converter.optimizations = [tf.lite.Optimize.DEFAULT]
-converter.experimental_new_converter = True
-converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+print("[INFO] converting {} with {} quantization...".format(args.model, args.quantize))
+dataset = representative_dataset(spread(calibration, args.calibration_frames), width, height)
+tflite_model = convert(args.model, args.quantize, dataset)
+
+# Save the model to disk. The dynamic range model keeps its original name
+name = 'model.tflite' if args.quantize == 'dynamic' else 'model_{}.tflite'.format(args.quantize)
+output = os.path.join(args.output, name)
+save(tflite_model, output)
+
+# Compare the converted model against the float model on the held out frames
+if not args.no_report and evaluation:
+    reference = os.path.join(args.output, 'model_float32.tflite')
+    save(convert(args.model, 'float32'), reference)
 
-tflite_model = converter.convert()
+    frames = spread(evaluation, args.eval_frames)
+    print("[INFO] comparing against the float model on {} held out frames...".format(len(frames)))
+    summary = dict(report(reference, output, frames, args.threshold, args.threads), model=output, quantize=args.quantize)
+    for key, value in summary.items():
+        print("    {}: {}".format(key, value))
 
-# Save the model to disk
-output = args.output + '/model.tflite'
-with tf.io.gfile.GFile(output, 'wb') as f:
-  f.write(tflite_model)
\ No newline at end of file
+    with open(os.path.join(args.output, 'report_{}.json'.format(args.quantize)), 'w') as f:
+        json.dump(summary, f, indent=2)
+elif not args.no_report:
+    print("[INFO] no held out frames to report on, pass --replay or --eval recordings")
@@ -2,11 +2,16 @@
     Usage: python object_detector.py
 '''
 import os 
+import sys
 import cv2
 import numpy as np
 from imutils.video import FPS
 from config import PATH_TO_LABELS, path_to_cfg, path_to_ckpt
 
+# The scene change gate lives in the src folder, two levels up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from gating import SceneGate
+
 # Suppress TensorFlow logging
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'    
 
@@ -44,16 +49,20 @@ cap = cv2.VideoCapture(0)
 fps = FPS().start()
 print("[INFO] Starting video stream...")
 
+# Reuse the detections while the scene doesn't change, for up to 10 frames
+scene = SceneGate(max_age=10)
+
 while fps._numFrames<800:
     ret, frame = cap.read()
     if not ret:
         break
         
     frame2 = frame
-    frame = np.expand_dims(frame, axis=0)
+    if scene.changed(frame):
+        frame = np.expand_dims(frame, axis=0)
 
-    input_tensor = tf.convert_to_tensor(frame, dtype=tf.float32)
-    (detections, predictions_dict, shapes) = detect(input_tensor)
+        input_tensor = tf.convert_to_tensor(frame, dtype=tf.float32)
+        (detections, predictions_dict, shapes) = detect(input_tensor)
 
     label_id_offset = 1
     frame2 = frame2.copy()
@@ -82,6 +91,7 @@ while fps._numFrames<800:
 fps.stop()
 print("[INFO] elapsed time: {:.2f}".format(fps.elapsed()))
 print("[INFO] approximate fps: {:.2f}".format(fps.fps()))
+print("[INFO] scene gate: {}".format(scene.stats()))
 
 cap.release()
 cv2.destroyAllWindows()
@@ -2,12 +2,17 @@
     Usage: python threaded_object_detection.py
 '''
 import os 
+import sys
 import cv2
 import numpy as np
 from imutils.video import FPS
 from imutils.video import WebcamVideoStream
 from config import PATH_TO_LABELS, path_to_cfg, path_to_ckpt
 
+# The scene change gate lives in the src folder, two levels up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from gating import SceneGate
+
 # Suppress TensorFlow logging
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'    
 
@@ -45,14 +50,18 @@ vs = WebcamVideoStream().start()
 fps = FPS().start()
 print("[INFO] Starting video stream...")
 
+# Reuse the detections while the scene doesn't change, for up to 10 frames
+scene = SceneGate(max_age=10)
+
 while fps._numFrames<800:
     frame = vs.read()
         
     frame2 = frame
-    frame = np.expand_dims(frame, axis=0)
+    if scene.changed(frame):
+        frame = np.expand_dims(frame, axis=0)
 
-    input_tensor = tf.convert_to_tensor(frame, dtype=tf.float32)
-    (detections, predictions_dict, shapes) = detect(input_tensor)
+        input_tensor = tf.convert_to_tensor(frame, dtype=tf.float32)
+        (detections, predictions_dict, shapes) = detect(input_tensor)
 
     label_id_offset = 1
     frame2 = frame2.copy()
@@ -81,6 +90,7 @@ while fps._numFrames<800:
 fps.stop()
 print("[INFO] elapsed time: {:.2f}".format(fps.elapsed()))
 print("[INFO] approximate fps: {:.2f}".format(fps.fps()))
+print("[INFO] scene gate: {}".format(scene.stats()))
 
 cv2.destroyAllWindows()
 vs.stop()
\ No newline at end of file
@@ -0,0 +1,89 @@
+'''
+    Description: Turns a whole depth frame into a per-column nearest obstacle profile
+                 and a polar (bearing x distance) occupancy histogram with a few
+                 vectorized numpy operations, plus the coverage grid used by the
+                 ASCII depth viewer
+'''
+
+from realsense import depth_array
+import numpy as np
+
+# Horizontal field of view of the D415 depth stream, used when no calibration
+# is available to work out the bearing of each column
+D415_DEPTH_HFOV = np.radians(65)
+
+class ObstacleMap:
+    def __init__(self, width=640, height=480, intrinsics=None, rows=None, step=4,
+                 bearing_bins=16, distance_edges=(0.5, 1.0, 1.5, 2.0, 3.0, 4.0), max_distance=4.0):
+        # Only the band of rows between rows[0] and rows[1] is considered, which
+        # keeps the floor at the bottom of the frame out of the map. Every step-th
+        # row and column is used
+        self.width = width
+        self.height = height
+        self.rows = rows if rows is not None else (height // 4, 3 * height // 4)
+        self.step = step
+        self.max_distance = max_distance
+
+        # Bearing (radians, positive to the right) of every sampled column
+        if intrinsics is not None:
+            fx, ppx = intrinsics["fx"], intrinsics["ppx"]
+        else:
+            fx, ppx = width / 2 / np.tan(D415_DEPTH_HFOV / 2), width / 2
+        self.columns = np.arange(0, width, step)
+        self.bearings = np.arctan((self.columns - ppx) / fx)
+
+        # Bearing bin of every sampled column and the distance bin edges in metres
+        edges = np.linspace(self.bearings[0], self.bearings[-1], bearing_bins + 1)
+        self.bearing_edges = edges
+        self.column_bins = np.clip(np.searchsorted(edges, self.bearings, side="right") - 1, 0, bearing_bins - 1)
+        self.distance_edges = np.asarray(distance_edges, dtype=np.float32)
+        self.bearing_bins = bearing_bins
+
+        # Results of the last update
+        self.nearest = np.full(width, max_distance * 100, dtype=np.float32)
+        self.histogram = np.zeros((bearing_bins, len(distance_edges) + 1), dtype=np.int32)
+        self.free_space = np.full(bearing_bins, max_distance, dtype=np.float32)
+
+    def update(self, depth):
+        # Slice the band of rows and convert it to metres
+        image, scale = depth_array(depth)
+        band = image[self.rows[0]:self.rows[1]:self.step, ::self.step]
+        metres = band * np.float32(scale)
+
+        # Nearest valid obstacle in every sampled column. Columns without any
+        # valid depth are treated as free up to the maximum distance
+        valid = band > 0
+        nearest = np.where(valid, metres, self.max_distance).min(axis=0)
+        np.minimum(nearest, self.max_distance, out=nearest)
+
+        # Spread the sampled columns back over the full frame width, in cm
+        self.nearest[:] = np.repeat(nearest * 100, self.step)[:self.width]
+
+        # Free space in each bearing bin is the nearest obstacle among its columns
+        self.free_space[:] = self.max_distance
+        np.minimum.at(self.free_space, self.column_bins, nearest)
+
+        # Polar occupancy histogram of the valid pixels, binned by bearing and distance
+        distance_bins = np.searchsorted(self.distance_edges, metres[valid])
+        bearing_bins = np.broadcast_to(self.column_bins, band.shape)[valid]
+        counts = np.bincount(bearing_bins * self.histogram.shape[1] + distance_bins,
+                             minlength=self.histogram.size)
+        self.histogram[:] = counts.reshape(self.histogram.shape)
+
+        return self
+
+    def column_distances(self, x1, x2, nearest=None):
+        # Nearest obstacle (cm) in each column between x1 and x2, as a view of the
+        # last update or of a copy of nearest taken earlier
+        x1, x2 = max(x1, 0), min(x2, self.width)
+        return (self.nearest if nearest is None else nearest)[x1:x2]
+
+def coverage(depth, max_distance=1.0, cell=(20, 10)):
+    # Number of pixels in each (rows x cols) cell that are closer than the given
+    # distance in metres
+    image, scale = depth_array(depth)
+    ch, cw = cell
+    h, w = image.shape[0] // ch, image.shape[1] // cw
+    near = (image[:h*ch, :w*cw] > 0) & (image[:h*ch, :w*cw] < max_distance / scale)
+
+    return near.reshape(h, ch, w, cw).sum(axis=(1, 3))
@@ -0,0 +1,185 @@
+'''
+    Description: Staged processing pipeline. Each stage runs on its own thread and
+                 hands its results to the next one through a small bounded queue
+                 that drops the oldest item when it is full, so a slow stage works
+                 on the newest frame instead of falling behind. Sources that can
+                 produce frames as fast as they are asked, like a replay, get
+                 blocking queues instead so that no frame is dropped. Every queue
+                 and stage keeps the metrics needed to find the bottleneck
+'''
+
+from threading import Thread, Condition
+from collections import deque
+import numpy as np
+import time
+
+class LatestQueue:
+    # Bounded hand-off between two stages. When the queue is full the oldest item
+    # is dropped and passed to on_drop, so that its buffers can be reused. With
+    # block set, put() waits for room instead, which pushes back on the producer
+    def __init__(self, maxsize=1, on_drop=None, block=False):
+        self.condition = Condition()
+        self.items = deque()
+        self.maxsize = maxsize
+        self.on_drop = on_drop
+        self.block = block
+        self.closed = False
+
+        # Items put, items dropped and the largest depth seen
+        self.put_count = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    def put(self, item):
+        dropped = None
+        with self.condition:
+            if self.block:
+                self.condition.wait_for(lambda: len(self.items) < self.maxsize or self.closed)
+            if len(self.items) >= self.maxsize:
+                dropped = self.items.popleft()
+                self.dropped += 1
+            self.items.append(item)
+            self.put_count += 1
+            self.max_depth = max(self.max_depth, len(self.items))
+            self.condition.notify_all()
+
+        if dropped is not None and self.on_drop is not None:
+            self.on_drop(dropped)
+
+    def get(self, timeout=None):
+        # Oldest item in the queue, or None if the queue was closed or nothing
+        # arrived before the timeout
+        with self.condition:
+            self.condition.wait_for(lambda: self.items or self.closed, timeout)
+            if not self.items:
+                return None
+            item = self.items.popleft()
+            self.condition.notify_all()
+            return item
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __len__(self):
+        with self.condition:
+            return len(self.items)
+
+    def stats(self):
+        with self.condition:
+            return {"depth": len(self.items), "max_depth": self.max_depth,
+                    "put": self.put_count, "dropped": self.dropped}
+
+class Stage:
+    def __init__(self, name, func, window=200):
+        # func takes the item from the previous stage and returns the item for
+        # the next one, or None to drop it. The latency of the last `window`
+        # items is kept
+        self.name = name
+        self.func = func
+        self.latencies = deque(maxlen=window)
+        self.processed = 0
+
+    def __call__(self, item):
+        start = time.perf_counter()
+        result = self.func(item)
+        self.latencies.append(time.perf_counter() - start)
+        self.processed += 1
+        return result
+
+    def stats(self):
+        latencies = np.asarray(self.latencies or [0]) * 1000
+        return {"processed": self.processed, "mean_ms": float(latencies.mean()),
+                "p95_ms": float(np.percentile(latencies, 95))}
+
+class Pipeline:
+    def __init__(self, source, stages, maxsize=1, release=None, block=False):
+        # source() returns the next item, None to try again or raises StopIteration
+        # at the end of the input. stages is a list of (name, func) pairs. Every
+        # item that leaves the pipeline, because it was dropped, filtered out or
+        # went through the last stage, is passed to release. block makes every
+        # stage wait for the next one instead of dropping, for sources that
+        # aren't paced by a camera
+        self.source = source
+        self.stages = [Stage(name, func) for name, func in stages]
+        self.release = release
+        self.queues = [LatestQueue(maxsize, on_drop=self._release, block=block) for _ in self.stages]
+        self.threads = []
+        self.stopped = False
+
+        # End-to-end throughput
+        self.start_time = None
+        self.end_time = None
+        self.completed = 0
+
+    def _release(self, item):
+        if self.release is not None:
+            self.release(item)
+
+    def _capture(self):
+        while not self.stopped:
+            try:
+                item = self.source()
+            except StopIteration:
+                break
+            if item is not None:
+                self.queues[0].put(item)
+
+        self.queues[0].close()
+
+    def _work(self, i):
+        stage, queue = self.stages[i], self.queues[i]
+        last = i == len(self.stages) - 1
+        while True:
+            item = queue.get(timeout=0.1)
+            if item is None:
+                if queue.closed and not len(queue):
+                    break
+                continue
+
+            result = stage(item)
+            if result is None or last:
+                self._release(item)
+                if last and result is not None:
+                    self.completed += 1
+                continue
+            self.queues[i + 1].put(result)
+
+        # Let the next stage finish what it has queued and then stop
+        if not last:
+            self.queues[i + 1].close()
+        else:
+            self.end_time = time.perf_counter()
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.threads = [Thread(target=self._capture, daemon=True)]
+        self.threads += [Thread(target=self._work, args=(i,), daemon=True) for i in range(len(self.stages))]
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def join(self, timeout=None):
+        # Wait for the source to run out and every stage to drain
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def running(self):
+        return any(thread.is_alive() for thread in self.threads)
+
+    def stop(self):
+        self.stopped = True
+        self.join()
+
+    def stats(self):
+        # Per stage latency and input queue metrics, and the end-to-end rate with
+        # the number of items that made it through and that were dropped on the way
+        end = self.end_time or time.perf_counter()
+        elapsed = end - self.start_time if self.start_time else 0
+        stats = {stage.name: dict(stage.stats(), queue=queue.stats())
+                 for stage, queue in zip(self.stages, self.queues)}
+        stats["throughput"] = self.completed / elapsed if elapsed else 0.0
+        stats["completed"] = self.completed
+        stats["dropped"] = sum(queue.dropped for queue in self.queues)
+        return stats
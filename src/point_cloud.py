@@ -0,0 +1,140 @@
+'''
+    Description: Vectorized depth to point cloud deprojection with precomputed ray
+                 tables, RANSAC ground plane fitting and an above-ground obstacle
+                 mask. Camera coordinates follow librealsense: x right, y down and
+                 z forward, in metres
+'''
+
+from realsense import ArrayFrame, depth_array
+import numpy as np
+import time
+
+# The camera is worn upright, so the floor normal points roughly along -y
+UP = np.array([0.0, -1.0, 0.0], dtype=np.float32)
+
+class PointCloud:
+    def __init__(self, intrinsics, step=4):
+        # Ray through every step-th pixel of the depth image, so that a pixel at
+        # depth z deprojects to (z*ray_x, z*ray_y, z)
+        self.step = step
+        v, u = np.mgrid[0:intrinsics["height"]:step, 0:intrinsics["width"]:step]
+        self.ray_x = ((u - intrinsics["ppx"]) / intrinsics["fx"]).astype(np.float32)
+        self.ray_y = ((v - intrinsics["ppy"]) / intrinsics["fy"]).astype(np.float32)
+        self.shape = u.shape
+
+    def deproject(self, depth):
+        # Return the (h, w, 3) points of the decimated grid and its valid mask
+        image, scale = depth_array(depth)
+        z = image[::self.step, ::self.step] * np.float32(scale)
+        points = np.dstack([z * self.ray_x, z * self.ray_y, z])
+
+        return points, z > 0
+
+class GroundPlane:
+    def __init__(self, threshold=0.04, max_tilt=35, iterations=128, batch=32,
+                 samples=2000, budget=0.005, seed=0):
+        # Inlier distance (m), largest allowed angle between the plane normal and
+        # UP (degrees), the maximum number of RANSAC hypotheses, how many of them
+        # are scored per batch, the number of points they are scored on and the
+        # time budget (s) after which fitting stops with the best plane so far
+        self.threshold = threshold
+        self.min_cos = np.cos(np.radians(max_tilt))
+        self.iterations = iterations
+        self.batch = batch
+        self.samples = samples
+        self.budget = budget
+        self.rng = np.random.RandomState(seed)
+
+        # Last fitted plane as (normal, offset) with normal.p + offset = height
+        # above the ground, and the time the last fit took
+        self.plane = None
+        self.elapsed = 0.0
+
+    def _hypotheses(self, points):
+        # Planes through random triples of points, oriented to face up. Planes
+        # that are degenerate or too steep to be the floor are dropped
+        triples = points[self.rng.randint(0, len(points), size=(self.batch, 3))]
+        normals = np.cross(triples[:, 1] - triples[:, 0], triples[:, 2] - triples[:, 0])
+        length = np.linalg.norm(normals, axis=1)
+        keep = length > 1e-9
+        normals = normals[keep] / length[keep, None]
+        normals *= np.sign(normals @ UP)[:, None]
+        offsets = -np.einsum("ij,ij->i", normals, triples[keep, 0])
+
+        flat = normals @ UP > self.min_cos
+        return normals[flat], offsets[flat]
+
+    def fit(self, points):
+        # Fit the ground plane to an Nx3 array of valid points
+        start = time.perf_counter()
+        if len(points) < 3:
+            return self.plane
+        subset = points[self.rng.randint(0, len(points), size=min(self.samples, len(points)))]
+
+        # The previous plane is scored alongside the new hypotheses so that the
+        # estimate stays stable when the budget only allows a few of them
+        best, best_score = self.plane, -1
+        if self.plane is not None:
+            best_score = np.count_nonzero(np.abs(subset @ self.plane[0] + self.plane[1]) < self.threshold)
+
+        tried = 0
+        while tried < self.iterations and time.perf_counter() - start < self.budget:
+            normals, offsets = self._hypotheses(points)
+            tried += self.batch
+            if len(normals) == 0:
+                continue
+
+            # Score every hypothesis of the batch in one matrix product
+            scores = np.count_nonzero(np.abs(subset @ normals.T + offsets) < self.threshold, axis=0)
+            i = np.argmax(scores)
+            if scores[i] > best_score:
+                best, best_score = (normals[i], offsets[i]), scores[i]
+
+        # Refine the best plane with a least squares fit to its inliers
+        if best is not None:
+            inliers = subset[np.abs(subset @ best[0] + best[1]) < self.threshold]
+            if len(inliers) >= 3:
+                centroid = inliers.mean(axis=0)
+                normal = np.linalg.svd(inliers - centroid, full_matrices=False)[2][-1]
+                normal *= np.sign(normal @ UP)
+                if normal @ UP > self.min_cos:
+                    best = (normal.astype(np.float32), np.float32(-normal @ centroid))
+
+        self.plane = best
+        self.elapsed = time.perf_counter() - start
+        return self.plane
+
+class GroundObstacles:
+    def __init__(self, intrinsics, step=4, min_height=0.1, max_height=2.0,
+                 max_distance=4.0, ground=None):
+        # Points between min_height and max_height above the fitted floor and
+        # closer than max_distance are treated as obstacles
+        self.cloud = PointCloud(intrinsics, step)
+        self.ground = ground if ground is not None else GroundPlane()
+        self.step = step
+        self.min_height = min_height
+        self.max_height = max_height
+        self.max_distance = max_distance
+
+        # Results of the last update on the decimated grid
+        self.mask = np.zeros(self.cloud.shape, dtype=bool)
+        self.obstacle_frame = ArrayFrame(np.zeros(self.cloud.shape, dtype=np.uint16))
+
+    def update(self, depth):
+        image, scale = depth_array(depth)
+        points, valid = self.cloud.deproject(depth)
+        in_range = valid & (points[..., 2] < self.max_distance)
+        plane = self.ground.fit(points[in_range])
+
+        # Without a ground estimate every valid point in range is an obstacle
+        if plane is None:
+            self.mask = in_range
+        else:
+            height = points @ plane[0] + plane[1]
+            self.mask = in_range & (height > self.min_height) & (height < self.max_height)
+
+        # Depth of the obstacle points only, with the floor and everything out of
+        # range turned into holes
+        grid = image[::self.step, ::self.step]
+        self.obstacle_frame = ArrayFrame(np.where(self.mask, grid, 0).astype(np.uint16), scale)
+        return self.mask
@@ -5,29 +5,76 @@
             
 '''
 
-import pyrealsense2.pyrealsense2 as rs
-from threading import Thread
+from threading import Thread, Lock, Condition
+from collections import namedtuple
 import numpy as np
+import time
+import cv2
+
+# The Raspberry Pi build of librealsense nests the bindings one level deeper
+# than the Windows wheel. Neither is required for the array based utilities
+try:
+    import pyrealsense2.pyrealsense2 as rs
+except ImportError:
+    try:
+        import pyrealsense2 as rs
+    except ImportError:
+        rs = None
+
+# Size of one z16 depth unit in metres on the D415
+DEPTH_SCALE = 0.001
+
+# Resolution, frame rate and pixel format (the name of an rs.format member) of
+# one camera stream
+StreamProfile = namedtuple("StreamProfile", ["width", "height", "fps", "format"])
 
 class RealSense:
-    def __init__(self, width=640, height=480):
-        # Frame dimensions of camera
-        self.width = width
-        self.height = height
+    def __init__(self, width=640, height=480, history=0, filters=None, integral=False,
+                 depth_profile=None, color_profile=None):
+        # Both streams default to the same resolution at 30 fps. The depth stream
+        # can be given a higher rate and lower resolution than the color stream so
+        # that the depth checks run faster than the detector
+        self.depth_profile = depth_profile or StreamProfile(width, height, 30, "z16")
+        self.color_profile = color_profile or StreamProfile(width, height, 30, "bgr8")
+
+        # Frame dimensions of the depth and color streams
+        self.width, self.height = self.depth_profile.width, self.depth_profile.height
+        self.color_width, self.color_height = self.color_profile.width, self.color_profile.height
+
+        # Build the summed area tables of every depth frame on the capture thread
+        self.integral = integral
+
+        # Optional DepthFilterChain that is run on the capture thread
+        self.filters = filters
+        self.manual_filters = None
+
+        # Optionally keep the last few depth frames for temporal denoising. The
+        # history is sized from the first filtered frame, which decimation shrinks
+        self.history_length = history
+        self.history = None
 
         # Build and enable the depth and color frames
         self.pipeline = rs.pipeline()
         self.config = rs.config()
-        self.config.enable_stream(rs.stream.depth, self.width, self.height, rs.format.z16, 30)
-        self.config.enable_stream(rs.stream.color, self.width, self.height, rs.format.bgr8, 30)
+        for stream, profile in [(rs.stream.depth, self.depth_profile), (rs.stream.color, self.color_profile)]:
+            self.config.enable_stream(stream, profile.width, profile.height,
+                                      getattr(rs.format, profile.format), profile.fps)
 
         # Start streaming
-        self.pipeline.start(self.config)
+        self.profile = self.pipeline.start(self.config)
         
-        # Read the first frame from the stream
-        self.frame = self.pipeline.wait_for_frames()
-        self.depth_frame = self.frame.get_depth_frame()
-        self.color_frame = self.frame.get_color_frame()
+        # Every depth frame is published on the depth slot, and every new color
+        # frame is published on the main slot together with the latest depth frame
+        self.slot = FrameSlot()
+        self.depth_slot = FrameSlot()
+        self.depth = None
+        self.color_number = None
+
+        # Publish the first complete frameset from the stream. Everything that
+        # consumes the depth frames is sized from the published, filtered frame
+        while self.slot.seq == 0:
+            self.publish(self.pipeline.wait_for_frames())
+        self.width, self.height = self.depth[0].get_width(), self.depth[0].get_height()
         
         # Variable to check if thread should be stopped
         self.stopped = False
@@ -37,6 +84,31 @@ class RealSense:
         Thread(target=self.update, args=()).start()
         return self
 
+    def publish(self, frame):
+        # When the streams run at different rates the framesets only contain the
+        # frames that arrived since the previous one, so either stream can be missing
+        depth_frame = frame.get_depth_frame()
+        color_frame = frame.get_color_frame()
+
+        if depth_frame:
+            if self.filters is not None:
+                depth_frame = self.filters.process(depth_frame)
+            if self.history_length and self.history is None:
+                self.history = DepthHistory(self.history_length, depth_frame.get_width(), depth_frame.get_height())
+            if self.history is not None:
+                self.history.push(depth_frame)
+            integral = DepthIntegral(depth_frame) if self.integral else None
+            self.depth = (depth_frame, integral)
+            self.depth_slot.publish(None, depth_frame, integral=integral)
+
+        # Hand each color frame to the consumers once, paired with the depth frame
+        # closest to it
+        if not color_frame or self.depth is None or color_frame.get_frame_number() == self.color_number:
+            return False
+        self.color_number = color_frame.get_frame_number()
+        self.slot.publish(color_frame, self.depth[0], integral=self.depth[1])
+        return True
+
     def update(self):
         while True:
             # Stop streaming in indicator is set
@@ -44,52 +116,492 @@ class RealSense:
                 return
 
             # Otherwise read the next frame in the stream
-            self.frame = self.pipeline.wait_for_frames()
-            self.depth_frame = self.frame.get_depth_frame()
-            self.color_frame = self.frame.get_color_frame()
-            
-            if not self.depth_frame or not self.color_frame:
-                return
+            self.publish(self.pipeline.wait_for_frames())
+
+    def read(self, wait_newer_than=None, timeout=None):
+        # Return the most recent (color, depth) frameset. If a sequence number is
+        # given, block until a newer frameset arrives or the timeout expires
+        return self.slot.get(wait_newer_than=wait_newer_than, timeout=timeout)
 
-    def read(self):
-        # Return the most recent color and depth frame
-        return self.color_frame, self.depth_frame
+    def read_depth(self, wait_newer_than=None, timeout=None):
+        # Same as read() for the depth-only framesets, which arrive at the depth
+        # stream rate and have no color frame
+        return self.depth_slot.get(wait_newer_than=wait_newer_than, timeout=timeout)
     
     def filter_depth(self, depth):
-        # Apply post processing filters to depth image
-        spat_filter = rs.spatial_filter()
-        temp_filter = rs.temporal_filter()
-        depth = spat_filter.process(depth)
-        depth = temp_filter.process(depth)
+        # Apply the spatial and temporal post processing filters to a depth frame.
+        # The chain is only built once so the temporal filter keeps its history
+        if self.manual_filters is None:
+            self.manual_filters = DepthFilterChain(threshold=None, hole_filling=False)
         
-        return depth.as_depth_frame()
+        return self.manual_filters.process(depth)
+
+    def get_calibration(self):
+        # Intrinsics of both streams, the depth to color extrinsics and the depth
+        # scale as a plain dict so that they can be stored alongside recordings
+        depth_profile = self.profile.get_stream(rs.stream.depth).as_video_stream_profile()
+        color_profile = self.profile.get_stream(rs.stream.color).as_video_stream_profile()
+        extrinsics = depth_profile.get_extrinsics_to(color_profile)
+
+        # The depth intrinsics are those of the published frames, so they are
+        # scaled along with the frames when the filters decimate them
+        return {
+            "depth_scale": self.profile.get_device().first_depth_sensor().get_depth_scale(),
+            "depth_intrinsics": scale_intrinsics(intrinsics_to_dict(depth_profile.get_intrinsics()), self.width, self.height),
+            "color_intrinsics": intrinsics_to_dict(color_profile.get_intrinsics()),
+            "depth_to_color": {
+                # Column major 3x3 rotation, as librealsense stores it
+                "rotation": list(extrinsics.rotation),
+                "translation": list(extrinsics.translation),
+            },
+        }
 
     def stop(self)        :
-        # Stop the video stream
+        # Stop the video stream and wake up any blocked consumers
         self.stopped = True
+        self.slot.close()
+        self.depth_slot.close()
         self.pipeline.stop()
 
-def filter_distance(depth_frame, x, y):
-    #List to store the consecutive distance values and randomly initialized variable
-    distances = []
-    positive = np.random.randint(low=30, high=100)
+class Frameset(tuple):
+    # (color, depth) pair published through a FrameSlot. It unpacks like the tuple
+    # that read() has always returned, but also carries the sequence number, the
+    # monotonic time at which the frameset was captured and, if the capture
+    # thread built one, the DepthIntegral of the depth frame
+    def __new__(cls, color, depth, seq, timestamp, integral=None):
+        frameset = tuple.__new__(cls, (color, depth))
+        frameset.seq = seq
+        frameset.timestamp = timestamp
+        frameset.integral = integral
+        return frameset
 
-    i = 0
-    while(i < 50):
-        # Extract the depth value from the camera
-        dist = int(depth_frame.get_distance(x, y) * 100)
-        
-        # Store the last positive value for use in the event that the
-        # value returned is 0
-        if dist != 0:
-            positive = dist
-        elif dist == 0:
-            positive == positive
-
-        # Add the distances to the list
-        distances.append(positive)
-        i += 1
-
-    # Convert the list to a numpy array and return it
-    distances = np.asarray(distances)
-    return int(distances.mean())
\ No newline at end of file
+    @property
+    def color(self):
+        return self[0]
+
+    @property
+    def depth(self):
+        return self[1]
+
+class FrameSlot:
+    # Latest-frame-wins hand-off between a capture thread and its consumers. Each
+    # frameset is published atomically with an increasing sequence number so that
+    # consumers never see a torn pair and can wait for a frame they haven't seen
+    def __init__(self):
+        self.condition = Condition()
+        self.frameset = None
+        self.seq = 0
+        self.closed = False
+
+        # Highest sequence number handed out so far, framesets that were replaced
+        # before anyone read them and reads that returned an already seen frameset
+        self.delivered = 0
+        self.dropped = 0
+        self.duplicates = 0
+
+    def publish(self, color, depth, timestamp=None, integral=None):
+        with self.condition:
+            if self.frameset is not None and self.delivered < self.seq:
+                self.dropped += 1
+
+            self.seq += 1
+            self.frameset = Frameset(color, depth, self.seq,
+                                     time.monotonic() if timestamp is None else timestamp, integral)
+            self.condition.notify_all()
+            return self.seq
+
+    def get(self, wait_newer_than=None, timeout=None):
+        # Return the latest frameset, or None if the slot was closed or no newer
+        # frameset arrived before the timeout
+        with self.condition:
+            if wait_newer_than is not None:
+                self.condition.wait_for(lambda: self.seq > wait_newer_than or self.closed, timeout)
+                if self.seq <= wait_newer_than:
+                    return None
+            elif self.closed or self.frameset is None:
+                return None
+
+            frameset = self.frameset
+            if frameset.seq <= self.delivered:
+                self.duplicates += 1
+            self.delivered = max(self.delivered, frameset.seq)
+            return frameset
+
+    def close(self):
+        # Wake every waiting consumer, no further framesets will be published
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {"published": self.seq, "dropped": self.dropped, "duplicates": self.duplicates}
+
+def intrinsics_to_dict(intrinsics):
+    # Convert librealsense intrinsics to a JSON serializable dict
+    return {
+        "width": intrinsics.width,
+        "height": intrinsics.height,
+        "fx": intrinsics.fx,
+        "fy": intrinsics.fy,
+        "ppx": intrinsics.ppx,
+        "ppy": intrinsics.ppy,
+        "model": str(intrinsics.model),
+        "coeffs": list(intrinsics.coeffs),
+    }
+
+def scale_intrinsics(intrinsics, width, height):
+    # Intrinsics of a stream resized to width x height, like after decimation
+    sx, sy = width / intrinsics["width"], height / intrinsics["height"]
+    if sx == 1 and sy == 1:
+        return intrinsics
+
+    return dict(intrinsics, width=width, height=height, fx=intrinsics["fx"] * sx, fy=intrinsics["fy"] * sy,
+                ppx=intrinsics["ppx"] * sx, ppy=intrinsics["ppy"] * sy)
+
+class ArrayFrame:
+    # Minimal stand-in for a librealsense frame that is backed by a numpy array
+    # so that the depth utilities can run on recorded or synthetic data
+    def __init__(self, data, depth_scale=DEPTH_SCALE):
+        self.data = data
+        self.depth_scale = depth_scale
+
+    def get_data(self):
+        return self.data
+
+    def get_width(self):
+        return self.data.shape[1]
+
+    def get_height(self):
+        return self.data.shape[0]
+
+    def get_units(self):
+        return self.depth_scale
+
+    def get_distance(self, x, y):
+        return float(self.data[y, x]) * self.depth_scale
+
+def depth_array(depth):
+    # Return the raw z16 depth image and the scale that converts it to metres.
+    # Accepts a librealsense depth frame, an ArrayFrame or a plain numpy array
+    if isinstance(depth, np.ndarray):
+        return depth, DEPTH_SCALE
+
+    return np.asanyarray(depth.get_data()), depth.get_units()
+
+def sample_distance(depth, x, y, ksize=5, percentile=50, fill=0):
+    # Get the depth image and clip the kxk window around the point to the frame
+    image, scale = depth_array(depth)
+    H, W = image.shape[:2]
+    r = ksize // 2
+    window = image[max(y-r, 0):min(y+r+1, H), max(x-r, 0):min(x+r+1, W)]
+
+    # Zero pixels are holes in the depth map so they are left out of the statistic.
+    # If the whole window is a hole the fill value is returned instead
+    valid = window[window > 0]
+    if valid.size == 0:
+        return fill
+
+    # Sorting the few values in the window in place is much cheaper than
+    # np.percentile. Return the distance in centimetres
+    valid.sort()
+    value = valid[int((valid.size - 1) * percentile / 100 + 0.5)]
+    return int(value * scale * 100)
+
+def robust_percentile(values, percentile):
+    # Take the percentile of each row of raw depth values while ignoring zero holes.
+    # Holes are pushed to the end of each row by the sort so that only the valid
+    # prefix of the row is indexed
+    counts = np.count_nonzero(values, axis=1)
+    ordered = np.where(values > 0, values, np.iinfo(np.uint16).max)
+    ordered.sort(axis=1)
+    idx = ((np.maximum(counts, 1) - 1) * (percentile / 100) + 0.5).astype(np.intp)
+
+    return np.take_along_axis(ordered, idx[:, None], axis=1)[:, 0], counts
+
+def _to_centimetres(raw, counts, scale, fill):
+    # Convert raw depth units to integer centimetres and fill the empty windows
+    distances = (raw * (scale * 100)).astype(np.int32)
+    distances[counts == 0] = fill
+
+    return distances
+
+def sample_distances(depth, points, ksize=5, percentile=50, fill=0):
+    # Robust distance (cm) for an Nx2 array of (x, y) points in one pass over the
+    # depth image. Windows that run off the frame are clamped to its border
+    image, scale = depth_array(depth)
+    H, W = image.shape[:2]
+    points = np.asarray(points, dtype=np.intp).reshape(-1, 2)
+
+    # Gather the kxk window around every point into an N x k*k array
+    offsets = np.arange(ksize) - ksize // 2
+    xs = np.clip(points[:, 0, None, None] + offsets[None, None, :], 0, W-1)
+    ys = np.clip(points[:, 1, None, None] + offsets[None, :, None], 0, H-1)
+    values = image[ys, xs].reshape(len(points), ksize*ksize)
+
+    raw, counts = robust_percentile(values, percentile)
+    return _to_centimetres(raw, counts, scale, fill)
+
+def box_distances(depth, boxes, grid=7, shrink=0.5, percentile=50, fill=0):
+    # Robust distance (cm) for an Nx4 array of (x1, y1, x2, y2) pixel boxes. Each
+    # box is sampled on a grid x grid lattice covering its central region, which
+    # keeps the background around the edges of the box out of the statistic
+    image, scale = depth_array(depth)
+    H, W = image.shape[:2]
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+
+    # Centre and half size of the sampled region of each box
+    cx = (boxes[:, 0] + boxes[:, 2]) / 2
+    cy = (boxes[:, 1] + boxes[:, 3]) / 2
+    hw = (boxes[:, 2] - boxes[:, 0]) * shrink / 2
+    hh = (boxes[:, 3] - boxes[:, 1]) * shrink / 2
+
+    # Gather the lattice of every box into an N x grid*grid array
+    steps = np.linspace(-1, 1, grid, dtype=np.float32)
+    xs = np.clip(np.rint(cx[:, None] + hw[:, None]*steps), 0, W-1).astype(np.intp)
+    ys = np.clip(np.rint(cy[:, None] + hh[:, None]*steps), 0, H-1).astype(np.intp)
+    values = image[ys[:, :, None], xs[:, None, :]].reshape(len(boxes), grid*grid)
+
+    raw, counts = robust_percentile(values, percentile)
+    return _to_centimetres(raw, counts, scale, fill)
+
+def filter_distance(depth_frame, x, y, ksize=5, percentile=50):
+    # Robust distance (cm) at a point, taken as the median of the valid depth
+    # values in the window around it. Holes give a distance of 0
+    return sample_distance(depth_frame, x, y, ksize=ksize, percentile=percentile)
+
+class DepthHistory:
+    # Ring buffer of the last `length` z16 depth frames, stored in one preallocated
+    # array so that temporal statistics over the frames cost a single reduction.
+    # Memory use is fixed at length*height*width*2 bytes
+    def __init__(self, length=5, width=640, height=480, depth_scale=DEPTH_SCALE):
+        self.length = length
+        self.depth_scale = depth_scale
+        self.frames = np.zeros((length, height, width), dtype=np.uint16)
+
+        # Total number of frames pushed, the newest frame sits at (count-1) % length
+        self.count = 0
+        self.lock = Lock()
+
+    @property
+    def nbytes(self):
+        return self.frames.nbytes
+
+    def push(self, depth):
+        # Copy the depth frame into the oldest slot of the buffer
+        image, self.depth_scale = depth_array(depth)
+        with self.lock:
+            np.copyto(self.frames[self.count % self.length], image)
+            self.count += 1
+
+    def window(self, roi=None):
+        # Copy out the (x1, y1, x2, y2) region of every filled frame so that the
+        # statistics are computed without holding up the capture thread
+        x1, y1, x2, y2 = roi if roi is not None else (0, 0, self.frames.shape[2], self.frames.shape[1])
+        with self.lock:
+            return self.frames[:min(self.count, self.length), y1:y2, x1:x2].copy()
+
+    def median(self, roi=None):
+        # Per-pixel temporal median (raw depth units) ignoring holes. Pixels that
+        # were a hole in every frame stay 0
+        values = self.window(roi)
+        n, h, w = values.shape
+        if n == 0:
+            return np.zeros((h, w), dtype=np.uint16)
+        raw, counts = robust_percentile(values.reshape(n, h*w).T, 50)
+        raw[counts == 0] = 0
+
+        return raw.reshape(h, w)
+
+    def mean(self, roi=None):
+        # Per-pixel temporal mean (raw depth units) ignoring holes
+        values = self.window(roi)
+        counts = np.count_nonzero(values, axis=0)
+        total = values.sum(axis=0, dtype=np.float32)
+
+        return np.divide(total, counts, out=np.zeros_like(total), where=counts > 0)
+
+    def distance(self, x, y, ksize=5, percentile=50, fill=0):
+        # Robust distance (cm) at a point over a kxk window and every frame in
+        # the buffer
+        r = ksize // 2
+        values = self.window((max(x-r, 0), max(y-r, 0), x+r+1, y+r+1))
+        if values.size == 0:
+            return fill
+        raw, counts = robust_percentile(values.reshape(1, -1), percentile)
+
+        return int(_to_centimetres(raw, counts, self.depth_scale, fill)[0])
+
+class DepthFilterChain:
+    # Depth post processing that is built once and kept for the lifetime of the
+    # stream: decimation, threshold, spatial, temporal and hole filling, in the
+    # order librealsense recommends. Frames from the camera go through the
+    # librealsense filters, arrays and ArrayFrames through the numpy versions
+    def __init__(self, decimation=1, threshold=(0.1, 4.0), spatial=(0.5, 20),
+                 temporal=(0.4, 20), hole_filling=True, backend="auto"):
+        # A stage is disabled by passing None/False/1. Spatial and temporal take
+        # (alpha, delta) with delta in depth units, threshold takes metres.
+        # Decimation changes the frame size, so it is off by default
+        self.decimation = decimation
+        self.threshold = threshold
+        self.spatial = spatial
+        self.temporal = temporal
+        self.hole_filling = hole_filling
+        self.backend = backend
+
+        # State of the numpy temporal filter and the librealsense filter objects
+        self.previous = None
+        self.rs_filters = None
+
+    def _build_rs_filters(self):
+        filters = []
+        if self.decimation > 1:
+            decimation = rs.decimation_filter()
+            decimation.set_option(rs.option.filter_magnitude, self.decimation)
+            filters.append(decimation)
+        if self.threshold:
+            filters.append(rs.threshold_filter(*self.threshold))
+        if self.spatial:
+            spatial = rs.spatial_filter()
+            spatial.set_option(rs.option.filter_smooth_alpha, self.spatial[0])
+            spatial.set_option(rs.option.filter_smooth_delta, self.spatial[1])
+            filters.append(spatial)
+        if self.temporal:
+            temporal = rs.temporal_filter()
+            temporal.set_option(rs.option.filter_smooth_alpha, self.temporal[0])
+            temporal.set_option(rs.option.filter_smooth_delta, self.temporal[1])
+            filters.append(temporal)
+        if self.hole_filling:
+            filters.append(rs.hole_filling_filter())
+
+        return filters
+
+    def output_size(self, width, height):
+        # Size of the frames the numpy chain outputs for width x height input
+        return width // self.decimation, height // self.decimation
+
+    def use_rs(self, depth):
+        if self.backend == "auto":
+            return rs is not None and not isinstance(depth, (np.ndarray, ArrayFrame))
+        return self.backend == "rs"
+
+    def process(self, depth):
+        # Run the enabled stages and return the filtered depth frame
+        if self.use_rs(depth):
+            if self.rs_filters is None:
+                self.rs_filters = self._build_rs_filters()
+            for f in self.rs_filters:
+                depth = f.process(depth)
+            return depth.as_depth_frame()
+
+        image, scale = depth_array(depth)
+        if self.decimation > 1:
+            image = decimate(image, self.decimation)
+        else:
+            image = image.copy()
+        if self.threshold:
+            lo, hi = (int(t / scale) for t in self.threshold)
+            image[(image < lo) | (image > hi)] = 0
+        if self.spatial:
+            image = spatial_smooth(image, *self.spatial)
+        if self.temporal:
+            image = self._temporal_smooth(image, *self.temporal)
+        if self.hole_filling:
+            image = fill_holes(image)
+
+        return ArrayFrame(image, scale)
+
+    def _temporal_smooth(self, image, alpha, delta):
+        # Exponential moving average over frames that resets wherever the depth
+        # jumps by more than delta. Holes keep the last valid value
+        if self.previous is None or self.previous.shape != image.shape:
+            self.previous = image.astype(np.float32)
+            return image
+
+        current = image.astype(np.float32)
+        valid = image > 0
+        smooth = valid & (self.previous > 0) & (np.abs(current - self.previous) < delta)
+        np.copyto(self.previous, current, where=valid & ~smooth)
+        blended = alpha*current + (1-alpha)*self.previous
+        np.copyto(self.previous, blended, where=smooth)
+
+        return self.previous.astype(np.uint16)
+
+def decimate(image, factor):
+    # Downsample by taking the median of the valid pixels in each factor x factor
+    # block, as the librealsense decimation filter does for small factors. Blocks
+    # that are all holes stay holes
+    h, w = image.shape[0] // factor, image.shape[1] // factor
+    blocks = image[:h*factor, :w*factor].reshape(h, factor, w, factor).swapaxes(1, 2)
+    raw, counts = robust_percentile(blocks.reshape(h*w, factor*factor), 50)
+    raw[counts == 0] = 0
+
+    return raw.reshape(h, w)
+
+def spatial_smooth(image, alpha, delta):
+    # Edge preserving smoothing: each pixel is blended with the mean of its four
+    # neighbours that are valid and within delta of it, so depth edges survive
+    current = image.astype(np.float32)
+    total = np.zeros_like(current)
+    count = np.zeros_like(current)
+
+    # Pairs of (pixel, neighbour) slices for the up, down, left and right neighbour
+    body, head, tail = slice(None), slice(1, None), slice(None, -1)
+    for dst, src in [((head, body), (tail, body)), ((tail, body), (head, body)),
+                     ((body, head), (body, tail)), ((body, tail), (body, head))]:
+        neighbour = current[src]
+        close = (neighbour > 0) & (np.abs(neighbour - current[dst]) < delta)
+        total[dst] += neighbour * close
+        count[dst] += close
+
+    valid = (count > 0) & (image > 0)
+    total /= np.maximum(count, 1)
+    blended = alpha*current + (1-alpha)*total
+    np.copyto(current, blended, where=valid)
+
+    return current.astype(np.uint16)
+
+def fill_holes(image):
+    # Fill each hole with the closest valid pixel to its left on the same row
+    idx = np.where(image > 0, np.arange(image.shape[1]), 0)
+    np.maximum.accumulate(idx, axis=1, out=idx)
+
+    return np.take_along_axis(image, idx, axis=1)
+
+class DepthIntegral:
+    # Summed area tables of a depth frame: the depth sum, the squared depth sum
+    # and the number of valid pixels. Built once per frame, they make the mean,
+    # valid fraction and variance of any box a constant time lookup
+    def __init__(self, depth):
+        image, self.depth_scale = depth_array(depth)
+        self.height, self.width = image.shape[:2]
+
+        # OpenCV builds the tables with a leading row and column of zeros, so a box
+        # lookup never needs a bounds check. float64 holds the squared sums of a
+        # full z16 frame exactly
+        self.sum, self.squares = cv2.integral2(image, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+        self.count = cv2.integral((image > 0).view(np.uint8), sdepth=cv2.CV_32S)
+
+    def _box_sums(self, table, x1, y1, x2, y2):
+        return table[y2, x2] - table[y1, x2] - table[y2, x1] + table[y1, x1]
+
+    def box_stats(self, boxes):
+        # Mean depth (cm), valid pixel fraction and depth variance (cm^2) of an Nx4
+        # array of (x1, y1, x2, y2) pixel boxes. Holes are left out of the mean
+        # and variance, and boxes without valid pixels have a mean of 0
+        boxes = np.asarray(boxes, dtype=np.intp).reshape(-1, 4)
+        x1, x2 = np.clip(boxes[:, 0], 0, self.width), np.clip(boxes[:, 2], 0, self.width)
+        y1, y2 = np.clip(boxes[:, 1], 0, self.height), np.clip(boxes[:, 3], 0, self.height)
+
+        total = self._box_sums(self.sum, x1, y1, x2, y2)
+        squares = self._box_sums(self.squares, x1, y1, x2, y2)
+        count = self._box_sums(self.count, x1, y1, x2, y2)
+        area = np.maximum((x2 - x1) * (y2 - y1), 1)
+
+        # Statistics in raw depth units, then converted to centimetres
+        n = np.maximum(count, 1)
+        mean = total / n
+        variance = np.maximum(squares / n - mean*mean, 0)
+        scale = self.depth_scale * 100
+
+        return mean * scale, count / area, variance * scale * scale
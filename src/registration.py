@@ -0,0 +1,112 @@
+'''
+    Description: Depth to color registration built from the stored calibration
+                 (RealSense.get_calibration or a recording's index.json). The
+                 per-pixel lookup tables are computed once so that only the pixels
+                 or boxes that are actually queried need to be aligned, with a
+                 cv2.remap path for whole frames.
+
+                 Lens distortion is ignored, the D415 reports zero coefficients
+                 for both streams
+'''
+
+from realsense import depth_array, sample_distances, DEPTH_SCALE
+import numpy as np
+import cv2
+
+def camera_matrix(intrinsics):
+    # Focal lengths and principal point of a stream as an (fx, fy, ppx, ppy) tuple
+    return intrinsics["fx"], intrinsics["fy"], intrinsics["ppx"], intrinsics["ppy"]
+
+class Registration:
+    def __init__(self, calibration, iterations=2):
+        self.depth_intrinsics = calibration["depth_intrinsics"]
+        self.color_intrinsics = calibration["color_intrinsics"]
+        self.depth_scale = calibration.get("depth_scale", DEPTH_SCALE)
+        self.iterations = iterations
+
+        # librealsense stores the depth to color rotation column major. A point in
+        # the color frame maps back to the depth frame as P_d = R^T (P_c - t)
+        extrinsics = calibration["depth_to_color"]
+        rotation = np.reshape(extrinsics["rotation"], (3, 3)).T
+        translation = np.asarray(extrinsics["translation"])
+
+        # The ray through every color pixel expressed in the depth frame, so that
+        # a color pixel at color depth z lies at z*rays + origin in the depth frame
+        fx, fy, ppx, ppy = camera_matrix(self.color_intrinsics)
+        v, u = np.mgrid[0:self.color_intrinsics["height"], 0:self.color_intrinsics["width"]]
+        rays = np.dstack([(u - ppx) / fx, (v - ppy) / fy, np.ones(u.shape)])
+        self.rays = (rays @ rotation).astype(np.float32)
+        self.origin = (-rotation.T @ translation).astype(np.float32)
+
+        # Full frame remap tables, keyed by the plane depth they were built for
+        self.maps = {}
+
+    def _project(self, rays, z):
+        # Depth pixel of each color ray at the given depth (metres, depth frame)
+        z_color = (z - self.origin[2]) / rays[..., 2]
+        x = z_color * rays[..., 0] + self.origin[0]
+        y = z_color * rays[..., 1] + self.origin[1]
+
+        fx, fy, ppx, ppy = camera_matrix(self.depth_intrinsics)
+        return fx * x / z + ppx, fy * y / z + ppy
+
+    def color_to_depth(self, depth, points, ksize=5):
+        # Map an Nx2 array of color pixels to depth pixels. The first guess places
+        # every point far away, each iteration then samples the depth at the
+        # current guess and re-projects with it. Points on or past the edge of
+        # the color frame are clamped to its border
+        points = np.asarray(points, dtype=np.intp).reshape(-1, 2)
+        height, width = self.rays.shape[:2]
+        points = np.stack([np.clip(points[:, 0], 0, width-1), np.clip(points[:, 1], 0, height-1)], axis=1)
+        rays = self.rays[points[:, 1], points[:, 0]]
+
+        fx, fy, ppx, ppy = camera_matrix(self.depth_intrinsics)
+        u = fx * rays[:, 0] / rays[:, 2] + ppx
+        v = fy * rays[:, 1] / rays[:, 2] + ppy
+        for _ in range(self.iterations):
+            mapped = np.stack([u, v], axis=1).astype(np.intp)
+            z = sample_distances(depth, mapped, ksize=ksize) / 100.0
+
+            # Points that fall on a hole keep their previous estimate
+            valid = z > 0
+            u_new, v_new = self._project(rays[valid], z[valid])
+            u[valid], v[valid] = u_new, v_new
+
+        return np.stack([u, v], axis=1).astype(np.intp)
+
+    def sample_distances(self, depth, points, ksize=5, percentile=50, fill=0):
+        # Robust distance (cm) at an Nx2 array of color pixels
+        mapped = self.color_to_depth(depth, points, ksize=ksize)
+        return sample_distances(depth, mapped, ksize=ksize, percentile=percentile, fill=fill)
+
+    def boxes_to_depth(self, depth, boxes):
+        # Map Nx4 (x1, y1, x2, y2) color boxes to depth boxes. The parallax is
+        # nearly constant across one object, so the box is moved with its centre
+        # and scaled by the ratio of the focal lengths
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        centres = (boxes[:, :2] + boxes[:, 2:]) / 2
+        mapped = self.color_to_depth(depth, centres)
+
+        scale = np.array([self.depth_intrinsics["fx"] / self.color_intrinsics["fx"],
+                          self.depth_intrinsics["fy"] / self.color_intrinsics["fy"]])
+        half = (boxes[:, 2:] - boxes[:, :2]) / 2 * scale
+        return np.hstack([mapped - half, mapped + half]).astype(np.intp)
+
+    def remap_tables(self, z):
+        # Fixed point cv2.remap tables that align a depth frame to the color frame
+        # under the assumption that the whole scene lies at depth z (metres)
+        key = round(z, 2)
+        if key not in self.maps:
+            u, v = self._project(self.rays, key)
+            self.maps[key] = cv2.convertMaps(u.astype(np.float32), v.astype(np.float32), cv2.CV_16SC2)
+
+        return self.maps[key]
+
+    def align(self, depth, z=1.3):
+        # Resample a whole depth frame into the color frame geometry. The parallax
+        # error grows as objects move away from the plane depth z, which defaults
+        # to the distance at which the navigation decisions are made
+        image, _ = depth_array(depth)
+        map1, map2 = self.remap_tables(z)
+
+        return cv2.remap(image, map1, map2, cv2.INTER_NEAREST)
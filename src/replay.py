@@ -0,0 +1,298 @@
+'''
+    Description: Recording and replay of aligned RealSense color/depth streams so that
+                 the navigation code can be run and benchmarked without a camera.
+
+                 A recording is a folder of fixed size .npy chunks that are memory
+                 mapped on playback, a timestamps.npy file and an index.json that
+                 holds the chunk table and the camera calibration
+    Usage: python replay.py --output recordings/hallway --frames 900
+           python replay.py --info recordings/hallway
+'''
+
+from realsense import ArrayFrame, FrameSlot, DepthIntegral, DEPTH_SCALE, scale_intrinsics
+from threading import Thread, Lock
+import numpy as np
+import argparse
+import json
+import time
+import os
+
+INDEX_FILENAME = "index.json"
+TIMESTAMPS_FILENAME = "timestamps.npy"
+
+def frame_data(frame):
+    # Get the numpy array behind a librealsense frame, ArrayFrame or array
+    if isinstance(frame, np.ndarray):
+        return frame
+
+    return np.asanyarray(frame.get_data())
+
+class Recorder:
+    def __init__(self, path, calibration=None, chunk_size=300):
+        # Folder the recording is written to and the number of frames per chunk
+        self.path = path
+        self.chunk_size = chunk_size
+        self.calibration = calibration or {"depth_scale": DEPTH_SCALE}
+        os.makedirs(path, exist_ok=True)
+
+        # Chunk table, capture timestamps and the chunk currently being written
+        self.chunks = []
+        self.timestamps = []
+        self.color_chunk = None
+        self.depth_chunk = None
+
+    def _open_chunk(self, color, depth):
+        # Preallocate the next pair of memory mapped chunk files
+        number = len(self.chunks)
+        entry = {
+            "color": "color_{:05d}.npy".format(number),
+            "depth": "depth_{:05d}.npy".format(number),
+            "start": len(self.timestamps),
+            "count": 0,
+        }
+        self.color_chunk = np.lib.format.open_memmap(os.path.join(self.path, entry["color"]),
+            mode="w+", dtype=color.dtype, shape=(self.chunk_size,) + color.shape)
+        self.depth_chunk = np.lib.format.open_memmap(os.path.join(self.path, entry["depth"]),
+            mode="w+", dtype=depth.dtype, shape=(self.chunk_size,) + depth.shape)
+        self.chunks.append(entry)
+
+    def write(self, color, depth, timestamp=None):
+        # Store an aligned color/depth pair along with its capture time
+        color, depth = frame_data(color), frame_data(depth)
+        if not self.chunks or self.chunks[-1]["count"] == self.chunk_size:
+            self._open_chunk(color, depth)
+
+        entry = self.chunks[-1]
+        self.color_chunk[entry["count"]] = color
+        self.depth_chunk[entry["count"]] = depth
+        entry["count"] += 1
+        self.timestamps.append(time.time() if timestamp is None else timestamp)
+
+    def close(self):
+        # Flush the open chunk and write the timestamps and the index
+        if self.color_chunk is not None:
+            self.color_chunk.flush()
+            self.depth_chunk.flush()
+            self.color_chunk = self.depth_chunk = None
+
+        np.save(os.path.join(self.path, TIMESTAMPS_FILENAME), np.asarray(self.timestamps, dtype=np.float64))
+        with open(os.path.join(self.path, INDEX_FILENAME), "w") as f:
+            json.dump({
+                "frames": len(self.timestamps),
+                "chunk_size": self.chunk_size,
+                "chunks": self.chunks,
+                "calibration": self.calibration,
+            }, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class Recording:
+    def __init__(self, path):
+        # Load the index and memory map every chunk read-only
+        with open(os.path.join(path, INDEX_FILENAME)) as f:
+            self.index = json.load(f)
+        self.path = path
+        self.calibration = self.index["calibration"]
+        self.depth_scale = self.calibration.get("depth_scale", DEPTH_SCALE)
+        self.chunk_size = self.index["chunk_size"]
+        self.timestamps = np.load(os.path.join(path, TIMESTAMPS_FILENAME))
+
+        self.color_chunks = []
+        self.depth_chunks = []
+        for entry in self.index["chunks"]:
+            self.color_chunks.append(np.load(os.path.join(path, entry["color"]), mmap_mode="r"))
+            self.depth_chunks.append(np.load(os.path.join(path, entry["depth"]), mmap_mode="r"))
+
+    def __len__(self):
+        return self.index["frames"]
+
+    def __getitem__(self, i):
+        # Return the color image, depth image and timestamp of frame i. The images
+        # are views into the memory mapped chunks, so nothing is read until used
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("frame {} is outside the recording".format(i))
+
+        chunk, offset = divmod(i, self.chunk_size)
+        return self.color_chunks[chunk][offset], self.depth_chunks[chunk][offset], self.timestamps[i]
+
+    def seek_time(self, seconds):
+        # Index of the first frame at or after the given offset from the start
+        return int(np.searchsorted(self.timestamps, self.timestamps[0] + seconds))
+
+class ReplaySource:
+    def __init__(self, path, realtime=False, loop=False, start=0, integral=False, color_every=1, filters=None):
+        # Recording to play back. In realtime mode a thread paces the frames by
+        # their timestamps and read() returns the latest one. Otherwise every
+        # read() steps to the next frame so the consumer runs as fast as it can
+        self.recording = Recording(path)
+        self.realtime = realtime
+        self.loop = loop
+        self.integral = integral
+        self.position = start
+
+        # Only every color_every-th recorded frame carries its color frame, which
+        # stands in for a camera whose color stream runs slower than its depth stream
+        self.color_every = color_every
+
+        # Optional DepthFilterChain that is run on every replayed depth frame, as
+        # on the RealSense capture thread
+        self.filters = filters
+
+        # Height and width of the published depth frames and of the color stream,
+        # as on RealSense
+        self.height, self.width = self.recording[0][1].shape[:2]
+        if filters is not None:
+            self.width, self.height = filters.output_size(self.width, self.height)
+        self.color_height, self.color_width = self.recording[0][0].shape[:2]
+
+        # Framesets are handed out through the same slots that RealSense uses
+        self.slot = FrameSlot()
+        self.depth_slot = FrameSlot()
+        self.lock = Lock()
+        self.clock = None
+        self.stopped = False
+
+        # Like the camera, a realtime source has a frame ready once it is built
+        if realtime:
+            self.publish(self.position)
+            self._advance()
+
+    def publish(self, i):
+        # Publish frame i on the depth slot and, if it carries color, on the main
+        # slot. The framesets carry the recorded capture time so that anything
+        # that depends on the time between frames sees the recorded motion, even
+        # when replaying faster than realtime. Returns whether a color frameset
+        # was published
+        color, depth, timestamp = self.recording[i]
+        depth_frame = ArrayFrame(depth, self.recording.depth_scale)
+        if self.filters is not None:
+            depth_frame = self.filters.process(depth_frame)
+        integral = DepthIntegral(depth_frame) if self.integral else None
+        self.depth_slot.publish(None, depth_frame, timestamp=timestamp, integral=integral)
+        if i % self.color_every:
+            return False
+
+        self.slot.publish(ArrayFrame(color), depth_frame, timestamp=timestamp, integral=integral)
+        return True
+
+    def _advance(self):
+        # Move to the next frame, wrapping around or stopping at the end
+        self.position += 1
+        if self.position >= len(self.recording):
+            if not self.loop:
+                self.stopped = True
+                return False
+            self.position = 0
+
+        return True
+
+    def start(self):
+        # Start the thread that paces the frames in realtime mode
+        if self.realtime and not self.stopped:
+            Thread(target=self.update, args=(), daemon=True).start()
+        return self
+
+    def update(self):
+        timestamps = self.recording.timestamps
+        while not self.stopped:
+            # Restart the playback clock at the start and after a seek or wrap around
+            if self.clock is None:
+                self.clock = time.monotonic() - timestamps[self.position]
+
+            # Wait until the frame is due and then publish it
+            delay = self.clock + timestamps[self.position] - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.publish(self.position)
+
+            if not self._advance():
+                break
+            if self.position == 0:
+                self.clock = None
+
+        self.slot.close()
+        self.depth_slot.close()
+
+    def _step(self):
+        # Outside of realtime mode, publish frames until one with color has been
+        # published. The frames without color only reach the depth slot
+        with self.lock:
+            while not self.stopped:
+                published = self.publish(self.position)
+                self._advance()
+                if published:
+                    return
+
+            self.slot.close()
+            self.depth_slot.close()
+
+    def read(self, wait_newer_than=None, timeout=None):
+        # Return the most recent (color, depth) frameset, or None once the
+        # recording has been played through. Outside of realtime mode every
+        # read steps to the next frame with color
+        if not self.realtime:
+            self._step()
+
+        return self.slot.get(wait_newer_than=wait_newer_than, timeout=timeout)
+
+    def read_depth(self, wait_newer_than=None, timeout=None):
+        # Return the most recent depth-only frameset. Outside of realtime mode the
+        # frames are only stepped by read(), so this returns the depth frames that
+        # its stepping has published and never runs ahead of the color frames
+        return self.depth_slot.get(wait_newer_than=wait_newer_than, timeout=timeout)
+
+    def seek(self, i):
+        # Jump to frame i of the recording
+        self.position = i
+        self.clock = None
+
+    def get_calibration(self):
+        # The depth intrinsics are scaled to the published depth frames
+        calibration = self.recording.calibration
+        if "depth_intrinsics" in calibration:
+            calibration = dict(calibration, depth_intrinsics=scale_intrinsics(calibration["depth_intrinsics"],
+                                                                              self.width, self.height))
+        return calibration
+
+    def stop(self):
+        self.stopped = True
+        self.slot.close()
+        self.depth_slot.close()
+
+if __name__ == "__main__":
+    # Construct and parse the command line arguments
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--output", help="Folder to write a new recording from the camera to")
+    ap.add_argument("--frames", type=int, default=900, help="Number of frames to record")
+    ap.add_argument("--chunk", type=int, default=300, help="Number of frames per chunk file")
+    ap.add_argument("--resolution", default="640x480", help="Camera resolution in WxH")
+    ap.add_argument("--info", help="Print a summary of an existing recording")
+    args = vars(ap.parse_args())
+
+    if args["info"]:
+        recording = Recording(args["info"])
+        duration = recording.timestamps[-1] - recording.timestamps[0] if len(recording) else 0
+        print("[INFO] {} frames over {:.1f} seconds in {} chunks".format(
+            len(recording), duration, len(recording.index["chunks"])))
+        print(json.dumps(recording.calibration, indent=2))
+
+    if args["output"]:
+        from realsense import RealSense
+
+        W, H = [int(v) for v in args["resolution"].split("x")]
+        video = RealSense(width=W, height=H)
+
+        # Read frames synchronously so that no frameset is written twice
+        print("[INFO] recording {} frames to {}...".format(args["frames"], args["output"]))
+        with Recorder(args["output"], video.get_calibration(), chunk_size=args["chunk"]) as recorder:
+            for _ in range(args["frames"]):
+                frameset = video.pipeline.wait_for_frames()
+                recorder.write(frameset.get_color_frame(), frameset.get_depth_frame(),
+                               frameset.get_timestamp() / 1000)
+        video.stop()
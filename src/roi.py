@@ -0,0 +1,126 @@
+'''
+    Description: Depth guided region of interest for the detector. The near field
+                 obstacles of the depth frame and the walking corridor straight ahead
+                 pick a crop of the color frame that the detector runs on at close
+                 to its native resolution, with a full frame pass every few frames
+                 so that nothing outside the crop goes unseen for long. Boxes
+                 found in the crop are mapped back to the whole frame
+'''
+
+from realsense import depth_array
+from detector import Detections
+import numpy as np
+import cv2
+
+class CorridorROI:
+    def __init__(self, width=640, height=480, input_size=(300, 300), max_distance=2.0, rows=None,
+                 corridor=0.4, margin=0.1, refresh=10, max_area=0.7, step=4, jump=0.1, min_size=4):
+        # width and height are those of the color frame and input_size the (w, h)
+        # of the model input. Pixels closer than max_distance (m) between rows[0]
+        # and rows[1] are near field, which like in the obstacle map keeps the
+        # floor out. corridor is the centred fraction of the width over those rows
+        # that is always part of the crop and margin the fraction of the crop
+        # added on every side. Every refresh-th frame, and whenever the crop would
+        # cover more than max_area of the frame, the detector gets the full frame.
+        # The depth frame is sampled every step pixels. Neighbouring samples whose
+        # depth differs by more than jump of their depth belong to different
+        # surfaces, and near clusters of fewer than min_size samples are noise
+        self.width = width
+        self.height = height
+        self.rows = rows if rows is not None else (height // 4, 3 * height // 4)
+        self.input_size = input_size
+        self.max_distance = max_distance
+        self.corridor = corridor
+        self.margin = margin
+        self.refresh = refresh
+        self.max_area = max_area
+        self.step = step
+        self.jump = jump
+        self.min_size = min_size
+        self.full = (0, 0, width, height)
+
+        # Frames seen and how many of them were cropped
+        self.frames = 0
+        self.cropped = 0
+
+    def near_field(self, depth):
+        # Bounding box (x1, y1, x2, y2) in color pixels of the near clusters that
+        # reach into the corridor, or None. Indoors the walls are nearly always
+        # within max_distance, so near pixels are split into clusters at depth
+        # edges and only the clusters in the walking path count, which keeps a
+        # wall alongside from widening the crop to the whole frame. The depth
+        # frame is scaled to the color frame, which the margin leaves room for
+        # when the streams aren't registered exactly
+        image, scale = depth_array(depth)
+        sx, sy = self.width / image.shape[1], self.height / image.shape[0]
+        top, bottom = int(self.rows[0] / sy), int(self.rows[1] / sy)
+        sampled = image[top:bottom:self.step, ::self.step].astype(np.float32)
+        near = (sampled > 0) & (sampled < self.max_distance / scale)
+
+        # Break the near pixels apart where the depth jumps between neighbours
+        limit = sampled * self.jump
+        edges = np.zeros_like(near)
+        edges[:, :-1] |= np.abs(np.diff(sampled, axis=1)) > limit[:, :-1]
+        edges[:-1, :] |= np.abs(np.diff(sampled, axis=0)) > limit[:-1, :]
+        count, _, stats, _ = cv2.connectedComponentsWithStats((near & ~edges).astype(np.uint8), connectivity=4)
+
+        # Keep the clusters that overlap the corridor columns
+        half = self.width * self.corridor / 2
+        left, right = (self.width/2 - half) / (sx * self.step), (self.width/2 + half) / (sx * self.step)
+        x, y, w, h, area = stats[1:].T
+        keep = (area >= self.min_size) & (x < right) & (x + w > left)
+        if not keep.any():
+            return None
+
+        x, y, w, h = x[keep], y[keep], w[keep], h[keep]
+        return (x.min() * self.step * sx, (top + y.min() * self.step) * sy,
+                (x + w).max() * self.step * sx, (top + (y + h).max() * self.step) * sy)
+
+    def select(self, depth):
+        # Region (x1, y1, x2, y2) of the color frame the detector should run on
+        refresh = self.frames % self.refresh == 0
+        self.frames += 1
+        if refresh:
+            return self.full
+
+        # The corridor ahead, grown to the near field clusters in it
+        half = self.width * self.corridor / 2
+        x1, y1, x2, y2 = self.width/2 - half, self.rows[0], self.width/2 + half, self.rows[1]
+        near = self.near_field(depth)
+        if near is not None:
+            x1, y1, x2, y2 = min(x1, near[0]), min(y1, near[1]), max(x2, near[2]), max(y2, near[3])
+
+        # Add the margin, then grow the crop to the aspect ratio of the model
+        # input and to at least its size, so the crop is never upscaled
+        mx, my = (x2 - x1) * self.margin, (y2 - y1) * self.margin
+        x1, y1, x2, y2 = x1 - mx, y1 - my, x2 + mx, y2 + my
+        aspect = self.input_size[0] / self.input_size[1]
+        w = max(x2 - x1, (y2 - y1) * aspect, self.input_size[0])
+        h = max(w / aspect, self.input_size[1])
+        w = h * aspect
+        if w * h > self.max_area * self.width * self.height:
+            return self.full
+
+        # Centre the grown crop on the region and shift it back inside the frame
+        w, h = min(w, self.width), min(h, self.height)
+        cx, cy = (x1 + x2) / 2, (y1 + y2) / 2
+        x1 = int(np.clip(cx - w/2, 0, self.width - w))
+        y1 = int(np.clip(cy - h/2, 0, self.height - h))
+        self.cropped += 1
+        return x1, y1, x1 + int(w), y1 + int(h)
+
+    def crop(self, frame, region):
+        # View of the region of the color frame
+        x1, y1, x2, y2 = region
+        return frame[y1:y2, x1:x2]
+
+    def to_frame(self, detections, region):
+        # Map detections normalized to the crop back to normalized frame coordinates
+        x1, y1, x2, y2 = region
+        size = np.array([self.height, self.width] * 2, dtype=np.float32)
+        scale = np.array([y2 - y1, x2 - x1] * 2, dtype=np.float32) / size
+        offset = np.array([y1, x1] * 2, dtype=np.float32) / size
+        return Detections(detections.boxes * scale + offset, detections.classes, detections.scores)
+
+    def stats(self):
+        return {"frames": self.frames, "cropped": self.cropped}
@@ -3,7 +3,7 @@
     Usage: python rpi_test.py  
 '''
 
-from realsense import RealSense, filter_distance
+from realsense import RealSense, sample_distances
 import tflite_runtime.interpreter as tflite
 from depth_profile import get_depth_profile
 from imutils.video import FPS
@@ -53,30 +53,20 @@ def visualize_boxes(frame, depth_frame, boxes, scores, classes, H, W):
         cv2.rectangle(frame, (x1,y1), (x2,y2), (0,255,0), 2)
 
 def get_object_info(depth_frame, detections, scores, H, W):
-    # Initialize list to store bounding box coordinates of each bounding box
-    # and the distance of each block
-    object_info = []
+    # Only keep the detections whose score is above the threshold
+    keep = np.asarray(scores) > CONFIDENCE_THRESH
+    detections = np.asarray(detections).reshape(-1, 4)[keep]
 
-    for detection, score in zip(detections, scores):
-        # Only move forward if score is above the threshold
-        if score > CONFIDENCE_THRESH:
-            # Extract the coordinates of the detections and normalize each detection
-            y1, x1, y2, x2 = detection
-            y1 = int(H*y1)
-            x1 = int(W*x1)
-            y2 = int(H*y2)
-            x2 = int(W*x2)
+    # Scale the normalized (y1, x1, y2, x2) detections to pixel coordinates
+    y1, x1, y2, x2 = (detections * [H, W, H, W]).astype(int).T
 
-            # Get the midpoint of each bounding box
-            midX = (x1 + x2)//2
-            midY = (y1 + y2)//2
-            
-            distance = filter_distance(depth_frame, midX, midY)
-
-            # Add the coordinates to the coordinate list and the 
-            object_info.append((distance, (x1, y1, x2, y2)))
+    # Get the distance at the midpoint of every bounding box in one pass
+    midpoints = np.stack([(x1 + x2)//2, (y1 + y2)//2], axis=1)
+    distances = sample_distances(depth_frame, midpoints)
 
-    # Sort the data points by distance
+    # Pair each distance with its box coordinates and sort them by distance
+    object_info = [(int(d), (int(a), int(b), int(c), int(e)))
+                    for d, a, b, c, e in zip(distances, x1, y1, x2, y2)]
     object_info.sort()
 
     return object_info
@@ -125,17 +115,14 @@ def checkpoints(depth_frame):
     min_distance2 = 80
     W, H = 640, 480
 
-    # Coordinates of the points to be checked in the frame
-    center = filter_distance(depth_frame, W//2, H//2)
-    right = filter_distance(depth_frame, W//2 + 90, H//2)
-    left = filter_distance(depth_frame, W//2 - 90, H//2)
-    l_center = filter_distance(depth_frame, W//2, H//2 + 180)
-    l_right = filter_distance(depth_frame, W//2 + 60, H//2 + 180)
-    l_left = filter_distance(depth_frame, W//2 - 60, H//2 + 180)
+    # Coordinates of the points to be checked in the frame: center, right, left
+    # and the lower center, right and left
+    points = [(W//2, H//2), (W//2 + 90, H//2), (W//2 - 90, H//2),
+              (W//2, H//2 + 180), (W//2 + 60, H//2 + 180), (W//2 - 60, H//2 + 180)]
+    distances = sample_distances(depth_frame, points)
     
     # If any of the checkpoints are triggered raise a notification
-    if ((center < min_distance) or (left < min_distance) or (right < min_distance) or 
-        (l_center < min_distance) or (l_left < min_distance) or (l_right < min_distance)):
+    if (distances < min_distance).any():
         checkpoint_detection = True
         return True
     
@@ -150,8 +137,8 @@ def navigate(frame, depth_frame, dist, left, right):
     # Get the depth profile on either side of the object
     profile_w = 100
     y_offset = 30
-    left_profile = get_depth_profile(depth_frame, profile_w, left-profile_w, midY+y_offset)
-    right_profile = get_depth_profile(depth_frame, profile_w, right, midY+y_offset)   
+    left_profile = get_depth_profile(depth_frame, profile_w, left-profile_w, midY+y_offset, thickness=5)
+    right_profile = get_depth_profile(depth_frame, profile_w, right, midY+y_offset, thickness=5)   
             
     # Draw line across the profiles
     cv2.line(frame, (left-profile_w, midY+y_offset), (left, midY+y_offset), (0, 0, 255), thickness=2)
@@ -0,0 +1,216 @@
+'''
+    Description: Keeps the detections current between detector runs. A constant
+                 velocity Kalman filter per track, batched over all tracks,
+                 predicts where each box has moved, and detections are associated
+                 with the tracks by IoU so that every object keeps a stable id.
+                 DetectionScheduler decides on which frames the detector runs
+
+                 Boxes are normalized (y1, x1, y2, x2) like the detector output
+'''
+
+from detector import Detections
+from collections import namedtuple
+import numpy as np
+
+# Tracked boxes with the id of each track. Unpacks like Detections plus the ids
+Tracks = namedtuple("Tracks", ["boxes", "classes", "scores", "ids"])
+
+def iou_matrix(a, b):
+    # IoU of every box in a against every box in b
+    a, b = np.asarray(a, dtype=np.float32).reshape(-1, 4), np.asarray(b, dtype=np.float32).reshape(-1, 4)
+    top_left = np.maximum(a[:, None, :2], b[None, :, :2])
+    bottom_right = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+
+    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
+    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return intersection / np.maximum(union, 1e-9)
+
+def to_state(boxes):
+    # (y1, x1, y2, x2) boxes to (cx, cy, w, h) measurements
+    y1, x1, y2, x2 = boxes.T
+    return np.stack([(x1 + x2)/2, (y1 + y2)/2, x2 - x1, y2 - y1], axis=1)
+
+def to_boxes(state):
+    # (cx, cy, w, h, ...) states to (y1, x1, y2, x2) boxes
+    cx, cy, w, h = state[:, :4].T
+    return np.stack([cy - h/2, cx - w/2, cy + h/2, cx + w/2], axis=1)
+
+class Tracker:
+    def __init__(self, iou_threshold=0.3, max_misses=2, position_noise=0.05,
+                 size_noise=0.02, velocity_noise=0.2, measurement_noise=0.01):
+        # Detections are matched to tracks of the same class whose predicted box
+        # overlaps by at least iou_threshold. A track is dropped after max_misses
+        # detector runs in a row without a match. The noise terms are standard
+        # deviations in normalized units (per second for the process noise)
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.noise = np.array([position_noise, position_noise, size_noise, size_noise,
+                               velocity_noise, velocity_noise], dtype=np.float32) ** 2
+        self.R = np.eye(4, dtype=np.float32) * measurement_noise ** 2
+
+        # State (cx, cy, w, h, vx, vy) and covariance of every track, stacked
+        self.x = np.zeros((0, 6), dtype=np.float32)
+        self.P = np.zeros((0, 6, 6), dtype=np.float32)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.classes = np.zeros(0, dtype=np.int32)
+        self.scores = np.zeros(0, dtype=np.float32)
+        self.misses = np.zeros(0, dtype=np.int32)
+        self.next_id = 0
+
+        # Mean IoU between the predicted and detected boxes at the last update,
+        # and the number of tracks that were started or lost
+        self.agreement = 1.0
+        self.changes = 0
+
+    def __len__(self):
+        return len(self.x)
+
+    def predict(self, dt):
+        # Move every track dt seconds forward under constant velocity
+        if len(self.x) and dt > 0:
+            F = np.eye(6, dtype=np.float32)
+            F[0, 4] = F[1, 5] = dt
+            self.x = self.x @ F.T
+            self.P = F @ self.P @ F.T + np.diag(self.noise * dt)
+
+        return self.tracks()
+
+    def _associate(self, boxes, classes):
+        # Greedy matching in order of decreasing IoU, which for the handful of
+        # objects in a frame gives the same pairs as an optimal assignment. Small
+        # boxes that moved further than their own size between detector runs don't
+        # overlap their prediction, so the leftovers are then matched by the
+        # distance between the centres relative to the track's size
+        predicted = to_boxes(self.x)
+        same_class = self.classes[:, None] == classes[None, :]
+        iou = np.where(same_class, iou_matrix(predicted, boxes), 0)
+
+        centres = to_state(boxes)[:, :2]
+        size = np.linalg.norm(self.x[:, 2:4], axis=1)
+        distance = np.linalg.norm(self.x[:, None, :2] - centres[None], axis=2) / np.maximum(size[:, None], 1e-6)
+        closeness = np.where(same_class, 1 - distance, 0)
+
+        pairs = []
+        used_tracks, used_detections = set(), set()
+        for score, threshold in [(iou, self.iou_threshold), (closeness, 0.0)]:
+            order = np.argsort(-score, axis=None)
+            for t, d in zip(*np.unravel_index(order, score.shape)):
+                if score[t, d] <= threshold:
+                    break
+                if t in used_tracks or d in used_detections:
+                    continue
+                used_tracks.add(t)
+                used_detections.add(d)
+                pairs.append((t, d))
+
+        return np.array(pairs, dtype=np.intp).reshape(-1, 2), iou
+
+    def update(self, detections, dt=0.0):
+        # Predict the tracks to the time of the detections, correct the matched
+        # tracks, start tracks for the unmatched detections and age the rest
+        self.predict(dt)
+        boxes = np.asarray(detections.boxes, dtype=np.float32).reshape(-1, 4)
+        classes = np.asarray(detections.classes, dtype=np.int32)
+        scores = np.asarray(detections.scores, dtype=np.float32)
+
+        pairs, iou = self._associate(boxes, classes)
+        tracks, matched = pairs[:, 0], pairs[:, 1]
+        self.agreement = float(iou[tracks, matched].mean()) if len(pairs) else float(len(boxes) == len(self.x) == 0)
+
+        # Batched Kalman correction of the matched tracks
+        if len(pairs):
+            x, P = self.x[tracks], self.P[tracks]
+            y = to_state(boxes[matched]) - x[:, :4]
+            S = P[:, :4, :4] + self.R
+            K = P[:, :, :4] @ np.linalg.inv(S)
+            self.x[tracks] = x + np.einsum("nij,nj->ni", K, y)
+            self.P[tracks] = P - K @ P[:, :4, :]
+            self.scores[tracks] = scores[matched]
+        self.misses += 1
+        self.misses[tracks] = 0
+
+        # Drop the tracks that have gone unmatched for too long
+        keep = self.misses <= self.max_misses
+        self.changes = int(np.count_nonzero(~keep))
+        self.x, self.P, self.ids = self.x[keep], self.P[keep], self.ids[keep]
+        self.classes, self.scores, self.misses = self.classes[keep], self.scores[keep], self.misses[keep]
+
+        # Start a track for every detection that didn't match, at rest and with
+        # an uncertain velocity
+        new = np.setdiff1d(np.arange(len(boxes)), matched)
+        if len(new):
+            x = np.zeros((len(new), 6), dtype=np.float32)
+            x[:, :4] = to_state(boxes[new])
+            P = np.tile(np.diag(np.r_[np.diag(self.R), 1.0, 1.0]).astype(np.float32), (len(new), 1, 1))
+            self.x, self.P = np.concatenate([self.x, x]), np.concatenate([self.P, P])
+            self.ids = np.concatenate([self.ids, np.arange(self.next_id, self.next_id + len(new))])
+            self.classes = np.concatenate([self.classes, classes[new]])
+            self.scores = np.concatenate([self.scores, scores[new]])
+            self.misses = np.concatenate([self.misses, np.zeros(len(new), dtype=np.int32)])
+            self.next_id += len(new)
+            self.changes += len(new)
+
+        return self.tracks()
+
+    def tracks(self):
+        return Tracks(np.clip(to_boxes(self.x), 0, 1).astype(np.float32), self.classes.copy(),
+                      self.scores.copy(), self.ids.copy())
+
+class DetectionScheduler:
+    def __init__(self, tracker=None, interval=3, adaptive=False, max_interval=6, threshold=0.5):
+        # The detector runs every interval-th frame and the tracker fills in the
+        # frames between. In adaptive mode the interval grows while the tracker
+        # keeps agreeing with the detector and halves when it doesn't. Only
+        # detections scoring above the threshold are tracked
+        self.tracker = tracker if tracker is not None else Tracker()
+        self.interval = interval
+        self.adaptive = adaptive
+        self.max_interval = max_interval
+        self.threshold = threshold
+
+        # Frames seen, detector runs and frames since the tracker was last
+        # corrected, plus the time of the last frame given to the tracker
+        self.frames = 0
+        self.detections = 0
+        self.stale = 0
+        self.timestamp = None
+
+    def due(self):
+        # Whether the detector should run on the next frame. A detection that got
+        # lost before update() counts as not having happened
+        due = self.frames % self.interval == 0 or self.stale >= self.interval
+        self.frames += 1
+        return due
+
+    def _dt(self, timestamp):
+        dt = 0.0 if self.timestamp is None or timestamp is None else max(timestamp - self.timestamp, 0.0)
+        if timestamp is not None:
+            self.timestamp = timestamp
+        return dt
+
+    def update(self, detections, timestamp=None):
+        # Correct the tracker with the detector output of a frame
+        keep = np.asarray(detections.scores) > self.threshold
+        detections = Detections(*(np.asarray(field)[keep] for field in detections))
+        tracks = self.tracker.update(detections, self._dt(timestamp))
+        self.detections += 1
+        self.stale = 0
+
+        if self.adaptive:
+            if self.tracker.changes == 0 and self.tracker.agreement > 0.7:
+                self.interval = min(self.interval + 1, self.max_interval)
+            else:
+                self.interval = max(self.interval // 2, 1)
+
+        return tracks
+
+    def predict(self, timestamp=None):
+        # Tracked boxes for a frame on which the detector didn't run
+        self.stale += 1
+        return self.tracker.predict(self._dt(timestamp))
+
+    def stats(self):
+        return {"frames": self.frames, "detections": self.detections, "interval": self.interval,
+                "tracks": len(self.tracker)}
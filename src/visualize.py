@@ -0,0 +1,153 @@
+'''
+    Description: Debug view of the color frame, the colormapped depth frame, the
+                 detections and the depth profiles. Rendering and display run on
+                 their own thread at a capped rate so that the decision loop never
+                 waits on the window, and the whole view can be switched off for
+                 headless runs
+'''
+
+from realsense import depth_array
+from threading import Thread, Condition
+import numpy as np
+import time
+import cv2
+
+def depth_lut(alpha=0.03, colormap=cv2.COLORMAP_JET):
+    # BGR color of every z16 value, the same as applying the colormap to
+    # cv2.convertScaleAbs(depth, alpha=alpha). Each color is packed into one
+    # uint32 as BGRA so that the lookup gathers whole pixels at once
+    levels = np.clip(np.round(np.arange(65536) * alpha), 0, 255).astype(np.uint8)
+    bgra = np.zeros((65536, 4), dtype=np.uint8)
+    bgra[:, :3] = cv2.applyColorMap(levels.reshape(-1, 1), colormap).reshape(-1, 3)
+
+    return bgra.view(np.uint32).ravel()
+
+def colorize(depth, lut=None, out=None):
+    # Colormap a depth frame or z16 array through the lookup table into a BGR image
+    image, _ = depth_array(depth)
+    lut = depth_lut() if lut is None else lut
+    bgra = np.take(lut, image).view(np.uint8).reshape(image.shape + (4,))
+
+    return cv2.cvtColor(bgra, cv2.COLOR_BGRA2BGR, dst=out)
+
+class Visualizer:
+    def __init__(self, window="RealSense", max_fps=15, enabled=True, lut=None):
+        # Name of the window, the highest rate at which it is redrawn and whether
+        # there is a window at all
+        self.window = window
+        self.period = 1.0 / max_fps
+        self.enabled = enabled
+        self.lut = depth_lut() if lut is None and enabled else lut
+
+        # The frame waiting to be rendered. Frames that are submitted while the
+        # previous one is still waiting, or before the next redraw is due, are
+        # dropped
+        self.condition = Condition()
+        self.pending = None
+        self.due = 0.0
+        self.buffers = None
+        self.rendered = 0
+        self.dropped = 0
+
+        # Set when the window was closed with the "q" key
+        self.quit = False
+        self.stopped = False
+
+    def start(self):
+        # Start the thread that renders and displays the submitted frames
+        if self.enabled:
+            Thread(target=self.update, args=(), daemon=True).start()
+        return self
+
+    def submit(self, frame=None, depth=None, boxes=(), lines=(), text=None):
+        # Hand a frame to the render thread. The color and depth images are copied
+        # so the caller can reuse its buffers, boxes are (x1, y1, x2, y2, label)
+        # tuples and lines are ((x1, y1), (x2, y2)) segments in color pixels.
+        # Returns whether the frame will be shown
+        if not self.enabled:
+            return False
+
+        with self.condition:
+            if self.pending is not None or time.monotonic() < self.due:
+                self.dropped += 1
+                return False
+
+            color = None if frame is None else np.asanyarray(frame)
+            image = None if depth is None else depth_array(depth)[0]
+            if self.buffers is None:
+                self.buffers = [None, None]
+            for i, source in enumerate((color, image)):
+                if source is None:
+                    continue
+                if self.buffers[i] is None or self.buffers[i].shape != source.shape:
+                    self.buffers[i] = np.empty_like(source)
+                np.copyto(self.buffers[i], source)
+
+            self.pending = (color is not None, image is not None, list(boxes), list(lines), text)
+            self.due = time.monotonic() + self.period
+            self.condition.notify()
+            return True
+
+    def render(self, color, depth, boxes, lines, text):
+        # Draw the overlays on the color image and place the colormapped depth
+        # image next to it
+        if color is not None:
+            for x1, y1, x2, y2, label in boxes:
+                cv2.rectangle(color, (x1, y1), (x2, y2), (0, 255, 0), 2)
+                cv2.circle(color, ((x1 + x2)//2, (y1 + y2)//2), radius=5, color=(0, 0, 255), thickness=2)
+                if label:
+                    cv2.putText(color, label, (x1, y1 + 20), cv2.FONT_HERSHEY_SIMPLEX,
+                                0.6, (0, 0, 255), thickness=2)
+            for start, end in lines:
+                cv2.line(color, start, end, (0, 0, 255), thickness=2)
+            if text:
+                cv2.rectangle(color, (0, 0), (180, 25), (255, 255, 255), -1)
+                cv2.putText(color, text, (10, 20), cv2.FONT_HERSHEY_SIMPLEX,
+                            0.5, (0, 0, 0), thickness=2)
+
+        if depth is None:
+            return color
+
+        depth = colorize(depth, self.lut)
+        if color is None:
+            return depth
+        if depth.shape[:2] != color.shape[:2]:
+            depth = cv2.resize(depth, (color.shape[1], color.shape[0]), interpolation=cv2.INTER_NEAREST)
+
+        return np.hstack((color, depth))
+
+    def update(self):
+        while True:
+            # Wait for a frame to render. The submitted images stay in the buffers
+            # until pending is cleared, so nothing can overwrite them meanwhile.
+            # The rendered image can be the color buffer itself, so pending is
+            # only cleared once imshow has taken its copy
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending is not None or self.stopped)
+                if self.stopped:
+                    break
+                has_color, has_depth, boxes, lines, text = self.pending
+
+            color = self.buffers[0] if has_color else None
+            depth = self.buffers[1] if has_depth else None
+            image = self.render(color, depth, boxes, lines, text)
+
+            # The window has to be drawn and polled from the same thread
+            cv2.imshow(self.window, image)
+            with self.condition:
+                self.pending = None
+                self.rendered += 1
+            if cv2.waitKey(1) & 0xFF == ord("q"):
+                self.quit = True
+
+        cv2.destroyAllWindows()
+
+    def stats(self):
+        with self.condition:
+            return {"rendered": self.rendered, "dropped": self.dropped}
+
+    def stop(self):
+        # Stop the render thread, which closes the window
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()